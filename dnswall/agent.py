@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import os
 import sys
 import urlparse
@@ -8,8 +9,10 @@ import urlparse
 from dnswall import constants
 from dnswall import events
 from dnswall import loggers
+from dnswall import profiler
 from dnswall.backend import *
 from dnswall.commons import *
+from dnswall.compaction import *
 
 __BACKEND_TYPES = {"etcd": EtcdBackend}
 
@@ -26,7 +29,11 @@ def _get_callargs():
 
     parser.add_argument('-docker-url', dest='docker_url',
                         default=os.getenv(constants.DOCKER_URL_ENV, 'unix:///var/run/docker.sock'),
-                        help='docker daemon addr, default is unix:///var/run/docker.sock.')
+                        help='docker daemon addrs separated by comma, default is unix:///var/run/docker.sock.')
+    parser.add_argument('--docker-endpoints', dest='docker_endpoints',
+                        default=os.getenv(constants.DOCKER_ENDPOINTS_ENV),
+                        help='json file of docker endpoints watched instead of -docker-url, '
+                             'a list of objects with url, tls_verify, tls_ca, tls_cert, tls_key and zone.')
 
     parser.add_argument('--docker-tlsverify', dest='docker_tls_verify',
                         default=os.getenv(constants.DOCKER_TLSVERIFY_ENV, False), action='store_true')
@@ -37,11 +44,63 @@ def _get_callargs():
     parser.add_argument('--docker-tlscert', dest='docker_tls_cert',
                         default=os.getenv(constants.DOCKER_TLSCERT_ENV))
 
+    parser.add_argument('--heartbeat-interval', dest='heartbeat_interval',
+                        default=os.getenv(constants.HEARTBEAT_INTERVAL_ENV, 30), type=int,
+                        help='seconds between two heartbeats of containers, jittered by 10%%. default is 30.')
+    parser.add_argument('--write-rate', dest='write_rate',
+                        default=os.getenv(constants.WRITE_RATE_ENV, 50), type=float,
+                        help='max registrations written to backend per second, 0 means no limit, '
+                             'a warning is logged when too low to heartbeat all containers within an interval. '
+                             'default is 50.')
+    parser.add_argument('--write-burst', dest='write_burst',
+                        default=os.getenv(constants.WRITE_BURST_ENV, 100), type=int,
+                        help='max registrations written to backend at once. default is 100.')
+
+    parser.add_argument('--zone', dest='zone',
+                        default=os.getenv(constants.ZONE_ENV),
+                        help='zone of the docker host, default is the dnswall.zone label of docker daemon.')
+
+    parser.add_argument('--compact-interval', dest='compact_interval',
+                        default=os.getenv(constants.COMPACT_INTERVAL_ENV, 3600), type=int,
+                        help='seconds between two compactions of backend tree, run by one elected process, '
+                             '0 to disable. default is 3600.')
+
+    parser.add_argument('--profile-seconds', dest='profile_seconds',
+                        default=os.getenv(constants.PROFILE_SECONDS_ENV, 30), type=int,
+                        help='seconds sampled by the profiler when SIGUSR2 received. default is 30.')
+    parser.add_argument('--profile-output', dest='profile_output',
+                        default=os.getenv(constants.PROFILE_OUTPUT_ENV, '/tmp'),
+                        help='directory where profiler dumps samples. default is /tmp.')
+    parser.add_argument('--profile-format', dest='profile_format',
+                        default=os.getenv(constants.PROFILE_FORMAT_ENV, 'collapsed'),
+                        choices=['collapsed', 'pstats'],
+                        help='collapsed stacks or pstats file. default is collapsed.')
+
     return parser.parse_args()
 
 
+def _get_endpoints(callargs):
+    if callargs.docker_endpoints:
+        with open(callargs.docker_endpoints) as f:
+            return json.load(f) | select(lambda it: it.get('url')) | as_list
+
+    return callargs.docker_url \
+           | split(r'[,;\s]') \
+           | select(lambda it: it) \
+           | collect(lambda it: {'url': it,
+                                 'tls_verify': callargs.docker_tls_verify,
+                                 'tls_ca': callargs.docker_tls_ca,
+                                 'tls_cert': callargs.docker_tls_cert,
+                                 'tls_key': callargs.docker_tls_key}) \
+           | as_list
+
+
 def main():
     callargs = _get_callargs()
+    profiler.install(profiler.SamplingProfiler(seconds=callargs.profile_seconds,
+                                               output=callargs.profile_output,
+                                               fmt=callargs.profile_format,
+                                               prefix='dnswall-agent'))
 
     backend_url = callargs.backend
     if not backend_url:
@@ -54,8 +113,20 @@ def main():
         _logger.e('backend[type=%s] not found, agent exit.', backend_type)
         sys.exit(1)
 
+    docker_endpoints = _get_endpoints(callargs)
+    if not docker_endpoints:
+        _logger.e('docker endpoints must not be empty, agent exit.')
+        sys.exit(1)
+
     backend = backend_cls(backend_url)
-    events.loop(backend, callargs.docker_url)
+    if callargs.compact_interval > 0:
+        Compactor(backend, interval=callargs.compact_interval).start()
+
+    events.loop(backend, docker_endpoints,
+                zone=callargs.zone,
+                interval=callargs.heartbeat_interval,
+                write_rate=callargs.write_rate,
+                write_burst=callargs.write_burst)
 
 
 if __name__ == '__main__':
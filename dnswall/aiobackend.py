@@ -0,0 +1,430 @@
+"""
+
+"""
+import asyncio
+import json
+import time
+from urllib.parse import quote, urlencode
+
+import etcd
+
+from dnswall import loggers
+from dnswall.backend import *
+from dnswall.commons import *
+from dnswall.errors import *
+
+__all__ = ["AioEtcdBackend", "then", "maybe_future"]
+
+_MAX_IDLE_PER_HOST = 16
+
+
+def _copy(source, target):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def then(future, callback):
+    """
+    future of callback(future) once future is done, like addBoth of a deferred,
+    callback gets the done future and may return another future.
+    """
+
+    chained = asyncio.get_event_loop().create_future()
+
+    def _done(done):
+        if chained.done():
+            return
+        try:
+            value = callback(done)
+        except Exception as e:
+            chained.set_exception(e)
+            return
+
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(lambda it: _copy(it, chained))
+        else:
+            chained.set_result(value)
+
+    future.add_done_callback(_done)
+    return chained
+
+
+def maybe_future(function, *args, **kwargs):
+    """
+    call function, wrap its result or error in a future unless it returns one.
+    """
+
+    future = asyncio.get_event_loop().create_future()
+    try:
+        value = function(*args, **kwargs)
+    except Exception as e:
+        future.set_exception(e)
+        return future
+
+    if isinstance(value, asyncio.Future):
+        return value
+    future.set_result(value)
+    return future
+
+
+class _HttpConnection(asyncio.Protocol):
+    """
+    http/1.1 keep-alive connection carrying one request at a time,
+    response bodies are delimited by content-length or chunked encoding.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self._buffer = b''
+        self._waiter = None
+        self._closed = False
+
+    @property
+    def reusable(self):
+        return not self._closed and self._waiter is None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self._closed = True
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(ConnectionError('connection to etcd lost.'))
+
+    def close(self):
+        self._closed = True
+        self.transport.close()
+
+    def request(self, method, path, host, body=None):
+        """
+
+        :return: a future of three-tuple(status, headers, body).
+        """
+
+        self._waiter = waiter = asyncio.get_event_loop().create_future()
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(host), 'Accept: application/json']
+        if body is not None:
+            lines += ['Content-Type: application/x-www-form-urlencoded', 'Content-Length: {}'.format(len(body))]
+
+        self.transport.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        return waiter
+
+    def data_received(self, data):
+        self._buffer += data
+        if self._waiter is None:
+            return
+
+        response = self._parse()
+        if response is None:
+            return
+
+        waiter, self._waiter = self._waiter, None
+        if not waiter.done():
+            waiter.set_result(response)
+
+    def _parse(self):
+        head_end = self._buffer.find(b'\r\n\r\n')
+        if head_end < 0:
+            return None
+
+        lines = self._buffer[:head_end].decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = dict((it[0].strip().lower(), it[2].strip()) for it in (line.partition(':') for line in lines[1:]))
+
+        body_start = head_end + 4
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body, body_end = self._parse_chunked(body_start)
+            if body is None:
+                return None
+        else:
+            body_end = body_start + int(headers.get('content-length', 0))
+            if len(self._buffer) < body_end:
+                return None
+            body = self._buffer[body_start:body_end]
+
+        self._buffer = self._buffer[body_end:]
+        if headers.get('connection', '').lower() == 'close':
+            self._closed = True
+        return status, headers, body
+
+    def _parse_chunked(self, pos):
+        chunks = []
+        while True:
+            line_end = self._buffer.find(b'\r\n', pos)
+            if line_end < 0:
+                return None, pos
+
+            chunk_size = int(self._buffer[pos:line_end].split(b';')[0], 16)
+            chunk_start = line_end + 2
+            if len(self._buffer) < chunk_start + chunk_size + 2:
+                return None, pos
+
+            # etcd sends no trailers after the last chunk.
+            if chunk_size == 0:
+                return b''.join(chunks), chunk_start + 2
+
+            chunks.append(self._buffer[chunk_start:chunk_start + chunk_size])
+            pos = chunk_start + chunk_size + 2
+
+
+class AioEtcdBackend(EtcdBackend):
+    """
+    etcd backend talking to the etcd v2 http api on the asyncio event loop,
+    every operation returns a future instead of blocking.
+    """
+
+    asynchronous = True
+
+    def __init__(self, *args, **kwargs):
+        super(AioEtcdBackend, self).__init__(*args, **kwargs)
+        self._logger = loggers.getlogger('d.b.AioEtcdBackend')
+
+    def _new_client(self):
+        # endpoint -> idle connections.
+        self._idle = self._hosts | collect(lambda it: (it, [])) | as_dict
+        return None
+
+    def _connect(self, endpoint):
+        idle = self._idle[endpoint]
+        while idle:
+            connection = idle.pop()
+            if connection.reusable:
+                return maybe_future(lambda: connection)
+
+        loop = asyncio.get_event_loop()
+        connecting = asyncio.ensure_future(loop.create_connection(_HttpConnection, endpoint[0], endpoint[1]))
+        return then(connecting, lambda done: done.result()[1])
+
+    def _release(self, endpoint, connection, done):
+        try:
+            status, headers, body = done.result()
+        except Exception:
+            connection.close()
+            raise
+
+        if connection.reusable and len(self._idle[endpoint]) < _MAX_IDLE_PER_HOST:
+            self._idle[endpoint].append(connection)
+        else:
+            connection.close()
+        return self._to_result(status, headers, body)
+
+    def _request(self, method, etcd_key, params=None, body=None, measured=True, attempts=None):
+        """
+        send request to the endpoint picked by balancer, fail over to next endpoint on connection errors.
+
+        :return: a future of EtcdResult.
+        """
+
+        if attempts is None:
+            attempts = len(self._hosts)
+
+        endpoint = self._balancer.pick()
+        path = '/v2/keys{}'.format(quote(etcd_key))
+        if params:
+            path = '{}?{}'.format(path, urlencode(params))
+        data = urlencode(body).encode('utf-8') if body is not None else None
+        started = time.time()
+
+        def _send(connected):
+            connection = connected.result()
+            host = '{}:{}'.format(*endpoint)
+            return then(connection.request(method, path, host, body=data),
+                        lambda done: self._release(endpoint, connection, done))
+
+        def _failover(done):
+            try:
+                result = done.result()
+            except etcd.EtcdException:
+                self._balancer.succeeded(endpoint, time.time() - started if measured else None)
+                raise
+            except Exception:
+                self._balancer.failed(endpoint)
+                if attempts <= 1:
+                    raise
+
+                self._logger.w('request %s of %s occurs error, fail over to next endpoint.', path, endpoint)
+                return self._request(method, etcd_key, params=params, body=body,
+                                     measured=measured, attempts=attempts - 1)
+
+            self._balancer.succeeded(endpoint, time.time() - started if measured else None)
+            return result
+
+        return then(then(self._connect(endpoint), _send), _failover)
+
+    def _read_params(self, **params):
+        if self._quorum:
+            params['quorum'] = 'true'
+        return params
+
+    def _to_result(self, status, headers, body):
+        payload = json.loads(body.decode('utf-8'))
+        if status not in (200, 201):
+            payload['status'] = status
+            etcd.EtcdError.handle(payload)
+
+        result = etcd.EtcdResult(**payload)
+        result.etcd_index = headers.get('x-etcd-index', 1) | as_int
+        return result
+
+    def _backend_error(self, done, message, *args):
+        try:
+            return done.result()
+        except BackendError:
+            raise
+        except Exception:
+            self._logger.ex(message, *args)
+            raise BackendError
+
+    def register(self, name, item, ttl=None):
+        return maybe_future(self._register, name, item, ttl)
+
+    def _register(self, name, item, ttl):
+
+        etcd_keys = self._pointers_to_write(self._etcdkeys(name, item), item)
+        item_body = {'value': self._etcdvalue(item)}
+        if ttl:
+            item_body['ttl'] = ttl
+
+        pointer_body = {'value': self._etcdpointer(item.uuid)}
+        if ttl:
+            pointer_body['ttl'] = self._pointer_ttl(ttl)
+
+        def _write_pointers(done):
+            done.result()
+            return asyncio.gather(*[self._request('PUT', it, body=pointer_body) for it in etcd_keys])
+
+        def _registered(done):
+            self._backend_error(done, 'register occur error.')
+            self._pointers_written(etcd_keys, ttl, item)
+
+        # the item goes first, so a new pointer never points to nothing.
+        d = then(self._request('PUT', self._etcduuidkey(item.uuid), body=item_body), _write_pointers)
+        return then(d, _registered)
+
+    def unregister(self, name, item):
+        return maybe_future(self._unregister, name, item)
+
+    def _unregister(self, name, item):
+
+        def _not_found(done, etcd_key):
+            try:
+                return done.result()
+            except etcd.EtcdKeyError:
+                self._logger.d('unregister key %s not found, just ignore it', etcd_key)
+
+        def _unregistered(done):
+            self._backend_error(done, 'unregister occur error.')
+
+        etcd_keys = self._etcdkeys(name, item)
+        self._pointers_removed(etcd_keys, item)
+
+        requests = [then(self._request('DELETE', it), lambda done, it=it: _not_found(done, it))
+                    for it in etcd_keys + [self._etcduuidkey(item.uuid)]]
+        return then(asyncio.gather(*requests), _unregistered)
+
+    def lookup(self, name):
+        return maybe_future(self._lookup, name)
+
+    def _lookup(self, name):
+
+        self._check_name(name)
+        etcd_key = self._etcdkey(name)
+
+        def _to_namedetail(done):
+            try:
+                result = done.result()
+            except etcd.EtcdKeyError:
+                if not self._can_wildcard_lookback(name):
+                    return DomainDetail(name)
+                return self._lookup(self._get_wildcard_lookback(name))
+
+            return then(self._lookup_pointed([result]),
+                        lambda pointed: self._to_namedetail(name, result, pointed.result()))
+
+        d = then(self._request('GET', etcd_key, params=self._read_params(recursive='true')), _to_namedetail)
+        return then(d, lambda done: self._backend_error(done, 'lookup key %s occurs error.', etcd_key))
+
+    def _lookup_pointed(self, results):
+        pointed, missing = self._cached_items(self._pointers_of(results))
+
+        def _read(done):
+            pointed.update(done.result() | as_dict)
+            return pointed
+
+        def _read_all(done):
+            pointed.update(self._pointed_of(done.result(), missing))
+            return pointed
+
+        if self._reads_missing_at_once(missing):
+            return then(self._lookall_uuids(), _read_all)
+        return then(asyncio.gather(*[self._lookup_uuid(it) for it in missing]), _read)
+
+    def _lookup_uuid(self, uuid):
+
+        def _to_item(done):
+            try:
+                result = done.result()
+            except etcd.EtcdKeyError:
+                return uuid, None
+            return uuid, self._item_read(self._rawvalue(result.value, result.ttl), result.etcd_index)
+
+        return then(self._request('GET', self._etcduuidkey(uuid), params=self._read_params()), _to_item)
+
+    def lookall(self, name=None, with_index=False):
+
+        def _to_lookall(done):
+            results = done.result()
+            if self._reads_all_items(name):
+                d = self._lookall_uuids()
+            else:
+                d = self._lookup_pointed(results | select(lambda it: it[0] is not None)
+                                         | collect(lambda it: it[0]) | as_list)
+            return then(d, lambda pointed: self._to_lookall(results, pointed.result(), with_index))
+
+        d = then(asyncio.gather(*[self._lookall(it) for it in self._etcdlookallkeys(name)]), _to_lookall)
+        return then(d, lambda done: self._backend_error(done, 'lookall items occurs error.'))
+
+    def _lookall(self, etcd_key):
+
+        def _to_result(done):
+            try:
+                result = done.result()
+                return result, result.etcd_index
+            except etcd.EtcdKeyError:
+                self._logger.d('key %s not found, just ignore it.', etcd_key)
+                return None, 0
+
+        d = then(self._request('GET', etcd_key, params=self._read_params(recursive='true')), _to_result)
+        return then(d, lambda done: self._backend_error(done, 'lookall key %s occurs error.', etcd_key))
+
+    def _lookall_uuids(self):
+        etcd_key = self._etcduuidkey()
+
+        def _to_uuiditems(done):
+            try:
+                result = done.result()
+                return self._to_uuiditems(result, result.etcd_index)
+            except etcd.EtcdKeyError:
+                self._logger.d('key %s not found, just ignore it.', etcd_key)
+                return {}
+
+        d = then(self._request('GET', etcd_key, params=self._read_params(recursive='true')), _to_uuiditems)
+        return then(d, lambda done: self._backend_error(done, 'lookall key %s occurs error.', etcd_key))
+
+    def watch(self, name=None, index=None):
+
+        etcd_key = self._etcdwatchkey(name)
+        etcd_params = {'wait': 'true', 'recursive': 'true'}
+        if index:
+            etcd_params['waitIndex'] = index
+
+        d = self._request('GET', etcd_key, params=etcd_params, measured=False)
+        d = then(d, lambda done: self._to_change(done.result()))
+        return then(d, lambda done: self._backend_error(done, 'watch key %s occurs error.', etcd_key))
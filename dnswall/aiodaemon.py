@@ -0,0 +1,531 @@
+#!/usr/bin/env python3
+"""
+dns server on asyncio for python 3, serving the same backends as daemon for comparison.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import socket
+import struct
+import sys
+import time
+from urllib.parse import urlparse
+
+from dnswall import constants
+from dnswall import loggers
+from dnswall.aiobackend import *
+from dnswall.backend import *
+from dnswall.commons import *
+
+__ADDRPAIR_LEN = 2
+__BACKENDS = {"etcd": AioEtcdBackend}
+
+_HEADER = struct.Struct('!HHHHHH')
+_QUESTION = struct.Struct('!HH')
+_RECORD = struct.Struct('!HHIH')
+_LENGTH = struct.Struct('!H')
+
+_TYPE_A = 1
+_TYPE_AAAA = 28
+_TYPE_OPT = 41
+_CLASS_IN = 1
+_RCODE_OK = 0
+_RCODE_SERVFAIL = 2
+_MAX_UDP_SIZE = 512
+# compression pointer to the question name, which always follows the header.
+_QUESTION_NAME = b'\xc0\x0c'
+
+_Query = collections.namedtuple('_Query', ['id', 'flags', 'name', 'type', 'cls', 'question_end', 'udp_size'])
+
+_logger = loggers.getlogger('d.AioDaemon')
+
+
+def _parse_query(data):
+    """
+
+    :param data: raw query.
+    :return: _Query, or None if data is not a plain single question query optionally carrying an opt record.
+    """
+
+    if len(data) < _HEADER.size + 1 + _QUESTION.size:
+        return None
+
+    qid, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(data)
+    # qr and opcode must be zero.
+    if flags & 0xf800 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+
+    labels, pos = [], _HEADER.size
+    while True:
+        if pos >= len(data):
+            return None
+        label_len = data[pos]
+        if label_len == 0:
+            pos += 1
+            break
+        if label_len & 0xc0:
+            return None
+        labels.append(data[pos + 1:pos + 1 + label_len])
+        pos += 1 + label_len
+
+    if pos + _QUESTION.size > len(data):
+        return None
+    qtype, qclass = _QUESTION.unpack_from(data, pos)
+    question_end = pos + _QUESTION.size
+
+    udp_size = None
+    if arcount:
+        if question_end + 1 + _RECORD.size > len(data) or data[question_end] != 0:
+            return None
+        rtype, udp_size, _, _ = _RECORD.unpack_from(data, question_end + 1)
+        if rtype != _TYPE_OPT:
+            return None
+
+    try:
+        name = b'.'.join(labels).decode('ascii').lower()
+    except UnicodeDecodeError:
+        return None
+    return _Query(qid, flags, name, qtype, qclass, question_end, udp_size)
+
+
+def _build_response(data, query, rcode, records=None, max_size=None, max_udp_size=_MAX_UDP_SIZE):
+    """
+    build a response echoing the question of data, answers are dropped from the end to fit max_size.
+
+    :param data: raw query.
+    :param query: _Query parsed from data.
+    :param rcode:
+    :param records: list of three-tuple(type, ttl, rdata) answered.
+    :param max_size: max bytes of the response, None for streams.
+    :param max_udp_size: udp payload size advertised to edns0 clients.
+    :return: raw response.
+    """
+
+    opt = b'\0' + _RECORD.pack(_TYPE_OPT, max_udp_size, 0, 0) if query.udp_size is not None else b''
+    answers = (records or []) \
+              | collect(lambda it: _QUESTION_NAME + _RECORD.pack(it[0], _CLASS_IN, it[1], len(it[2])) + it[2]) \
+              | as_list
+
+    trunc = 0
+    if max_size is not None:
+        room = max_size - query.question_end - len(opt)
+        fitted = []
+        for answer in answers:
+            room -= len(answer)
+            if room < 0:
+                break
+            fitted.append(answer)
+        if answers and not fitted:
+            trunc = 0x0200
+        answers = fitted
+
+    # qr, rd copied from query, ra.
+    flags = 0x8000 | trunc | (query.flags & 0x0100) | 0x0080 | rcode
+    return _HEADER.pack(query.id, flags, 1, len(answers), 0, 1 if opt else 0) \
+           + data[_HEADER.size:query.question_end] + b''.join(answers) + opt
+
+
+class Forwarder(asyncio.DatagramProtocol):
+    """
+    forward raw queries to upstream servers over one udp socket,
+    a query is retried on the next server when one does not answer in time.
+    """
+
+    def __init__(self, servers, timeout=2):
+        """
+
+        :param servers: list of (host, port) of upstream servers, hosts must be addresses.
+        :param timeout: seconds waited for a server.
+        :return:
+        """
+        self._servers = servers
+        self._timeout = timeout
+        # upstream id -> (raw query, reply, attempt, server, timer)
+        self._pending = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def forward(self, data, reply, attempt=0):
+        if len(data) < _HEADER.size or not self._servers or self.transport is None:
+            return
+        if len(self._pending) >= 0xf000:
+            _logger.w('too many queries forwarding, drop one.')
+            return
+
+        upstream_id = random.randint(0, 0xffff)
+        while upstream_id in self._pending:
+            upstream_id = random.randint(0, 0xffff)
+
+        server = self._servers[attempt % len(self._servers)]
+        timer = asyncio.get_event_loop().call_later(self._timeout, self._expire, upstream_id)
+        self._pending[upstream_id] = (data, reply, attempt, server, timer)
+        self.transport.sendto(_LENGTH.pack(upstream_id) + data[2:], server)
+
+    def datagram_received(self, data, addr):
+        if len(data) < _HEADER.size:
+            return
+
+        upstream_id = _LENGTH.unpack_from(data)[0]
+        pending = self._pending.get(upstream_id)
+        if pending is None or tuple(addr[:2]) != pending[3]:
+            return
+
+        del self._pending[upstream_id]
+        query_data, reply, _, _, timer = pending
+        timer.cancel()
+        reply(query_data[:2] + data[2:])
+
+    def _expire(self, upstream_id):
+        pending = self._pending.pop(upstream_id, None)
+        if pending is None:
+            return
+
+        query_data, reply, attempt, server, _ = pending
+        if attempt + 1 < len(self._servers):
+            _logger.w('upstream %s does not answer, try next one.', server)
+            self.forward(query_data, reply, attempt=attempt + 1)
+            return
+
+        query = _parse_query(query_data)
+        if query is not None:
+            reply(_build_response(query_data, query, _RCODE_SERVFAIL))
+
+
+class Engine(object):
+    """
+    answer queries of backend names from backend, forward others,
+    concurrent lookups of a name share one backend request and results are reused for a few seconds.
+    """
+
+    def __init__(self, backend, forwarder, timeout=2, min_ttl=1, max_ttl=30, stale_age=3600,
+                 max_answers=16, max_udp_size=1232, cache_ttl=5, max_entries=10000):
+        """
+
+        :param backend: asynchronous backend returning futures.
+        :param forwarder:
+        :param timeout: seconds a backend lookup may take.
+        :param min_ttl: min ttl of answers.
+        :param max_ttl: max ttl of answers.
+        :param stale_age: max seconds last known records are served after backend fails.
+        :param max_answers: max records of an answer, 0 means no limit.
+        :param max_udp_size: max udp payload size negotiated with edns0 clients.
+        :param cache_ttl: seconds a lookup result is reused.
+        :param max_entries: max names whose lookup results are kept.
+        :return:
+        """
+        self._backend = backend
+        self._forwarder = forwarder
+        self._timeout = timeout
+        self._min_ttl = min_ttl
+        self._max_ttl = max_ttl
+        self._stale_age = stale_age
+        self._max_answers = max_answers
+        self._max_udp_size = [max_udp_size, _MAX_UDP_SIZE] | max
+        self._cache_ttl = cache_ttl
+        self._max_entries = max_entries
+        # name -> (DomainDetail, fetched_at), in least recently fetched order.
+        self._details = collections.OrderedDict()
+        # name -> future shared by queries waiting for the lookup of name.
+        self._inflight = {}
+
+    def handle(self, data, stream, reply):
+        """
+
+        :param data: raw query.
+        :param stream: True if query comes from tcp, whose responses are never trimmed.
+        :param reply: called with the raw response.
+        :return:
+        """
+
+        query = _parse_query(data)
+        if query is None or query.type not in (_TYPE_A, _TYPE_AAAA) or query.cls != _CLASS_IN \
+                or not self._backend.supports(query.name):
+            self._forwarder.forward(data, reply)
+            return
+
+        max_size = None
+        if not stream:
+            max_size = [[query.udp_size or _MAX_UDP_SIZE, _MAX_UDP_SIZE] | max, self._max_udp_size] | min
+
+        cached = self._details.get(query.name)
+        if cached is not None and time.time() - cached[1] < self._cache_ttl:
+            reply(self._to_response(data, query, cached[0], False, max_size))
+            return
+
+        def _answer(done):
+            try:
+                name_detail, stale = done.result()
+            except Exception:
+                reply(_build_response(data, query, _RCODE_SERVFAIL, max_udp_size=self._max_udp_size))
+                return
+            reply(self._to_response(data, query, name_detail, stale, max_size))
+
+        self._lookup(query.name).add_done_callback(_answer)
+
+    def _lookup(self, name):
+        """
+
+        :return: a future of two-tuple(DomainDetail, stale).
+        """
+
+        inflight = self._inflight.get(name)
+        if inflight is not None:
+            return inflight
+
+        loop = asyncio.get_event_loop()
+        inflight = self._inflight[name] = loop.create_future()
+        timer = loop.call_later(self._timeout, self._land, name, inflight, None, None)
+        then(maybe_future(self._backend.lookup, name), lambda done: self._land(name, inflight, done, timer))
+        return inflight
+
+    def _land(self, name, inflight, done, timer):
+        if inflight.done():
+            return
+        if timer is not None:
+            timer.cancel()
+        self._inflight.pop(name, None)
+
+        try:
+            if done is None:
+                raise asyncio.TimeoutError('lookup name {} exceeds {} seconds.'.format(name, self._timeout))
+            name_detail = done.result()
+        except Exception as e:
+            last_known = self._details.get(name)
+            if last_known is not None and time.time() - last_known[1] <= self._stale_age:
+                _logger.w('lookup name %s occurs error, serve last known records.', name)
+                inflight.set_result((last_known[0], True))
+            else:
+                _logger.e('lookup name %s occurs error: %r.', name, e)
+                inflight.set_exception(e)
+            return
+
+        self._details.pop(name, None)
+        self._details[name] = (name_detail, time.time())
+        if len(self._details) > self._max_entries:
+            self._details.popitem(last=False)
+        inflight.set_result((name_detail, False))
+
+    def _to_response(self, data, query, name_detail, stale, max_size):
+        if query.type == _TYPE_A:
+            family, to_address = socket.AF_INET, lambda it: it.host_ipv4
+        else:
+            family, to_address = socket.AF_INET6, lambda it: it.host_ipv6
+
+        items = name_detail.items | select(to_address) | as_list
+        ttl = self._to_ttl(items, stale)
+        addresses = collections.OrderedDict.fromkeys(items | collect(to_address)) | as_list
+        random.shuffle(addresses)
+        if self._max_answers:
+            addresses = addresses[:self._max_answers]
+
+        records = addresses | collect(lambda it: (query.type, ttl, socket.inet_pton(family, it))) | as_list
+        return _build_response(data, query, _RCODE_OK, records, max_size, self._max_udp_size)
+
+    def _to_ttl(self, items, stale):
+        if stale:
+            return [self._min_ttl, self._max_ttl] | min
+
+        ttls = items | select(lambda it: it.ttl is not None) | collect(lambda it: it.ttl) | as_list
+        ttl = ttls | min if ttls else self._max_ttl
+        return [self._min_ttl, [ttl, self._max_ttl] | min] | max
+
+
+class _DatagramServer(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self._engine = engine
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self._engine.handle(data, False, lambda response: self.transport.sendto(response, addr))
+
+
+class _StreamServer(asyncio.Protocol):
+    """
+    length prefixed queries over tcp, answered in completion order, idle connections are closed.
+    """
+
+    def __init__(self, engine, idle_timeout=10):
+        self._engine = engine
+        self._idle_timeout = idle_timeout
+        self._buffer = b''
+        self._timer = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._reset_timer()
+
+    def connection_lost(self, exc):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.transport = None
+
+    def _reset_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_event_loop().call_later(self._idle_timeout, self._idle)
+
+    def _idle(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def _write(self, response):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(_LENGTH.pack(len(response)) + response)
+            self._reset_timer()
+
+    def data_received(self, data):
+        self._reset_timer()
+        self._buffer += data
+
+        pos = 0
+        while len(self._buffer) - pos >= _LENGTH.size:
+            length = _LENGTH.unpack_from(self._buffer, pos)[0]
+            if len(self._buffer) - pos - _LENGTH.size < length:
+                break
+            start = pos + _LENGTH.size
+            pos = start + length
+            self._engine.handle(self._buffer[start:pos], True, self._write)
+
+        self._buffer = self._buffer[pos:]
+
+
+def _nameservers(resolv_path):
+    try:
+        with open(resolv_path) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return []
+
+    return lines \
+           | collect(lambda it: it.split()) \
+           | select(lambda it: len(it) >= 2 and it[0] == 'nameserver') \
+           | collect(lambda it: (it[1], 53)) \
+           | as_list
+
+
+def _get_callargs():
+    parser = argparse.ArgumentParser(prog='dnswall-aiodaemon',
+                                     description='dns server for docker containers on asyncio.')
+
+    parser.add_argument('-backend', dest='backend',
+                        default=os.getenv(constants.BACKEND_ENV),
+                        help='which backend to use.')
+
+    parser.add_argument('--addr', dest='addr',
+                        default=os.getenv(constants.ADDR_ENV, '0.0.0.0:53'),
+                        help='address used to serve dns request. default is 0.0.0.0:53.')
+
+    parser.add_argument('--patterns', dest='patterns',
+                        default=os.getenv(constants.PATTERNS_ENV, 'dnswall.local'),
+                        help='patterns of domain name handle by backend.')
+
+    parser.add_argument('--servers', dest='servers',
+                        default=os.getenv(constants.SERVERS_ENV, '119.29.29.29:53,114.114.114.114:53'),
+                        help='nameservers used to forward request. default is 119.29.29.29:53,114.114.114.114:53')
+
+    parser.add_argument('--lookup-timeout', dest='lookup_timeout',
+                        default=os.getenv(constants.LOOKUP_TIMEOUT_ENV, 2), type=float,
+                        help='seconds a backend lookup may take. default is 2.')
+    parser.add_argument('--min-ttl', dest='min_ttl',
+                        default=os.getenv(constants.MIN_TTL_ENV, 1), type=int,
+                        help='min ttl of backend answers. default is 1.')
+    parser.add_argument('--max-ttl', dest='max_ttl',
+                        default=os.getenv(constants.MAX_TTL_ENV, 30), type=int,
+                        help='max ttl of backend answers, answers never outlive their registration. default is 30.')
+    parser.add_argument('--stale-age', dest='stale_age',
+                        default=os.getenv(constants.STALE_AGE_ENV, 3600), type=int,
+                        help='max seconds last known records are served while backend fails. default is 3600.')
+    parser.add_argument('--max-answers', dest='max_answers',
+                        default=os.getenv(constants.MAX_ANSWERS_ENV, 16), type=int,
+                        help='max records of a backend answer, 0 means no limit. default is 16.')
+    parser.add_argument('--fastpath-ttl', dest='fastpath_ttl',
+                        default=os.getenv(constants.FASTPATH_TTL_ENV, 5), type=int,
+                        help='seconds a backend lookup result is reused. default is 5.')
+    parser.add_argument('--udp-size', dest='udp_size',
+                        default=os.getenv(constants.UDP_SIZE_ENV, 1232), type=int,
+                        help='max udp payload size negotiated with edns0 clients. default is 1232.')
+    parser.add_argument('--tcp-idle-timeout', dest='tcp_idle_timeout',
+                        default=os.getenv(constants.TCP_IDLE_TIMEOUT_ENV, 10), type=int,
+                        help='seconds an idle tcp connection is kept. default is 10.')
+
+    return parser.parse_args()
+
+
+def _new_loop():
+    # uvloop is optional, the standard event loop is used without it.
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+
+    _logger.w('serve on uvloop.')
+    return uvloop.new_event_loop()
+
+
+def main():
+    callargs = _get_callargs()
+
+    patterns = callargs.patterns | split('[,;\s]')
+    if not patterns:
+        _logger.e('patterns must not be empty, daemon exit.')
+        sys.exit(1)
+
+    backend_url = callargs.backend
+    if not backend_url:
+        _logger.e('%s env not set, use -backend instead, daemon exit.', constants.BACKEND_ENV)
+        sys.exit(1)
+
+    backend_type = urlparse(backend_url | strip).scheme | lowcase
+    backend_cls = __BACKENDS.get(backend_type)
+    if not backend_cls:
+        _logger.e('backend[type=%s] not found, daemon exit.', backend_type)
+        sys.exit(1)
+
+    dns_addr = callargs.addr | split(':')
+    if len(dns_addr) != __ADDRPAIR_LEN:
+        _logger.e('addr must like 0.0.0.0:53 format, daemon exit.')
+        sys.exit(1)
+
+    loop = _new_loop()
+    asyncio.set_event_loop(loop)
+
+    backend = backend_cls(backend_url, patterns=patterns)
+    dns_servers = [(it | split(':')) for it in (callargs.servers | split(','))]
+    dns_servers = _nameservers('/etc/resolv.conf') + [(it[0], it[1] | as_int) for it in dns_servers]
+
+    forwarder = Forwarder(dns_servers, timeout=callargs.lookup_timeout)
+    engine = Engine(backend, forwarder,
+                    timeout=callargs.lookup_timeout,
+                    min_ttl=callargs.min_ttl,
+                    max_ttl=callargs.max_ttl,
+                    stale_age=callargs.stale_age,
+                    max_answers=callargs.max_answers,
+                    max_udp_size=callargs.udp_size,
+                    cache_ttl=callargs.fastpath_ttl)
+
+    dns_port, dns_host = dns_addr[1] | as_int, dns_addr[0]
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: forwarder, local_addr=('0.0.0.0', 0)))
+    loop.run_until_complete(loop.create_datagram_endpoint(lambda: _DatagramServer(engine),
+                                                          local_addr=(dns_host, dns_port)))
+    loop.run_until_complete(loop.create_server(lambda: _StreamServer(engine, callargs.tcp_idle_timeout),
+                                               dns_host, dns_port))
+
+    _logger.w('waitting request on [tcp/udp] %s.', callargs.addr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        _logger.w('daemon interrupted, exit.')
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
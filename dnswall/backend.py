@@ -1,12 +1,23 @@
 import abc
 import json
 import re
-import urlparse
+import time
 
 import etcd
-import jsonselect
+
+# Python 2 & 3 compatibility
+try:
+    import urlparse
+except ImportError:
+    from urllib import parse as urlparse
+
+try:
+    import jsonselect
+except ImportError:
+    jsonselect = None
 
 from dnswall import loggers
+from dnswall.balancer import *
 from dnswall.commons import *
 from dnswall.errors import *
 
@@ -15,6 +26,24 @@ __all__ = ["DomainItem", "DomainDetail", "Backend", "EtcdBackend"]
 DOMAIN_REGEX = re.compile(r'^([a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,6}$')
 DOMAIN_WILDCARD_REGEX = re.compile(r'^\*\.([a-zA-Z0-9]([a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,6}$')
 
+# name pointers outlive the item they point to, so heartbeats only refresh the item.
+_POINTER_TTL_FACTOR = 5
+# seconds before pointers without ttl are written again, in case someone removed them.
+_POINTER_REFRESH = 600
+_MAX_POINTERS_KEPT = 100000
+# max seconds a pointed item is trusted without reading it again, items expire sooner by their ttl.
+_ITEM_MAX_AGE = 60
+_MAX_ITEMS_KEPT = 100000
+# pointed items missing from the cache are read one by one up to this many, more are read with one
+# recursive read of all items.
+_MAX_ITEM_READS = 16
+
+
+def _select(dict_obj, key):
+    if jsonselect is None:
+        return dict_obj.get(key)
+    return jsonselect.select('.{}'.format(key), dict_obj)
+
 
 def _is_valid_domain(name):
     if not name:
@@ -27,10 +56,13 @@ class DomainItem(object):
 
     """
 
-    def __init__(self, uuid=None, host_ipv4=None, host_ipv6=None):
+    def __init__(self, uuid=None, host_ipv4=None, host_ipv6=None, ttl=None, host=None, zone=None):
         self._uuid = uuid
         self._host_ipv4 = host_ipv4
         self._host_ipv6 = host_ipv6
+        self._ttl = ttl
+        self._host = host
+        self._zone = zone
 
     def __eq__(self, other):
         if self is other:
@@ -60,19 +92,47 @@ class DomainItem(object):
     def host_ipv6(self):
         return self._host_ipv6
 
+    @property
+    def host(self):
+        """
+        docker host the item runs on, None if unknown.
+        """
+        return self._host
+
+    @property
+    def zone(self):
+        """
+        zone of the docker host, None if unknown.
+        """
+        return self._zone
+
+    @property
+    def ttl(self):
+        """
+        seconds remaining before the registration expires when looked up, None if it never expires.
+        """
+        return self._ttl
+
     def to_dict(self):
         return {'uuid': self._uuid,
                 'host_ipv4': self._host_ipv4,
-                'host_ipv6': self._host_ipv6}
+                'host_ipv6': self._host_ipv6,
+                'host': self._host,
+                'zone': self._zone}
 
     @staticmethod
-    def from_dict(dict_obj):
-        uuid = jsonselect.select('.uuid', dict_obj)
-        host_ipv4 = jsonselect.select('.host_ipv4', dict_obj)
-        host_ipv6 = jsonselect.select('.host_ipv6', dict_obj)
+    def from_dict(dict_obj, ttl=None):
+        uuid = _select(dict_obj, 'uuid')
+        host_ipv4 = _select(dict_obj, 'host_ipv4')
+        host_ipv6 = _select(dict_obj, 'host_ipv6')
+        host = _select(dict_obj, 'host')
+        zone = _select(dict_obj, 'zone')
         return DomainItem(uuid=uuid,
                           host_ipv4=host_ipv4,
-                          host_ipv6=host_ipv6)
+                          host_ipv6=host_ipv6,
+                          ttl=ttl,
+                          host=host,
+                          zone=zone)
 
 
 class DomainDetail(object):
@@ -94,8 +154,8 @@ class DomainDetail(object):
 
     @staticmethod
     def from_dict(dict_obj):
-        name = jsonselect.select('.name', dict_obj)
-        items = jsonselect.select('.items', dict_obj)
+        name = _select(dict_obj, 'name')
+        items = _select(dict_obj, 'items')
         return DomainDetail(name,
                             items=items | collect(lambda it: DomainItem.from_dict(it)) | as_list)
 
@@ -106,6 +166,9 @@ class Backend(object):
     """
     __metaclass__ = abc.ABCMeta
 
+    # asynchronous backends return deferreds instead of blocking the caller.
+    asynchronous = False
+
     def __init__(self, backend_options, patterns=None):
         """
 
@@ -120,6 +183,15 @@ class Backend(object):
         else:
             self._path = backend_url.path
 
+        self._options = urlparse.parse_qsl(backend_url.query) | as_dict
+        self._patterns = patterns if patterns else []
+
+    @property
+    def patterns(self):
+        return self._patterns
+
+    @patterns.setter
+    def patterns(self, patterns):
         self._patterns = patterns if patterns else []
 
     def supports(self, name):
@@ -168,11 +240,23 @@ class Backend(object):
         pass
 
     @abc.abstractmethod
-    def lookall(self, name=None):
+    def lookall(self, name=None, with_index=False):
         """
 
         :param name:
-        :return:
+        :param with_index: also return the backend index the names are read at.
+        :return: list of DomainDetail, or two-tuple(list of DomainDetail, index) if with_index.
+        """
+        pass
+
+    @abc.abstractmethod
+    def watch(self, name=None, index=None):
+        """
+
+        :param name: watch names under this name, or all names if None.
+        :param index: watch changes since this index.
+        :return: three-tuple(action, name, index) of the next change, name is None if the change is not
+                    a name like an item or a lock, or None if no change happens before the watch times out.
         """
         pass
 
@@ -183,6 +267,8 @@ class EtcdBackend(Backend):
     """
 
     ITEMS_KEY = '@items'
+    UUIDS_KEY = '@uuids'
+    LOCKS_KEY = '@locks'
     WILDCARD_SYMBOL = "*"
     WILDCARD_NAME = "__wildcard__"
 
@@ -190,11 +276,59 @@ class EtcdBackend(Backend):
         super(EtcdBackend, self).__init__(*args, **kwargs)
 
         host_pairs = [(it | split(r':')) for it in (self._url.netloc | split(','))]
-        host_tuple = [(it[0], it[1] | as_int) for it in host_pairs] | as_tuple
-
-        self._client = etcd.Client(host=host_tuple, allow_reconnect=True)
+        self._hosts = [(it[0], it[1] | as_int) for it in host_pairs] | as_tuple
+
+        # reads go to any member unless quorum=true is given in backend options.
+        self._quorum = (self._options.get('quorum', 'false') | lowcase) == 'true'
+        self._balancer = EndpointBalancer(self._hosts, eject_seconds=self._options.get('eject', 10) | as_int)
+        self._client = self._new_client()
+        self._scope_keys = self._etcdscopekeys()
+        # pointer key -> time it should be written again.
+        self._pointers = {}
+        # uuid -> item value last written by this process.
+        self._written = {}
+        # uuid -> four-tuple(DomainItem, etcd index read at, time read at, time it must be read again).
+        self._items = {}
         self._logger = loggers.getlogger('d.b.EtcdBackend')
 
+    @Backend.patterns.setter
+    def patterns(self, patterns):
+        self._patterns = patterns if patterns else []
+        self._scope_keys = self._etcdscopekeys()
+
+    def _new_client(self):
+        return self._hosts \
+               | collect(lambda it: (it, etcd.Client(host=it[0], port=it[1], allow_reconnect=False))) \
+               | as_dict
+
+    def _call(self, method, *args, **kwargs):
+        """
+        call method of the client of the endpoint picked by balancer,
+        try next endpoint if the picked one can not be connected.
+        """
+
+        measured = kwargs.pop('measured', True)
+        for _ in self._hosts:
+            endpoint = self._balancer.pick()
+            started = time.time()
+            try:
+                result = getattr(self._client[endpoint], method)(*args, **kwargs)
+            except etcd.EtcdWatchTimedOut:
+                # a watch without changes times out on a healthy endpoint, it is not a connection failure.
+                self._balancer.succeeded(endpoint, None)
+                raise
+            except etcd.EtcdConnectionFailed:
+                self._balancer.failed(endpoint)
+                continue
+            except etcd.EtcdException:
+                self._balancer.succeeded(endpoint, time.time() - started if measured else None)
+                raise
+
+            self._balancer.succeeded(endpoint, time.time() - started if measured else None)
+            return result
+
+        raise etcd.EtcdConnectionFailed('no etcd endpoint can be connected.')
+
     def _etcdkey(self, name, uuid=None, with_items_key=True):
 
         if not uuid:
@@ -232,8 +366,115 @@ class EtcdBackend(Backend):
     def _etcdvalue(self, raw_value):
         return json.dumps(raw_value.to_dict(), sort_keys=True)
 
-    def _rawvalue(self, etcd_value):
-        return DomainItem.from_dict(json.loads(etcd_value))
+    def _rawvalue(self, etcd_value, etcd_ttl=None):
+        return DomainItem.from_dict(json.loads(etcd_value), ttl=etcd_ttl)
+
+    def _etcduuidkey(self, uuid=''):
+        return [self._path, EtcdBackend.UUIDS_KEY, uuid] | join('/') | replace(r'/+', '/')
+
+    def _etcdpointer(self, uuid):
+        return '{}/{}'.format(EtcdBackend.UUIDS_KEY, uuid)
+
+    def _pointed_uuid(self, etcd_value):
+        """
+
+        :param etcd_value: value of a name key.
+        :return: uuid the value points to, or None if value is an item written before pointers.
+        """
+
+        prefix = '{}/'.format(EtcdBackend.UUIDS_KEY)
+        if etcd_value.startswith(prefix):
+            return etcd_value[len(prefix):]
+        return None
+
+    def _pointer_ttl(self, ttl):
+        return ttl * _POINTER_TTL_FACTOR if ttl else None
+
+    def _stale_pointers(self, etcd_keys):
+        now = time.time()
+        return etcd_keys | select(lambda it: self._pointers.get(it, 0) <= now) | as_list
+
+    def _pointers_to_write(self, etcd_keys, item):
+        """
+        pointers about to expire, or all of them when the item changes,
+        so readers caching the item notice a pointer newer than their copy.
+        """
+
+        if self._written.get(item.uuid) != self._etcdvalue(item):
+            return etcd_keys
+        return self._stale_pointers(etcd_keys)
+
+    def _pointers_written(self, etcd_keys, ttl, item):
+        if len(self._pointers) >= _MAX_POINTERS_KEPT:
+            self._pointers.clear()
+        if len(self._written) >= _MAX_POINTERS_KEPT:
+            self._written.clear()
+        self._written[item.uuid] = self._etcdvalue(item)
+
+        # write again at half of pointer ttl, so a heartbeat refreshes pointers before they expire.
+        refresh = self._pointer_ttl(ttl) / 2.0 if ttl else _POINTER_REFRESH
+        rewrite_at = time.time() + refresh
+        for etcd_key in etcd_keys:
+            self._pointers[etcd_key] = rewrite_at
+
+    def _pointers_removed(self, etcd_keys, item):
+        self._written.pop(item.uuid, None)
+        for etcd_key in etcd_keys:
+            self._pointers.pop(etcd_key, None)
+
+    def _pointers_of(self, results):
+        """
+
+        :param results: etcd results of name keys.
+        :return: dict of uuid -> latest modified index of pointers to it.
+        """
+
+        pointers = {}
+        for result in results:
+            for leaf in result.leaves:
+                uuid = self._pointed_uuid(leaf.value) if leaf.value else None
+                if uuid:
+                    pointers[uuid] = [pointers.get(uuid, 0), leaf.modifiedIndex or 0] | max
+        return pointers
+
+    def _cached_items(self, pointers):
+        """
+        items of pointers still trusted, an item is read again once it may have expired
+        or a pointer to it was written after it was read.
+
+        :param pointers: dict returned by _pointers_of().
+        :return: two-tuple(dict of uuid -> DomainItem, list of uuids to read).
+        """
+
+        now = time.time()
+        cached, missing = {}, []
+        for uuid, pointer_index in pointers.items():
+            entry = self._items.get(uuid)
+            if entry is None or entry[1] < pointer_index or entry[3] <= now:
+                missing.append(uuid)
+                continue
+
+            item, _, read_at, _ = entry
+            ttl = item.ttl - int(now - read_at) if item.ttl is not None else None
+            cached[uuid] = DomainItem(uuid=item.uuid, host_ipv4=item.host_ipv4, host_ipv6=item.host_ipv6,
+                                      ttl=ttl, host=item.host, zone=item.zone)
+        return cached, missing
+
+    def _reads_missing_at_once(self, missing):
+        return len(missing) > _MAX_ITEM_READS
+
+    def _pointed_of(self, items, missing):
+        # items not found among all items have expired.
+        return missing | collect(lambda it: (it, items.get(it))) | as_dict
+
+    def _item_read(self, item, etcd_index):
+        if len(self._items) >= _MAX_ITEMS_KEPT:
+            self._items.clear()
+
+        now = time.time()
+        max_age = _ITEM_MAX_AGE if item.ttl is None else [item.ttl, _ITEM_MAX_AGE] | min
+        self._items[item.uuid] = (item, etcd_index, now, now + max_age)
+        return item
 
     def _can_wildcard_lookback(self, name):
         if EtcdBackend.WILDCARD_SYMBOL in name:
@@ -245,17 +486,63 @@ class EtcdBackend(Backend):
         name_list = name | split(r'\.') | as_list
         return ([EtcdBackend.WILDCARD_SYMBOL] + name_list[1:]) | join('.')
 
-    def register(self, name, item, ttl=None):
-
+    def _etcdkeys(self, name, item):
         name_list = name | split(r'[,|;]') | as_list
         name_list = name_list | collect(lambda it: self._check_name(it))
         name_item = self._check_item(item)
 
-        etcd_keys = name_list | collect(lambda it: self._etcdkey(it, uuid=name_item.uuid))
+        return name_list | collect(lambda it: self._etcdkey(it, uuid=name_item.uuid)) | as_list
+
+    def _etcdscopekeys(self):
+        """
+        subtree keys of the configured patterns, patterns nested in another one are dropped,
+        so a daemon only reads the names it serves.
+        """
+
+        if not self._patterns:
+            return [self._path]
+
+        etcd_keys = self._patterns \
+                    | collect(lambda it: self._etcdkey(it.strip('.'), with_items_key=False)) \
+                    | as_set \
+                    | sort \
+                    | as_list
+
+        return etcd_keys \
+               | select(lambda it: not etcd_keys | any(lambda other: other != it and it.startswith(other))) \
+               | as_list
+
+    def _etcdlookallkeys(self, name):
+        return [self._etcdkey(name, with_items_key=False)] if name else self._scope_keys
+
+    def _etcdwatchkey(self, name):
+        if name:
+            return self._etcdkey(name, with_items_key=False)
+
+        # one watch covers every scope, so watch their deepest common ancestor.
+        scope_parts = self._scope_keys | collect(lambda it: it | split(r'/') | as_list) | as_list
+        common_parts = []
+        for parts in zip(*scope_parts):
+            if len(parts | as_set) != 1:
+                break
+            common_parts.append(parts[0])
+
+        return common_parts | join('/') | replace(r'/+', '/') or '/'
+
+    def register(self, name, item, ttl=None):
+        """
+        item is written once under its uuid, names point to it,
+        pointers are only written again when they are about to expire.
+        """
+
+        etcd_keys = self._etcdkeys(name, item)
         try:
-            etcd_value = self._etcdvalue(name_item)
+            self._call('set', self._etcduuidkey(item.uuid), self._etcdvalue(item), ttl=ttl)
+
+            etcd_keys = self._pointers_to_write(etcd_keys, item)
             for etcd_key in etcd_keys:
-                self._client.set(etcd_key, etcd_value, ttl=ttl)
+                self._call('set', etcd_key, self._etcdpointer(item.uuid), ttl=self._pointer_ttl(ttl))
+            self._pointers_written(etcd_keys, ttl, item)
         except:
             self._logger.ex('register occur error.')
             raise BackendError
@@ -271,15 +558,15 @@ class EtcdBackend(Backend):
         return item
 
     def unregister(self, name, item):
+        """
+        remove pointers of names and the item itself, other names pointing to it resolve nothing.
+        """
 
-        name_list = name | split(r'[,|;]') | as_list
-        name_list = name_list | collect(lambda it: self._check_name(it))
-        name_item = self._check_item(item)
-
-        etcd_keys = name_list | collect(lambda it: self._etcdkey(it, uuid=name_item.uuid))
-        for etcd_key in etcd_keys:
+        etcd_keys = self._etcdkeys(name, item)
+        self._pointers_removed(etcd_keys, item)
+        for etcd_key in etcd_keys + [self._etcduuidkey(item.uuid)]:
             try:
-                self._client.delete(etcd_key)
+                self._call('delete', etcd_key)
             except etcd.EtcdKeyError:
                 self._logger.d('unregister key %s not found, just ignore it', etcd_key)
             except:
@@ -292,15 +579,8 @@ class EtcdBackend(Backend):
         etcd_key = self._etcdkey(name)
         try:
 
-            etcd_result = self._client.read(etcd_key, recursive=True)
-            etcd_items = etcd_result.leaves \
-                         | select(lambda it: it.value) \
-                         | collect(lambda it: (self._rawkey(it.key), it.value)) \
-                         | select(lambda it: it[0] == name) \
-                         | collect(lambda it: self._rawvalue(it[1])) \
-                         | as_list
-
-            return DomainDetail(name, items=etcd_items)
+            etcd_result = self._call('read', etcd_key, recursive=True, quorum=self._quorum)
+            return self._to_namedetail(name, etcd_result, self._lookup_pointed([etcd_result]))
         except etcd.EtcdKeyError:
             if not self._can_wildcard_lookback(name):
                 return DomainDetail(name)
@@ -310,43 +590,228 @@ class EtcdBackend(Backend):
             self._logger.ex('lookup key %s occurs error.', etcd_key)
             raise BackendError
 
-    def lookall(self, name=None):
+    def _lookup_pointed(self, results):
+        """
+        items pointed by results, only those not trusted from an earlier read are read from etcd.
+
+        :return: dict of uuid -> DomainItem.
+        """
+
+        pointed, missing = self._cached_items(self._pointers_of(results))
+        if self._reads_missing_at_once(missing):
+            pointed.update(self._pointed_of(self._lookall_uuids(), missing))
+        else:
+            pointed.update(missing | collect(self._lookup_uuid) | as_dict)
+        return pointed
+
+    def _lookup_uuid(self, uuid):
+        """
+
+        :return: two-tuple(uuid, DomainItem), item is None if it has expired.
+        """
 
-        etcd_key = self._etcdkey(name, with_items_key=False) if name else self._path
         try:
+            etcd_result = self._call('read', self._etcduuidkey(uuid), quorum=self._quorum)
+            return uuid, self._item_read(self._rawvalue(etcd_result.value, etcd_result.ttl), etcd_result.etcd_index)
+        except etcd.EtcdKeyError:
+            return uuid, None
+
+    def _to_item(self, etcd_value, etcd_ttl, pointed):
+        uuid = self._pointed_uuid(etcd_value)
+        if uuid is None:
+            return self._rawvalue(etcd_value, etcd_ttl)
+        return (pointed or {}).get(uuid)
 
-            etcd_result = self._client.read(etcd_key, recursive=True)
-            return self._to_namedetails(etcd_result)
+    def _to_namedetail(self, name, result, pointed=None):
+        """
+
+        :param name:
+        :param result:
+        :param pointed: dict of uuid -> DomainItem pointed by result.
+        :return:
+        """
+
+        etcd_items = result.leaves \
+                     | select(lambda it: it.value) \
+                     | select(lambda it: self._rawkey(it.key) == name) \
+                     | collect(lambda it: self._to_item(it.value, it.ttl, pointed)) \
+                     | select(lambda it: it) \
+                     | as_list
+
+        return DomainDetail(name, items=etcd_items)
+
+    def lookall(self, name=None, with_index=False):
+        results = self._etcdlookallkeys(name) | collect(self._lookall) | as_list
+        if self._reads_all_items(name):
+            pointed = self._lookall_uuids()
+        else:
+            pointed = self._lookup_pointed(results | select(lambda it: it[0] is not None)
+                                           | collect(lambda it: it[0]) | as_list)
+        return self._to_lookall(results, pointed, with_index)
+
+    def _reads_all_items(self, name):
+        # the whole tree references nearly every item, so one read of all of them is cheaper.
+        return name is None and not self._patterns
+
+    def _to_lookall(self, results, pointed, with_index):
+        """
+
+        :param results: list of two-tuple(etcd result or None if key not found, etcd index) of each looked key.
+        :param pointed: dict of uuid -> DomainItem.
+        :param with_index:
+        :return:
+        """
+
+        details = results \
+                  | select(lambda it: it[0] is not None) \
+                  | collect(lambda it: self._to_namedetails(it[0], pointed)) \
+                  | chain \
+                  | as_list
+        if not with_index:
+            return details
+        return details, results | collect(lambda it: it[1]) | max
+
+    def _lookall(self, etcd_key):
+        try:
+
+            etcd_result = self._call('read', etcd_key, recursive=True, quorum=self._quorum)
+            return etcd_result, etcd_result.etcd_index
         except etcd.EtcdKeyError:
             self._logger.d('key %s not found, just ignore it.', etcd_key)
-            return []
+            return None, 0
         except:
             self._logger.ex('lookall key %s occurs error.', etcd_key)
             raise BackendError
 
-    def _to_namedetails(self, result):
+    def _lookall_uuids(self):
+        etcd_key = self._etcduuidkey()
+        try:
+
+            etcd_result = self._call('read', etcd_key, recursive=True, quorum=self._quorum)
+            return self._to_uuiditems(etcd_result, etcd_result.etcd_index)
+        except etcd.EtcdKeyError:
+            self._logger.d('key %s not found, just ignore it.', etcd_key)
+            return {}
+        except:
+            self._logger.ex('lookall key %s occurs error.', etcd_key)
+            raise BackendError
+
+    def _to_uuiditems(self, result, etcd_index):
+        return result.leaves \
+               | select(lambda it: it.value) \
+               | collect(lambda it: self._item_read(self._rawvalue(it.value, it.ttl), etcd_index)) \
+               | collect(lambda it: (it.uuid, it)) \
+               | as_dict
+
+    def acquire(self, lock, owner, ttl):
+        """
+        take lock for owner, or renew it if owner holds it already.
+
+        :param lock: lock name.
+        :param owner: unique id of the caller.
+        :param ttl: seconds the lock is held without being renewed.
+        :return: True if owner holds the lock.
+        """
+
+        etcd_key = [self._path, EtcdBackend.LOCKS_KEY, lock] | join('/') | replace(r'/+', '/')
+        try:
+            try:
+                self._call('write', etcd_key, owner, ttl=ttl, prevValue=owner)
+                return True
+            except etcd.EtcdKeyNotFound:
+                self._call('write', etcd_key, owner, ttl=ttl, prevExist=False)
+                return True
+        except (etcd.EtcdCompareFailed, etcd.EtcdAlreadyExist):
+            return False
+        except:
+            self._logger.ex('acquire lock %s occurs error.', etcd_key)
+            raise BackendError
+
+    def compact(self):
+        """
+        remove directories left empty by expired keys, deepest first.
+        directories are removed without recursion, so one written meanwhile is never lost.
+
+        :return: dict of keys, dirs and pruned counts of the tree before compaction.
+        """
+
+        try:
+            etcd_result = self._call('read', self._path, recursive=True, quorum=True, measured=False)
+        except etcd.EtcdKeyNotFound:
+            return {'keys': 0, 'dirs': 0, 'pruned': 0}
+        except:
+            self._logger.ex('read tree %s occurs error.', self._path)
+            raise BackendError
+
+        nodes = etcd_result.get_subtree() | as_list
+        dirs = nodes | select(lambda it: it.dir) | collect(lambda it: it.key) | as_set
+        keys = nodes | select(lambda it: not it.dir) | collect(lambda it: it.key) | as_list
+
+        live_dirs = set()
+        for key in keys:
+            parts = key | split(r'/') | as_list
+            for i in range(1, len(parts)):
+                live_dirs.add(parts[:i] | join('/'))
+
+        empty_dirs = dirs - live_dirs - {etcd_result.key, self._path}
+        pruned = 0
+        for etcd_key in empty_dirs | sort(key=lambda it: it.count('/'), reverse=True):
+            try:
+                self._call('delete', etcd_key, dir=True, measured=False)
+                pruned += 1
+            except (etcd.EtcdKeyNotFound, etcd.EtcdDirNotEmpty):
+                self._logger.d('directory %s is gone or written meanwhile, just ignore it.', etcd_key)
+            except:
+                self._logger.ex('remove directory %s occurs error.', etcd_key)
+                raise BackendError
+
+        return {'keys': len(keys), 'dirs': len(dirs), 'pruned': pruned}
+
+    def watch(self, name=None, index=None):
+
+        etcd_key = self._etcdwatchkey(name)
+        try:
+
+            etcd_result = self._call('watch', etcd_key, index=index, recursive=True, measured=False)
+            return self._to_change(etcd_result)
+        except etcd.EtcdWatchTimedOut:
+            return None
+        except:
+            self._logger.ex('watch key %s occurs error.', etcd_key)
+            raise BackendError
+
+    def _to_change(self, result):
+        # items, locks and the like live under @ keys beside the names.
+        if result.key[len(self._path):].lstrip('/').startswith('@'):
+            return result.action, None, result.modifiedIndex
+        return result.action, self._rawkey(result.key), result.modifiedIndex
+
+    def _to_namedetails(self, result, pointed=None):
 
         results = {}
-        self._collect_namedetails(result, results)
+        self._collect_namedetails(result, results, pointed)
 
         for child in result.leaves:
-            self._collect_namedetails(child, results)
+            self._collect_namedetails(child, results, pointed)
 
-        return results.items() \
+        # dict views take | as set union on python 3, so iterate over them explicitly.
+        return iter(results.items()) \
                | collect(lambda it: DomainDetail(it[0], items=it[1])) \
                | as_list
 
-    def _collect_namedetails(self, result, results):
+    def _collect_namedetails(self, result, results, pointed):
 
         if not result.value:
             return
 
         name = self._rawkey(result.key)
-        item = self._rawvalue(result.value)
-
         if not self.supports(name):
             return
 
+        item = self._to_item(result.value, result.ttl, pointed)
+        if not item:
+            return
+
         if name in results:
             results[name].append(item)
         else:
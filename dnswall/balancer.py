@@ -0,0 +1,86 @@
+"""
+
+"""
+import random
+import threading
+import time
+
+from dnswall import loggers
+
+__all__ = ['EndpointBalancer']
+
+_logger = loggers.getlogger('d.b.EndpointBalancer')
+
+
+class EndpointBalancer(object):
+    """
+    pick the fastest healthy endpoint by smoothed latency,
+    failed or slow endpoints are ejected for a while and probed again afterwards.
+    """
+
+    def __init__(self, endpoints, eject_seconds=10, slow_factor=4, probe_ratio=0.05, alpha=0.2):
+        """
+
+        :param endpoints: list of hashable endpoints.
+        :param eject_seconds: seconds an ejected endpoint is not picked.
+        :param slow_factor: eject endpoint whose latency exceeds the fastest one by this factor.
+        :param probe_ratio: ratio of picks spread over other healthy endpoints to refresh their latency.
+        :param alpha: smoothing factor of latency.
+        :return:
+        """
+        self._endpoints = list(endpoints)
+        self._eject_seconds = eject_seconds
+        self._slow_factor = slow_factor
+        self._probe_ratio = probe_ratio
+        self._alpha = alpha
+        self._latencies = dict((it, 0.0) for it in self._endpoints)
+        self._ejected_until = dict((it, 0) for it in self._endpoints)
+        self._lock = threading.Lock()
+
+    def _healthy(self, now):
+        return [it for it in self._endpoints if self._ejected_until[it] <= now]
+
+    def pick(self):
+        """
+        :return: the endpoint to use, the one ejected most far in the past if all are ejected.
+        """
+        with self._lock:
+            healthy = self._healthy(time.time())
+            if not healthy:
+                return min(self._endpoints, key=lambda it: self._ejected_until[it])
+
+            if len(healthy) > 1 and random.random() < self._probe_ratio:
+                return random.choice(healthy)
+            return min(healthy, key=lambda it: self._latencies[it])
+
+    def succeeded(self, endpoint, elapsed=None):
+        """
+
+        :param endpoint:
+        :param elapsed: seconds the request took, None if it should not be measured.
+        :return:
+        """
+        with self._lock:
+            probing = self._ejected_until[endpoint]
+            if probing:
+                _logger.w('endpoint %s recovered.', endpoint)
+                self._ejected_until[endpoint] = 0
+
+            if elapsed is None:
+                return
+
+            # latency of an ejected endpoint is stale, start over from the probe.
+            latency = self._latencies[endpoint]
+            self._latencies[endpoint] = elapsed if probing or not latency else \
+                (1 - self._alpha) * latency + self._alpha * elapsed
+
+            now = time.time()
+            others = [self._latencies[it] for it in self._healthy(now) if it != endpoint and self._latencies[it]]
+            if others and self._latencies[endpoint] > self._slow_factor * min(others):
+                _logger.w('endpoint %s is slow, eject it for %d seconds.', endpoint, self._eject_seconds)
+                self._ejected_until[endpoint] = now + self._eject_seconds
+
+    def failed(self, endpoint):
+        with self._lock:
+            _logger.w('endpoint %s failed, eject it for %d seconds.', endpoint, self._eject_seconds)
+            self._ejected_until[endpoint] = time.time() + self._eject_seconds
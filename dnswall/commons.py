@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import __builtin__ as builtins
 import itertools
 import json
 import re
@@ -11,7 +10,17 @@ from contextlib import closing
 from datetime import datetime
 from functools import reduce
 
-import jsonselect
+# Python 2 & 3 compatibility
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+# jsonselect supports python 2 only, select_path is unavailable on python 3.
+try:
+    import jsonselect
+except ImportError:
+    jsonselect = None
 
 __author__ = 'Julien Palard <julien@eeple.fr>'
 __all__ = [
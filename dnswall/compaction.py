@@ -0,0 +1,66 @@
+"""
+
+"""
+import os
+import random
+import socket
+import threading
+import time
+
+from dnswall import loggers
+
+__all__ = ['Compactor']
+
+_LOCK = 'compaction'
+
+_logger = loggers.getlogger('d.c.Compactor')
+
+
+class Compactor(object):
+    """
+    prunes empty directories of the backend tree from a background thread,
+    processes sharing a backend elect one of them through a lock, the others stand by.
+    """
+
+    def __init__(self, backend, interval=3600, owner=None):
+        """
+
+        :param backend: EtcdBackend, compaction blocks so asynchronous backends are not supported.
+        :param interval: seconds between two compactions, the lock is held for two intervals.
+        :param owner: unique id of this process, default is hostname and pid.
+        :return:
+        """
+        self._backend = backend
+        self._interval = interval
+        self._owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def start(self):
+        compactor = threading.Thread(target=self._run, name='dnswall-compactor')
+        compactor.daemon = True
+        compactor.start()
+
+    def compact(self):
+        """
+
+        :return: stats returned by backend.compact(), or None if another process holds the lock.
+        """
+
+        if not self._backend.acquire(_LOCK, self._owner, ttl=self._interval * 2):
+            _logger.d('compaction is run by another process.')
+            return None
+
+        started = time.time()
+        stats = self._backend.compact()
+        _logger.w('backend tree has %d keys and %d dirs, %d empty dirs pruned in %.2f seconds.',
+                  stats['keys'], stats['dirs'], stats['pruned'], time.time() - started)
+        return stats
+
+    def _run(self):
+        # processes started together try the lock at different times.
+        time.sleep(random.uniform(0, self._interval))
+        while True:
+            try:
+                self.compact()
+            except:
+                _logger.ex('compaction occurs error, retry next interval.')
+            time.sleep(self._interval)
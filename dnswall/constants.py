@@ -13,7 +13,7 @@ class _Constants(object):
         pass
 
     def __setattr__(self, name, value):
-        if self.__dict__.has_key(name):
+        if name in self.__dict__:
             raise self.ConstantError("Can't rebind constant (%s)" % name)
 
         self.__dict__[name] = value
@@ -24,9 +24,55 @@ _constants.ADDR_ENV = 'DNSWALL_ADDR'
 _constants.BACKEND_ENV = 'DNSWALL_BACKEND'
 _constants.SERVERS_ENV = 'DNSWALL_SERVERS'
 _constants.PATTERNS_ENV = 'DNSWALL_PATTERNS'
+_constants.CONFIG_ENV = 'DNSWALL_CONFIG'
 _constants.DOCKER_URL_ENV = 'DNSWALL_DOCKER_URL'
+_constants.DOCKER_ENDPOINTS_ENV = 'DNSWALL_DOCKER_ENDPOINTS'
 _constants.DOCKER_TLSCA_ENV = 'DNSWALL_DOCKER_TLSCA'
 _constants.DOCKER_TLSKEY_ENV = 'DNSWALL_DOCKER_TLSKEY'
 _constants.DOCKER_TLSCERT_ENV = 'DNSWALL_DOCKER_TLSCERT'
 _constants.DOCKER_TLSVERIFY_ENV = 'DNSWALL_DOCKER_TLSVERIFY'
+_constants.HEARTBEAT_INTERVAL_ENV = 'DNSWALL_HEARTBEAT_INTERVAL'
+_constants.WRITE_RATE_ENV = 'DNSWALL_WRITE_RATE'
+_constants.WRITE_BURST_ENV = 'DNSWALL_WRITE_BURST'
+_constants.ASYNC_BACKEND_ENV = 'DNSWALL_ASYNC_BACKEND'
+_constants.LOOKUP_THREADS_ENV = 'DNSWALL_LOOKUP_THREADS'
+_constants.LOOKUP_QUEUE_ENV = 'DNSWALL_LOOKUP_QUEUE'
+_constants.LOOKUP_TIMEOUT_ENV = 'DNSWALL_LOOKUP_TIMEOUT'
+_constants.LOOKUP_OVERLOAD_ENV = 'DNSWALL_LOOKUP_OVERLOAD'
+_constants.MIN_TTL_ENV = 'DNSWALL_MIN_TTL'
+_constants.MAX_TTL_ENV = 'DNSWALL_MAX_TTL'
+_constants.STALE_TTL_ENV = 'DNSWALL_STALE_TTL'
+_constants.STALE_AGE_ENV = 'DNSWALL_STALE_AGE'
+_constants.FASTPATH_TTL_ENV = 'DNSWALL_FASTPATH_TTL'
+_constants.FORWARD_CACHE_ENV = 'DNSWALL_FORWARD_CACHE'
+_constants.PREFETCH_HITS_ENV = 'DNSWALL_PREFETCH_HITS'
+_constants.UDP_SIZE_ENV = 'DNSWALL_UDP_SIZE'
+_constants.TCP_CONNECTIONS_ENV = 'DNSWALL_TCP_CONNECTIONS'
+_constants.TCP_PEER_CONNECTIONS_ENV = 'DNSWALL_TCP_PEER_CONNECTIONS'
+_constants.TCP_IDLE_TIMEOUT_ENV = 'DNSWALL_TCP_IDLE_TIMEOUT'
+_constants.TCP_INFLIGHT_ENV = 'DNSWALL_TCP_INFLIGHT'
+_constants.RATE_LIMIT_ENV = 'DNSWALL_RATE_LIMIT'
+_constants.RATE_LIMIT_BURST_ENV = 'DNSWALL_RATE_LIMIT_BURST'
+_constants.RATE_LIMIT_SLIP_ENV = 'DNSWALL_RATE_LIMIT_SLIP'
+_constants.RATE_LIMIT_IPV4_PREFIX_ENV = 'DNSWALL_RATE_LIMIT_IPV4_PREFIX'
+_constants.RATE_LIMIT_IPV6_PREFIX_ENV = 'DNSWALL_RATE_LIMIT_IPV6_PREFIX'
+_constants.REVERSE_NETWORKS_ENV = 'DNSWALL_REVERSE_NETWORKS'
+_constants.REVERSE_INTERVAL_ENV = 'DNSWALL_REVERSE_INTERVAL'
+_constants.SNAPSHOT_ENV = 'DNSWALL_SNAPSHOT'
+_constants.SNAPSHOT_INTERVAL_ENV = 'DNSWALL_SNAPSHOT_INTERVAL'
+_constants.SNAPSHOT_AGE_ENV = 'DNSWALL_SNAPSHOT_AGE'
+_constants.ZONE_ENV = 'DNSWALL_ZONE'
+_constants.HOST_ENV = 'DNSWALL_HOST'
+_constants.ANSWER_ORDER_ENV = 'DNSWALL_ANSWER_ORDER'
+_constants.MAX_ANSWERS_ENV = 'DNSWALL_MAX_ANSWERS'
+_constants.TRANSFER_ACL_ENV = 'DNSWALL_TRANSFER_ACL'
+_constants.TRANSFER_INTERVAL_ENV = 'DNSWALL_TRANSFER_INTERVAL'
+_constants.TRANSFER_JOURNAL_ENV = 'DNSWALL_TRANSFER_JOURNAL'
+_constants.TRANSFER_NS_ENV = 'DNSWALL_TRANSFER_NS'
+_constants.COMPACT_INTERVAL_ENV = 'DNSWALL_COMPACT_INTERVAL'
+_constants.QUERY_LOG_ENV = 'DNSWALL_QUERY_LOG'
+_constants.QUERY_LOG_QUEUE_ENV = 'DNSWALL_QUERY_LOG_QUEUE'
+_constants.PROFILE_SECONDS_ENV = 'DNSWALL_PROFILE_SECONDS'
+_constants.PROFILE_OUTPUT_ENV = 'DNSWALL_PROFILE_OUTPUT'
+_constants.PROFILE_FORMAT_ENV = 'DNSWALL_PROFILE_FORMAT'
 sys.modules[__name__] = _constants
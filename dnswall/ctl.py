@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import urlparse
+
+from twisted.internet import defer, reactor, task
+
+from dnswall import constants
+from dnswall import loggers
+from dnswall.backend import *
+from dnswall.commons import *
+from dnswall.txbackend import *
+
+__BACKENDS = {"etcd": TxEtcdBackend}
+
+_CHUNK_SIZE = 64 * 1024
+_PROGRESS_EVERY = 10000
+# chars changing the nesting of json objects, backslashes escape the next char of strings.
+_STRUCTURAL = re.compile(r'[{}"\\]')
+# chars allowed between records, separators of a top level array among them.
+_SEPARATORS = ' \t\r\n,[]'
+
+_logger = loggers.getlogger('d.Ctl')
+
+
+def _get_callargs():
+    parser = argparse.ArgumentParser(prog='dnswall-ctl',
+                                     description='bulk import and export names of dnswall backend.')
+
+    parser.add_argument('-backend', dest='backend',
+                        default=os.getenv(constants.BACKEND_ENV),
+                        help='which backend to use.')
+
+    commands = parser.add_subparsers(dest='command')
+
+    import_parser = commands.add_parser('import', help='register names of a json or ndjson file.')
+    import_parser.add_argument('file', nargs='?', default='-',
+                               help='json array, json objects or ndjson of names, default is - for stdin.')
+    import_parser.add_argument('--ttl', dest='ttl', default=None, type=int,
+                               help='ttl of imported items, default is no ttl.')
+    import_parser.add_argument('--concurrency', dest='concurrency', default=16, type=int,
+                               help='max registrations written at once. default is 16.')
+
+    export_parser = commands.add_parser('export', help='write names of backend as json or ndjson.')
+    export_parser.add_argument('file', nargs='?', default='-',
+                               help='file written to, default is - for stdout.')
+    export_parser.add_argument('--name', dest='name', default=None,
+                               help='export names under this name only, default is all names.')
+    export_parser.add_argument('--format', dest='format', default='ndjson', choices=['ndjson', 'json'],
+                               help='one name per line or a json array. default is ndjson.')
+
+    return parser.parse_args()
+
+
+def _iter_records(stream, chunk_size=_CHUNK_SIZE):
+    """
+    decode json objects from stream one by one, they may be items of a json array,
+    one per line or just concatenated, so the whole file is never held in memory.
+    a record is decoded as soon as its closing brace is read, so a malformed one fails right there.
+
+    :param stream:
+    :param chunk_size: bytes read at once.
+    :return: generator of dicts.
+    """
+
+    decoder = json.JSONDecoder()
+    buf, pos, depth, in_string = '', 0, 0, False
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        buf += chunk
+        while True:
+            match = _STRUCTURAL.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+
+            char, pos = match.group(), match.end()
+            if char == '\\':
+                if pos == len(buf):
+                    # the escaped char is in the next chunk.
+                    pos -= 1
+                    break
+                pos += 1
+            elif char == '"':
+                in_string = not in_string
+            elif in_string:
+                continue
+            elif char == '{':
+                if depth == 0:
+                    _check_separators(buf[:match.start()])
+                    buf, pos = buf[match.start():], pos - match.start()
+                depth += 1
+            else:
+                depth -= 1
+                if depth < 0:
+                    raise ValueError('malformed json near: {}'.format(buf[:80]))
+                if depth == 0:
+                    yield _decode(decoder, buf[:pos])
+                    buf, pos = buf[pos:], 0
+
+        if depth == 0:
+            _check_separators(buf)
+            buf, pos = '', 0
+
+    if depth or in_string:
+        raise ValueError('malformed json near: {}'.format(buf[:80]))
+
+
+def _check_separators(text):
+    if text.strip(_SEPARATORS):
+        raise ValueError('malformed json near: {}'.format(text.lstrip(_SEPARATORS)[:80]))
+
+
+def _decode(decoder, text):
+    try:
+        return decoder.decode(text)
+    except ValueError:
+        raise ValueError('malformed json near: {}'.format(text[:80]))
+
+
+def _open(path, mode):
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    return open(path, mode)
+
+
+def _import(backend, callargs):
+    """
+    register names with concurrent writers sharing one record stream,
+    records are read only as fast as writers take them.
+    """
+
+    stream = _open(callargs.file, 'r')
+    stats = {'imported': 0, 'failed': 0}
+    started = time.time()
+
+    def _registered(_):
+        stats['imported'] += 1
+        if stats['imported'] % _PROGRESS_EVERY == 0:
+            _logger.w('%d items imported, %.0f items/s.',
+                      stats['imported'], stats['imported'] / (time.time() - started))
+
+    def _failed(failure, name):
+        stats['failed'] += 1
+        _logger.w('register name %s occurs error: %r.', name, failure.value)
+
+    def _registrations():
+        for record in _iter_records(stream):
+            try:
+                name_detail = DomainDetail.from_dict(record)
+            except Exception:
+                stats['failed'] += 1
+                _logger.w('ignore invalid record: %s.', json.dumps(record)[:80])
+                continue
+
+            for item in name_detail.items:
+                d = backend.register(name_detail.name, item, ttl=callargs.ttl)
+                d.addCallbacks(_registered, _failed, errbackArgs=(name_detail.name,))
+                yield d
+
+    def _done(result):
+        elapsed = time.time() - started
+        _logger.w('%d items imported, %d failed in %.2f seconds.', stats['imported'], stats['failed'], elapsed)
+        return 1 if stats['failed'] else 0
+
+    registrations = _registrations()
+    cooperator = task.Cooperator()
+    workers = [cooperator.coiterate(registrations) for _ in range([callargs.concurrency, 1] | max)]
+
+    d = defer.gatherResults(workers, consumeErrors=True)
+    d.addCallback(_done)
+    return d
+
+
+def _export(backend, callargs):
+    """
+    read and write names one part of the tree at a time, so the whole tree is never held in memory.
+    """
+
+    stream = _open(callargs.file, 'w')
+    as_array = callargs.format == 'json'
+    stats = {'exported': 0}
+
+    def _write(details):
+        for name_detail in details:
+            if not name_detail.items:
+                continue
+
+            line = json.dumps(name_detail.to_dict(), sort_keys=True)
+            if as_array:
+                line = '{}  {}'.format(',\n' if stats['exported'] else '', line)
+                stream.write(line)
+            else:
+                stream.write(line + '\n')
+            stats['exported'] += 1
+        stream.flush()
+
+    def _parts(parts):
+        for name, recursive in parts:
+            if not recursive and not backend.supports(name):
+                continue
+            d = backend.lookall(name) if recursive else backend.lookup(name).addCallback(lambda it: [it])
+            d.addCallback(_write)
+            yield d
+
+    def _done(_):
+        if as_array:
+            stream.write('{}]\n'.format('\n' if stats['exported'] else ''))
+        stream.flush()
+
+        _logger.w('%d names exported.', stats['exported'])
+        return 0
+
+    if as_array:
+        stream.write('[\n')
+
+    d = backend.lookall_parts(callargs.name)
+    d.addCallback(lambda parts: task.coiterate(_parts(parts)))
+    d.addCallback(_done)
+    return d
+
+
+def _run(backend, callargs, status):
+
+    def _done(code):
+        status['code'] = code
+
+    def _failed(failure):
+        _logger.e('%s occurs error: %s', callargs.command, failure.getErrorMessage())
+        status['code'] = 1
+
+    command = _import if callargs.command == 'import' else _export
+    d = defer.maybeDeferred(command, backend, callargs)
+    d.addCallbacks(_done, _failed)
+    d.addBoth(lambda _: reactor.stop())
+
+
+def main():
+    callargs = _get_callargs()
+
+    backend_url = callargs.backend
+    if not backend_url:
+        _logger.e('%s env not set, use -backend instead, ctl exit.', constants.BACKEND_ENV)
+        sys.exit(1)
+
+    backend_type = urlparse.urlparse(backend_url | strip).scheme | lowcase
+    backend_cls = __BACKENDS.get(backend_type)
+    if not backend_cls:
+        _logger.e('backend[type=%s] not found, ctl exit.', backend_type)
+        sys.exit(1)
+
+    backend = backend_cls(backend_url)
+    status = {'code': 1}
+    reactor.callWhenRunning(_run, backend, callargs, status)
+    reactor.run()
+    return status['code']
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
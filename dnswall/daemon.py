@@ -5,17 +5,27 @@ import os
 import sys
 import urlparse
 
-from twisted.internet import reactor
-from twisted.names import dns, server
+from twisted.internet import reactor, task, threads
 
 from dnswall import constants
 from dnswall import loggers
+from dnswall import profiler
 from dnswall.backend import *
 from dnswall.commons import *
+from dnswall.compaction import *
+from dnswall.protocols import *
+from dnswall.querylog import *
+from dnswall.ratelimit import *
+from dnswall.reloader import *
 from dnswall.resolver import *
+from dnswall.reverse import *
+from dnswall.snapshot import *
+from dnswall.transfer import *
+from dnswall.txbackend import *
 
 __ADDRPAIR_LEN = 2
 __BACKENDS = {"etcd": EtcdBackend}
+__ASYNC_BACKENDS = {"etcd": TxEtcdBackend}
 
 _logger = loggers.getlogger('d.Daemon')
 
@@ -28,6 +38,10 @@ def _get_callargs():
                         default=os.getenv(constants.BACKEND_ENV),
                         help='which backend to use.')
 
+    parser.add_argument('--async-backend', dest='async_backend',
+                        default=os.getenv(constants.ASYNC_BACKEND_ENV, False), action='store_true',
+                        help='talk to backend on the reactor instead of a thread pool.')
+
     parser.add_argument('--addr', dest='addr',
                         default=os.getenv(constants.ADDR_ENV, '0.0.0.0:53'),
                         help='address used to serve dns request. default is 0.0.0.0:53.')
@@ -39,14 +53,222 @@ def _get_callargs():
     parser.add_argument('--servers', dest='servers',
                         default=os.getenv(constants.SERVERS_ENV, '119.29.29.29:53,114.114.114.114:53'),
                         help='nameservers used to forward request. default is 119.29.29.29:53,114.114.114.114:53')
+    parser.add_argument('--config', dest='config',
+                        default=os.getenv(constants.CONFIG_ENV),
+                        help='json file of patterns and servers overriding --patterns and --servers, '
+                             'reloaded on SIGHUP without restart.')
+
+    parser.add_argument('--lookup-threads', dest='lookup_threads',
+                        default=os.getenv(constants.LOOKUP_THREADS_ENV, 10), type=int,
+                        help='max threads used to lookup backend. default is 10.')
+    parser.add_argument('--lookup-queue', dest='lookup_queue',
+                        default=os.getenv(constants.LOOKUP_QUEUE_ENV, 100), type=int,
+                        help='max lookups waiting for a thread before shedding. default is 100.')
+    parser.add_argument('--lookup-timeout', dest='lookup_timeout',
+                        default=os.getenv(constants.LOOKUP_TIMEOUT_ENV, 2), type=float,
+                        help='seconds a backend lookup may take. default is 2.')
+    parser.add_argument('--lookup-overload', dest='lookup_overload',
+                        default=os.getenv(constants.LOOKUP_OVERLOAD_ENV, OVERLOAD_FORWARD),
+                        choices=[OVERLOAD_FORWARD, OVERLOAD_SERVFAIL],
+                        help='answer shed or timeout lookups by forward or servfail. default is forward.')
+
+    parser.add_argument('--min-ttl', dest='min_ttl',
+                        default=os.getenv(constants.MIN_TTL_ENV, 1), type=int,
+                        help='min ttl of backend answers. default is 1.')
+    parser.add_argument('--max-ttl', dest='max_ttl',
+                        default=os.getenv(constants.MAX_TTL_ENV, 30), type=int,
+                        help='max ttl of backend answers, answers never outlive their registration. default is 30.')
+
+    parser.add_argument('--stale-ttl', dest='stale_ttl',
+                        default=os.getenv(constants.STALE_TTL_ENV, 5), type=int,
+                        help='ttl of last known records served when backend fails. default is 5.')
+    parser.add_argument('--stale-age', dest='stale_age',
+                        default=os.getenv(constants.STALE_AGE_ENV, 3600), type=int,
+                        help='max seconds last known records are served when backend fails. default is 3600.')
+
+    parser.add_argument('--fastpath-ttl', dest='fastpath_ttl',
+                        default=os.getenv(constants.FASTPATH_TTL_ENV, 5), type=int,
+                        help='max seconds raw udp responses are reused for repeated questions, 0 to disable. default is 5.')
+    parser.add_argument('--forward-cache', dest='forward_cache',
+                        default=os.getenv(constants.FORWARD_CACHE_ENV, 10000), type=int,
+                        help='max forwarded answers cached for their ttl, 0 to disable. default is 10000.')
+    parser.add_argument('--prefetch-hits', dest='prefetch_hits',
+                        default=os.getenv(constants.PREFETCH_HITS_ENV, 3), type=int,
+                        help='min hits within ttl for a forwarded answer to be refreshed before it expires, '
+                             '0 to disable. default is 3.')
+
+    parser.add_argument('--udp-size', dest='udp_size',
+                        default=os.getenv(constants.UDP_SIZE_ENV, 1232), type=int,
+                        help='max udp payload size negotiated with edns0 clients. default is 1232.')
+    parser.add_argument('--tcp-connections', dest='tcp_connections',
+                        default=os.getenv(constants.TCP_CONNECTIONS_ENV, 512), type=int,
+                        help='max tcp connections. default is 512.')
+    parser.add_argument('--tcp-peer-connections', dest='tcp_peer_connections',
+                        default=os.getenv(constants.TCP_PEER_CONNECTIONS_ENV, 32), type=int,
+                        help='max tcp connections of one client address. default is 32.')
+    parser.add_argument('--tcp-idle-timeout', dest='tcp_idle_timeout',
+                        default=os.getenv(constants.TCP_IDLE_TIMEOUT_ENV, 10), type=int,
+                        help='seconds an idle tcp connection is kept. default is 10.')
+    parser.add_argument('--tcp-inflight', dest='tcp_inflight',
+                        default=os.getenv(constants.TCP_INFLIGHT_ENV, 16), type=int,
+                        help='max pipelined queries of a tcp connection in flight. default is 16.')
+
+    parser.add_argument('--rate-limit', dest='rate_limit',
+                        default=os.getenv(constants.RATE_LIMIT_ENV, 0), type=float,
+                        help='max udp responses per second to a client prefix, 0 means no limit. default is 0.')
+    parser.add_argument('--rate-limit-burst', dest='rate_limit_burst',
+                        default=os.getenv(constants.RATE_LIMIT_BURST_ENV, 0), type=int,
+                        help='max udp responses to a client prefix at once. default is the rate.')
+    parser.add_argument('--rate-limit-slip', dest='rate_limit_slip',
+                        default=os.getenv(constants.RATE_LIMIT_SLIP_ENV, 2), type=int,
+                        help='every n-th limited query is answered truncated instead of dropped, '
+                             '0 drops them all. default is 2.')
+    parser.add_argument('--rate-limit-ipv4-prefix', dest='rate_limit_ipv4_prefix',
+                        default=os.getenv(constants.RATE_LIMIT_IPV4_PREFIX_ENV, 24), type=int,
+                        help='prefix length ipv4 clients are limited by. default is 24.')
+    parser.add_argument('--rate-limit-ipv6-prefix', dest='rate_limit_ipv6_prefix',
+                        default=os.getenv(constants.RATE_LIMIT_IPV6_PREFIX_ENV, 56), type=int,
+                        help='prefix length ipv6 clients are limited by. default is 56.')
+
+    parser.add_argument('--answer-order', dest='answer_order',
+                        default=os.getenv(constants.ANSWER_ORDER_ENV, ORDER_RANDOM),
+                        choices=[ORDER_RANDOM, ORDER_TOPOLOGY],
+                        help='order answers randomly or nearest to the client first. default is random.')
+    parser.add_argument('--max-answers', dest='max_answers',
+                        default=os.getenv(constants.MAX_ANSWERS_ENV, 16), type=int,
+                        help='max records of a backend answer, 0 means no limit. default is 16.')
+    parser.add_argument('--zone', dest='zone',
+                        default=os.getenv(constants.ZONE_ENV),
+                        help='zone of this daemon, answers in it go first when ordering by topology.')
+    parser.add_argument('--host', dest='host',
+                        default=os.getenv(constants.HOST_ENV),
+                        help='docker host of this daemon, answers on it go next when ordering by topology.')
+
+    parser.add_argument('--reverse-interval', dest='reverse_interval',
+                        default=os.getenv(constants.REVERSE_INTERVAL_ENV, 300), type=int,
+                        help='seconds between two full rebuilds of the reverse index answering ptr queries, '
+                             'which follows backend changes in between, 0 to forward ptr queries. '
+                             'an item expiring without unregister is answered until its names expire '
+                             'or the next rebuild. default is 300.')
+    parser.add_argument('--reverse-networks', dest='reverse_networks',
+                        default=os.getenv(constants.REVERSE_NETWORKS_ENV, ''),
+                        help='cidrs of container networks, unknown addresses in them are answered nxdomain.')
+
+    parser.add_argument('--snapshot', dest='snapshot',
+                        default=os.getenv(constants.SNAPSHOT_ENV),
+                        help='snapshot file loaded on start, served while backend catches up and when backend fails.')
+    parser.add_argument('--snapshot-interval', dest='snapshot_interval',
+                        default=os.getenv(constants.SNAPSHOT_INTERVAL_ENV, 60), type=int,
+                        help='seconds between two exports of the snapshot file, 0 to disable. default is 60.')
+    parser.add_argument('--snapshot-age', dest='snapshot_age',
+                        default=os.getenv(constants.SNAPSHOT_AGE_ENV, 300), type=int,
+                        help='max age in seconds of a snapshot answered before backend, names are served '
+                             'from it without waiting until backend answers them once, 0 to serve the '
+                             'snapshot only when backend fails. default is 300.')
+
+    parser.add_argument('--transfer-acl', dest='transfer_acl',
+                        default=os.getenv(constants.TRANSFER_ACL_ENV, ''),
+                        help='cidrs allowed to transfer pattern zones by axfr or ixfr. default is nobody.')
+    parser.add_argument('--transfer-interval', dest='transfer_interval',
+                        default=os.getenv(constants.TRANSFER_INTERVAL_ENV, 30), type=int,
+                        help='seconds between two rebuilds of transferred zones, 0 to disable transfers. '
+                             'default is 30.')
+    parser.add_argument('--transfer-journal', dest='transfer_journal',
+                        default=os.getenv(constants.TRANSFER_JOURNAL_ENV, 100), type=int,
+                        help='max zone changes kept for incremental transfers. default is 100.')
+    parser.add_argument('--transfer-ns', dest='transfer_ns',
+                        default=os.getenv(constants.TRANSFER_NS_ENV),
+                        help='name of this daemon, served as ns at the apex of transferred zones. '
+                             'default is fqdn of host.')
+
+    parser.add_argument('--query-log', dest='query_log',
+                        default=os.getenv(constants.QUERY_LOG_ENV),
+                        help='file where queries are logged as json lines, - for stderr. default is disabled.')
+    parser.add_argument('--query-log-queue', dest='query_log_queue',
+                        default=os.getenv(constants.QUERY_LOG_QUEUE_ENV, 10000), type=int,
+                        help='max query log records waiting to be written, new ones are dropped when full. '
+                             'default is 10000.')
+
+    parser.add_argument('--compact-interval', dest='compact_interval',
+                        default=os.getenv(constants.COMPACT_INTERVAL_ENV, 3600), type=int,
+                        help='seconds between two compactions of backend tree, run by one elected process, '
+                             '0 to disable. default is 3600.')
+
+    parser.add_argument('--profile-seconds', dest='profile_seconds',
+                        default=os.getenv(constants.PROFILE_SECONDS_ENV, 30), type=int,
+                        help='seconds sampled by the profiler when SIGUSR2 received. default is 30.')
+    parser.add_argument('--profile-output', dest='profile_output',
+                        default=os.getenv(constants.PROFILE_OUTPUT_ENV, '/tmp'),
+                        help='directory where profiler dumps samples. default is /tmp.')
+    parser.add_argument('--profile-format', dest='profile_format',
+                        default=os.getenv(constants.PROFILE_FORMAT_ENV, 'collapsed'),
+                        choices=['collapsed', 'pstats'],
+                        help='collapsed stacks or pstats file. default is collapsed.')
 
     return parser.parse_args()
 
 
+def _load_snapshot(path):
+    if not path or not os.path.exists(path):
+        return None
+
+    try:
+        return Snapshot(path)
+    except:
+        _logger.ex('load snapshot %s occurs error, just ignore it.', path)
+        return None
+
+
+def _export_snapshot(backend, backend_resolver, path):
+    d = backend.lookall() if backend.asynchronous else threads.deferToThread(backend.lookall)
+    d.addCallback(lambda details: threads.deferToThread(export, details, path))
+
+    def _exported(count):
+        backend_resolver.snapshot = Snapshot(path)
+        _logger.i('%d names exported to snapshot %s.', count, path)
+
+    def _failed(failure):
+        _logger.e('export snapshot %s occurs error, retry later.', path,
+                  exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
+    d.addCallbacks(_exported, _failed)
+    return d
+
+
+def _rebuild_transfer(backend, transfer):
+    if backend.asynchronous:
+        d = backend.lookall(with_index=True)
+    else:
+        d = threads.deferToThread(backend.lookall, with_index=True)
+    d.addCallback(lambda result: transfer.rebuild(*result))
+
+    def _rebuilt(count):
+        _logger.i('%d zones changed for transfer.', count)
+
+    def _failed(failure):
+        _logger.e('rebuild transferred zones occurs error, retry later.',
+                  exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+
+    d.addCallbacks(_rebuilt, _failed)
+    return d
+
+
 def main():
     callargs = _get_callargs()
+    profiler.install(profiler.SamplingProfiler(seconds=callargs.profile_seconds,
+                                               output=callargs.profile_output,
+                                               fmt=callargs.profile_format,
+                                               prefix='dnswall-daemon'))
 
-    patterns = callargs.patterns | split('[,;\s]')
+    config = {}
+    if callargs.config:
+        try:
+            config = load_config(callargs.config)
+        except Exception:
+            _logger.ex('load config %s occurs error, daemon exit.', callargs.config)
+            sys.exit(1)
+
+    patterns = config.get('patterns') or callargs.patterns | split('[,;\s]')
     if not patterns:
         _logger.e('patterns must not be empty, daemon exit.')
         sys.exit(1)
@@ -57,20 +279,61 @@ def main():
         sys.exit(1)
 
     backend_type = urlparse.urlparse(backend_url | strip).scheme | lowcase
-    backend_cls = __BACKENDS.get(backend_type)
+    backend_cls = (__ASYNC_BACKENDS if callargs.async_backend else __BACKENDS).get(backend_type)
     if not backend_cls:
         _logger.e('backend[type=%s] not found, daemon exit.', backend_type)
         sys.exit(1)
 
     backend = backend_cls(backend_url, patterns=patterns)
+    reverse_index = None
+    if callargs.reverse_interval > 0:
+        reverse_networks = callargs.reverse_networks | split(r'[,;\s]') | select(lambda it: it) | as_list
+        reverse_index = ReverseIndex(networks=reverse_networks)
+
     dns_servers = [(it | split(':')) for it in (callargs.servers | split(','))]
-    dns_servers = [(it[0], it[1] | as_int) for it in dns_servers] | as_list
-    dns_factory = server.DNSServerFactory(
-        clients=[
-            BackendResolver(backend=backend),
-            ProxyResovler(resolv='/etc/resolv.conf'),
-            ProxyResovler(servers=dns_servers)
-        ]
+    dns_servers = config.get('servers') or [(it[0], it[1] | as_int) for it in dns_servers] | as_list
+    backend_resolver = BackendResolver(backend=backend,
+                                       max_threads=callargs.lookup_threads,
+                                       max_queue=callargs.lookup_queue,
+                                       timeout=callargs.lookup_timeout,
+                                       overload=callargs.lookup_overload,
+                                       min_ttl=callargs.min_ttl,
+                                       max_ttl=callargs.max_ttl,
+                                       stale_ttl=callargs.stale_ttl,
+                                       stale_age=callargs.stale_age,
+                                       snapshot=_load_snapshot(callargs.snapshot),
+                                       snapshot_age=callargs.snapshot_age,
+                                       order=callargs.answer_order,
+                                       zone=callargs.zone,
+                                       host=callargs.host,
+                                       max_answers=callargs.max_answers,
+                                       reverse=reverse_index)
+    transfer = None
+    transfer_acl = callargs.transfer_acl | split(r'[,;\s]') | select(lambda it: it) | as_list
+    if callargs.transfer_interval > 0 and transfer_acl:
+        transfer = ZoneTransfer(patterns, acl=transfer_acl, ttl=callargs.max_ttl,
+                                refresh=callargs.transfer_interval, max_journal=callargs.transfer_journal,
+                                nameserver=callargs.transfer_ns)
+
+    servers_resolver = ProxyResovler(servers=dns_servers)
+    upstream_resolvers = [ProxyResovler(resolv='/etc/resolv.conf'), servers_resolver]
+    forward_resolver = None
+    if callargs.forward_cache > 0:
+        forward_resolver = ForwardResolver(upstream_resolvers,
+                                           max_entries=callargs.forward_cache,
+                                           prefetch_hits=callargs.prefetch_hits)
+        upstream_resolvers = [forward_resolver]
+
+    query_log = QueryLog(callargs.query_log, max_queue=callargs.query_log_queue) if callargs.query_log else None
+    dns_factory = ServerFactory(
+        max_connections=callargs.tcp_connections,
+        max_peer_connections=callargs.tcp_peer_connections,
+        idle_timeout=callargs.tcp_idle_timeout,
+        max_inflight=callargs.tcp_inflight,
+        max_udp_size=callargs.udp_size,
+        query_log=query_log,
+        transfer=transfer,
+        clients=[backend_resolver] + upstream_resolvers
     )
 
     dns_addr = callargs.addr | split(':')
@@ -81,7 +344,48 @@ def main():
     # listen for serve dns request.
     dns_port, dns_host = dns_addr[1] | as_int, dns_addr[0]
     reactor.listenTCP(dns_port, dns_factory, interface=dns_host)
-    reactor.listenUDP(dns_port, dns.DNSDatagramProtocol(controller=dns_factory), interface=dns_host)
+    limiter = None
+    if callargs.rate_limit > 0:
+        limiter = ResponseRateLimiter(callargs.rate_limit,
+                                      burst=callargs.rate_limit_burst,
+                                      slip=callargs.rate_limit_slip,
+                                      ipv4_prefix=callargs.rate_limit_ipv4_prefix,
+                                      ipv6_prefix=callargs.rate_limit_ipv6_prefix)
+    dns_protocol = FastDatagramProtocol(controller=dns_factory, max_ttl=callargs.fastpath_ttl,
+                                        per_client=callargs.answer_order == ORDER_TOPOLOGY,
+                                        query_log=query_log,
+                                        limiter=limiter,
+                                        max_udp_size=callargs.udp_size)
+    reactor.listenUDP(dns_port, dns_protocol, interface=dns_host)
+
+    if callargs.snapshot and callargs.snapshot_interval > 0:
+        exporter = task.LoopingCall(_export_snapshot, backend, backend_resolver, callargs.snapshot)
+        exporter.start(callargs.snapshot_interval, now=False)
+
+    reverse_follower = None
+    if reverse_index is not None:
+        reverse_follower = ReverseFollower(backend, reverse_index, interval=callargs.reverse_interval)
+        reverse_follower.start()
+
+    if callargs.compact_interval > 0:
+        # compaction blocks, so it always runs on a blocking backend in its own thread.
+        Compactor(__BACKENDS[backend_type](backend_url), interval=callargs.compact_interval).start()
+
+    if transfer is not None:
+        transfer_rebuilder = task.LoopingCall(_rebuild_transfer, backend, transfer)
+        transfer_rebuilder.start(callargs.transfer_interval, now=True)
+
+    if callargs.config:
+        rebuilders = []
+        if reverse_follower is not None:
+            rebuilders.append(reverse_follower.rebuild)
+        if transfer is not None:
+            rebuilders.append(lambda: _rebuild_transfer(backend, transfer))
+        Reloader(callargs.config, backend, backend_resolver, servers_resolver,
+                 forward_resolver=forward_resolver,
+                 transfer=transfer,
+                 protocol=dns_protocol,
+                 rebuilders=rebuilders).install()
 
     _logger.w('waitting request on [tcp/udp] %s.', callargs.addr)
     reactor.run()
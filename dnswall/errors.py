@@ -2,7 +2,7 @@
 
 """
 
-__all__ = ['BackendError', 'BackendNotFound', 'BackendValueError']
+__all__ = ['BackendError', 'BackendNotFound', 'BackendValueError', 'BackendOverloadError']
 
 
 class BackendError(Exception):
@@ -24,3 +24,10 @@ class BackendValueError(BackendError):
 
     """
     pass
+
+
+class BackendOverloadError(BackendError):
+    """
+
+    """
+    pass
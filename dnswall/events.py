@@ -1,52 +1,173 @@
 """
 
 """
+import random
 import sched
+import threading
 import time
 
 import docker
+import docker.tls
 
 from dnswall import loggers
 from dnswall import supervisor
 from dnswall.backend import *
 from dnswall.commons import *
 from dnswall.errors import *
+from dnswall.ratelimit import *
+from dnswall.writers import *
 
 _logger = loggers.getlogger('d.e.Loop')
 
+_ZONE_LABEL = 'dnswall.zone'
+# heartbeat interval varies by this ratio, so agents drift apart instead of beating in lockstep.
+_INTERVAL_JITTER = 0.1
 
-def loop(backend, docker_url):
+
+def loop(backend, endpoints, zone=None, interval=30, write_rate=0, write_burst=None):
     """
 
     :param backend:
-    :param docker_url:
+    :param endpoints: list of docker endpoints, dicts of url, tls_verify, tls_ca, tls_cert, tls_key and zone.
+    :param zone: zone of docker hosts without zone, read from docker daemon labels if None.
+    :param interval: seconds between two heartbeats, registrations expire after two intervals.
+    :param write_rate: max registrations written per second, 0 means no limit.
+    :param write_burst: max registrations written at once when rate limited.
     :return:
     """
 
-    _logger.w('start and supervise event loop.')
-    client = docker.AutoVersionClient(base_url=docker_url)
-    supervisor.supervise(min_seconds=2, max_seconds=64)(_heartbeat)(backend, client)
+    limiter = TokenBucket(write_rate, burst=write_burst) if write_rate > 0 else None
+    budget = _WriteBudget(limiter, interval)
+    if len(endpoints) == 1:
+        _supervise(backend, endpoints[0], zone, interval, limiter, budget)
+        return
+
+    # registrations of all docker hosts go through one writer.
+    writer = BatchWriter(backend, limiter=limiter)
+    watchers = []
+    for endpoint in endpoints:
+        watcher = threading.Thread(target=_supervise, args=(writer, endpoint, zone, interval, None, budget),
+                                   name='dnswall-docker-{}'.format(len(watchers)))
+        watcher.daemon = True
+        watcher.start()
+        watchers.append(watcher)
+
+    # sleep instead of join, so the main thread still receives KeyboardInterrupt.
+    while watchers | any(lambda it: it.is_alive()):
+        time.sleep(1)
+
+
+class _WriteBudget(object):
+    """
+    containers registered by each docker host, warns when the write rate is too low to register all of them
+    within one interval, as they expire after two. the rate is a cap on backend load, so it is never changed.
+    """
+
+    def __init__(self, limiter, interval):
+        self._limiter = limiter
+        self._interval = interval
+        # docker url -> containers registered by its last heartbeat.
+        self._containers = {}
+        self._lock = threading.Lock()
+
+    def counted(self, url, containers):
+        if not self._limiter:
+            return
+
+        with self._lock:
+            self._containers[url] = containers
+            total = sum(self._containers.values())
+
+        # a round must end before the next one may start, which is the shortest jittered interval.
+        required_rate = total / (self._interval * (1 - _INTERVAL_JITTER))
+        if required_rate > self._limiter.rate:
+            _logger.w('write rate %.1f is too low to heartbeat %d containers every %s seconds, '
+                      'registrations may expire, at least %.1f is required.',
+                      self._limiter.rate, total, self._interval, required_rate)
+
+
+def _supervise(backend, endpoint, zone, interval, limiter, budget):
+    _logger.w('start and supervise event loop of docker %s.', endpoint['url'])
+    supervisor.supervise(min_seconds=2, max_seconds=64)(_watch)(backend, endpoint, endpoint.get('zone') or zone,
+                                                                interval, limiter, budget)
+
 
+def _watch(backend, endpoint, zone, interval, limiter, budget):
+    client = docker.AutoVersionClient(base_url=endpoint['url'], tls=_tlsconfig(endpoint))
+    _heartbeat(backend, client, zone, interval, limiter, budget)
 
-def _heartbeat(backend, client):
-    _heartbeat_containers(backend, client)
 
+def _tlsconfig(endpoint):
+    tls_verify = endpoint.get('tls_verify')
+    tls_ca = endpoint.get('tls_ca')
+    tls_cert = endpoint.get('tls_cert')
+    tls_key = endpoint.get('tls_key')
+    if not (tls_verify or tls_ca or tls_cert):
+        return None
+
+    return docker.tls.TLSConfig(client_cert=(tls_cert, tls_key) if tls_cert else None,
+                                ca_cert=tls_ca,
+                                verify=bool(tls_verify))
+
+
+def _heartbeat(backend, client, zone, interval, limiter, budget):
     _schd = sched.scheduler(time.time, time.sleep)
+
+    # start at a random phase, so agents restarted together don't beat together.
+    delay = random.uniform(0, interval * _INTERVAL_JITTER)
     while True:
-        _schd.enter(30, 0, _heartbeat_containers, (backend, client))
+        _schd.enter(delay, 0, _heartbeat_containers, (backend, client, zone, interval, limiter, budget))
         _schd.run()
+        delay = interval * random.uniform(1 - _INTERVAL_JITTER, 1 + _INTERVAL_JITTER)
+
+
+def _topology(client, zone):
+    """
+
+    :return: two-tuple(host, zone) of the docker host.
+    """
+
+    docker_info = client.info()
+    host = docker_info | select_path('.Name')
+    if zone:
+        return host, zone
+
+    docker_labels = (docker_info | select_path('.Labels')) or []
+    docker_labels = docker_labels \
+                    | collect(lambda it: it | split(r'=', maxsplit=1)) \
+                    | select(lambda it: len(it) == 2) \
+                    | collect(lambda it: it | as_tuple) \
+                    | as_dict
+    return host, docker_labels.get(_ZONE_LABEL)
 
 
-def _heartbeat_containers(backend, client):
+def _heartbeat_containers(backend, client, zone, interval, limiter, budget):
+    started = time.time()
+    host, zone = _topology(client, zone)
+
     # list all running containers.
-    containers = client.containers(quiet=True) \
-                 | collect(lambda it: it | select_path('.Id')) \
-                 | collect(lambda it: client.inspect_container(it))
-    for container in containers:
-        _heartbeat_container(backend, container)
+    container_ids = client.containers(quiet=True) \
+                    | collect(lambda it: it | select_path('.Id')) \
+                    | as_list
+    registered = 0
+    for container in container_ids | collect(lambda it: client.inspect_container(it)):
+        if _heartbeat_container(backend, container, host, zone, ttl=interval * 2, limiter=limiter):
+            registered += 1
+    budget.counted(client.base_url, registered)
+
+    elapsed = time.time() - started
+    if elapsed > interval:
+        _logger.w('heartbeat of %d containers takes %.1f seconds, longer than interval %s seconds, '
+                  'registrations may expire before next heartbeat.', registered, elapsed, interval)
+
+
+def _heartbeat_container(backend, container, host=None, zone=None, ttl=60, limiter=None):
+    """
 
+    :param limiter: TokenBucket taken right before the registration is written, None means no limit.
+    :return: True if the container is registered.
+    """
 
-def _heartbeat_container(backend, container):
     try:
 
         container_id = container | select_path('.Id')
@@ -96,8 +217,13 @@ def _heartbeat_container(backend, container):
         _logger.d('heartbeat container[id=%s, domain_name=%s] to backend.', container_id, container_domain)
         name_item = DomainItem(uuid=container_id,
                                host_ipv4=container_ipv4_addr,
-                               host_ipv6=container_ipv6_addr)
-        backend.register(container_domain, name_item, ttl=60)
+                               host_ipv6=container_ipv6_addr,
+                               host=host,
+                               zone=zone)
+        if limiter:
+            limiter.acquire()
+        backend.register(container_domain, name_item, ttl=ttl)
+        return True
 
     except BackendValueError:
         _logger.ex('heartbeat container occurs BackendValueError, just ignore it.')
@@ -0,0 +1,159 @@
+"""
+
+"""
+import collections
+import marshal
+import os
+import signal
+import sys
+import threading
+import time
+
+from dnswall import loggers
+
+__all__ = ['SamplingProfiler', 'install']
+
+_FORMATS = ('collapsed', 'pstats')
+
+_logger = loggers.getlogger('d.p.Profiler')
+
+
+class SamplingProfiler(object):
+    """
+    statistical profiler which samples the stacks of every python thread,
+    including the reactor thread and the deferToThread workers.
+    """
+
+    def __init__(self, seconds=30, interval=0.005, output='/tmp', fmt='collapsed', prefix='dnswall'):
+        """
+
+        :param seconds: how long to sample once started.
+        :param interval: seconds between two samples.
+        :param output: directory where the result is dumped.
+        :param fmt: collapsed or pstats.
+        :param prefix: prefix of the dumped file name.
+        :return:
+        """
+        if fmt not in _FORMATS:
+            raise ValueError('fmt must be one of {}.'.format(_FORMATS))
+
+        self._seconds = seconds
+        self._interval = interval
+        self._output = output
+        self._fmt = fmt
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        """
+        start sampling in background, ignored if a sampling is already running.
+        :return: True if a new sampling has been started.
+        """
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+
+        sampler = threading.Thread(target=self._run, name='dnswall-profiler')
+        sampler.daemon = True
+        sampler.start()
+        return True
+
+    def _run(self):
+        try:
+            _logger.w('start sampling all threads for %d seconds.', self._seconds)
+            samples = self._sample()
+            filename = self._dump(samples)
+            _logger.w('%d samples dumped to %s.', sum(samples.values()), filename)
+        except:
+            _logger.ex('sampling occurs error.')
+        finally:
+            with self._lock:
+                self._running = False
+
+    def _sample(self):
+        samples = collections.Counter()
+        myself = threading.current_thread().ident
+        deadline = time.time() + self._seconds
+
+        while time.time() < deadline:
+            thread_names = dict((it.ident, it.name) for it in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == myself:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+
+                stack.reverse()
+                samples[(thread_names.get(ident, str(ident)), tuple(stack))] += 1
+
+            time.sleep(self._interval)
+
+        return samples
+
+    def _dump(self, samples):
+        filename = os.path.join(self._output, '{}-{}-{}.{}'.format(
+            self._prefix, os.getpid(), time.strftime('%Y%m%d%H%M%S'), self._fmt))
+
+        if self._fmt == 'pstats':
+            with open(filename, 'wb') as f:
+                marshal.dump(self._to_pstats(samples), f)
+        else:
+            with open(filename, 'w') as f:
+                for (thread_name, stack), hits in sorted(samples.items()):
+                    frames = [thread_name] + ['{} ({}:{})'.format(it[2], it[0], it[1]) for it in stack]
+                    f.write('{} {}\n'.format(';'.join(frames), hits))
+
+        return filename
+
+    def _to_pstats(self, samples):
+        """
+        convert samples into the marshaled dict loaded by pstats.Stats,
+        call counts are sample counts and times are estimated by the interval.
+        """
+        stats = {}
+        for (_, stack), hits in samples.items():
+            elapsed = hits * self._interval
+            seen = set()
+            for pos, func in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                nc += hits
+                if func not in seen:
+                    cc += hits
+                    ct += elapsed
+                    seen.add(func)
+                if pos == len(stack) - 1:
+                    tt += elapsed
+                if pos > 0:
+                    caller = stack[pos - 1]
+                    c_nc, c_cc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_nc + hits, c_cc + hits, c_tt, c_ct + elapsed)
+                stats[func] = (cc, nc, tt, ct, callers)
+        return stats
+
+
+def install(profiler, signum=signal.SIGUSR2):
+    """
+    start profiler whenever signum is received by this process.
+
+    :param profiler:
+    :param signum:
+    :return:
+    """
+
+    def _on_signal(*_):
+        if not profiler.start():
+            _logger.w('profiler is already running, just ignore signal.')
+
+    signal.signal(signum, _on_signal)
+    # don't break blocking calls of the process when profiler is triggered.
+    signal.siginterrupt(signum, False)
@@ -0,0 +1,471 @@
+import struct
+import time
+
+from twisted.internet import interfaces
+from twisted.names import dns, server
+from twisted.protocols import policies
+from twisted.python import failure
+from zope.interface import implementer
+
+from dnswall import loggers
+from dnswall.ratelimit import *
+from dnswall.resolver import *
+
+__all__ = ["FastDatagramProtocol", "PipelinedStreamProtocol", "ServerFactory"]
+
+_HEADER = struct.Struct('!HBBHHHH')
+_LENGTH = struct.Struct('!H')
+_OPT = struct.Struct('!xHHIH')
+_MAX_UDP_SIZE = 512
+
+
+def _question_key(data):
+    """
+    parse header and question of a raw query without decoding it into a message.
+
+    :param data: raw datagram.
+    :return: two-tuple(key, end of question), or None if data is not a plain single question query,
+                optionally carrying one edns0 opt record.
+    """
+
+    if len(data) < _HEADER.size + 5:
+        return None
+
+    _, flags, _, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(data)
+    # a standard query with exactly one question and nothing else but an opt record.
+    if flags & 0xf8 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+
+    pos = _HEADER.size
+    while True:
+        if pos >= len(data):
+            return None
+        label_len = ord(data[pos])
+        if label_len == 0:
+            pos += 1
+            break
+        if label_len & 0xc0:
+            return None
+        pos += 1 + label_len
+
+    question_end = pos + 4
+    if arcount:
+        # root name, type, udp payload size, extended rcode and flags, rdata length.
+        if len(data) < question_end + _OPT.size or data[question_end] != '\0':
+            return None
+        opt_type, _, _, rdata_len = _OPT.unpack_from(data, question_end)
+        if opt_type != dns.OPT or question_end + _OPT.size + rdata_len != len(data):
+            return None
+    elif question_end != len(data):
+        return None
+
+    # label lengths are below 64, so lower() only folds the name,
+    # the opt record is kept as is since responses differ by it.
+    return data[_HEADER.size:question_end].lower() + data[question_end:], question_end
+
+
+def _read_name(data, pos):
+    # uncompressed name, as found in questions.
+    labels = []
+    while ord(data[pos]):
+        labels.append(data[pos + 1:pos + 1 + ord(data[pos])])
+        pos += 1 + ord(data[pos])
+    return '.'.join(labels)
+
+
+class FastDatagramProtocol(dns.DNSDatagramProtocol):
+    """
+    udp protocol answering repeated questions from prebuilt responses,
+    only the query id, rd flag and question case are patched into the response,
+    anything else falls through to the controller.
+    queries of rate limited clients are dropped or answered truncated before anything else.
+    """
+
+    def __init__(self, controller, reactor=None, max_ttl=5, max_entries=10000, per_client=False, query_log=None,
+                 limiter=None, max_udp_size=_MAX_UDP_SIZE):
+        """
+
+        :param controller:
+        :param reactor:
+        :param max_ttl: max seconds a response is reused, answers ttl may be overstated by this, 0 to disable.
+        :param max_entries: max responses kept.
+        :param per_client: responses are only reused for the same client, as answers are ordered for it.
+        :param query_log: QueryLog where reused responses are logged.
+        :param limiter: ResponseRateLimiter checked for every query, None means no limit.
+        :param max_udp_size: udp payload size advertised in truncated responses to edns0 clients.
+        :return:
+        """
+        dns.DNSDatagramProtocol.__init__(self, controller, reactor=reactor)
+        self._max_ttl = max_ttl
+        self._max_entries = max_entries
+        self._per_client = per_client
+        self._query_log = query_log
+        self._limiter = limiter
+        self._max_udp_size = max(max_udp_size, _MAX_UDP_SIZE)
+        # question key -> (raw response, expired_at)
+        self._responses = {}
+        # (query id, address) -> question key, queries whose responses will be kept.
+        self._misses = {}
+        self._logger = loggers.getlogger('d.p.FastDatagramProtocol')
+
+    def datagramReceived(self, data, addr):
+        if self._limiter is not None:
+            action = self._limiter.check(addr[0])
+            if action != ALLOW:
+                if action == SLIP:
+                    self._slip(data, addr)
+                return
+
+        if not self._max_ttl:
+            return dns.DNSDatagramProtocol.datagramReceived(self, data, addr)
+
+        question = _question_key(data)
+        if question is None:
+            return dns.DNSDatagramProtocol.datagramReceived(self, data, addr)
+
+        key, question_end = question
+        if self._per_client:
+            key = (addr[0], key)
+        cached = self._responses.get(key)
+        if cached is not None and cached[1] > time.time():
+            response = cached[0]
+            flags = (ord(response[2]) & 0xfe) | (ord(data[2]) & 0x01)
+            self.transport.write(data[:2] + chr(flags) + response[3:_HEADER.size]
+                                 + data[_HEADER.size:question_end] + response[question_end:], addr)
+            if self._query_log is not None:
+                self._log_hit(data, question_end, addr, response)
+            return
+
+        if len(self._misses) >= self._max_entries:
+            self._misses.clear()
+        self._misses[(_HEADER.unpack_from(data)[0], addr)] = key
+        return dns.DNSDatagramProtocol.datagramReceived(self, data, addr)
+
+    def _slip(self, data, addr):
+        """
+        answer with an empty truncated response, client should retry over tcp.
+        """
+
+        question = _question_key(data)
+        if question is None:
+            return
+
+        _, question_end = question
+        # an opt record is all that may follow the question, edns0 clients get one back.
+        opt = _OPT.pack(dns.OPT, self._max_udp_size, 0, 0) if len(data) > question_end else ''
+        # qr and tc set, opcode and rd copied; ra set; one question and nothing else but the opt record.
+        flags = 0x80 | 0x02 | (ord(data[2]) & 0x79)
+        self.transport.write(data[:2] + chr(flags) + chr(0x80) + _LENGTH.pack(1) + '\0' * 4
+                             + _LENGTH.pack(1 if opt else 0) + data[_HEADER.size:question_end] + opt, addr)
+
+    def _log_hit(self, data, question_end, addr, response):
+        qtype = _LENGTH.unpack_from(data, question_end - 4)[0]
+        answers = _HEADER.unpack_from(response)[4]
+        self._query_log.log(addr[0], _read_name(data, _HEADER.size), qtype, 'cache', 0, answers=answers)
+
+    def forget(self, predicate):
+        """
+        drop responses of names matching predicate, usually names whose answers come from elsewhere now.
+
+        :param predicate: callable taking a name.
+        :return: count of responses dropped.
+        """
+
+        keys = [key for key in self._responses
+                if predicate(_read_name(key[1] if self._per_client else key, 0))]
+        for key in keys:
+            del self._responses[key]
+        return len(keys)
+
+    def writeMessage(self, message, address):
+        data = message.toStr()
+        self.transport.write(data, address)
+
+        key = self._misses.pop((message.id, address), None)
+        if key is not None:
+            self._remember(key, message, data)
+
+    def _remember(self, key, message, data):
+        if message.rCode != dns.OK or message.trunc or not message.answers:
+            return
+
+        ttl = min([self._max_ttl] + [it.ttl for it in message.answers + message.authority + message.additional
+                                     if it.type != dns.OPT])
+        if ttl <= 0:
+            return
+
+        now = time.time()
+        if len(self._responses) >= self._max_entries:
+            self._responses = dict((k, v) for k, v in self._responses.items() if v[1] > now)
+            if len(self._responses) >= self._max_entries:
+                self._logger.w('too many responses kept, drop all of them.')
+                self._responses.clear()
+
+        self._responses[key] = (data, now + ttl)
+
+
+@implementer(interfaces.IPushProducer)
+class PipelinedStreamProtocol(dns.DNSProtocol, policies.TimeoutMixin):
+    """
+    tcp protocol answering pipelined queries in completion order,
+    reading pauses while too many queries are in flight or the client does not read responses,
+    idle connections are closed.
+    """
+
+    def __init__(self, controller, reactor=None, idle_timeout=10, max_inflight=16):
+        """
+
+        :param controller:
+        :param reactor:
+        :param idle_timeout: seconds a connection without queries in flight may stay idle.
+        :param max_inflight: max queries of a connection in flight before reading pauses.
+        :return:
+        """
+        dns.DNSProtocol.__init__(self, controller, reactor=reactor)
+        self._idle_timeout = idle_timeout
+        self._max_inflight = max_inflight
+        self._inflight = 0
+        self._paused = set()
+        self._logger = loggers.getlogger('d.p.PipelinedStreamProtocol')
+
+    def connectionMade(self):
+        dns.DNSProtocol.connectionMade(self)
+        self.transport.registerProducer(self, True)
+        self.setTimeout(self._idle_timeout)
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        dns.DNSProtocol.connectionLost(self, reason)
+
+    def timeoutConnection(self):
+        if self._inflight:
+            self.resetTimeout()
+            return
+        policies.TimeoutMixin.timeoutConnection(self)
+
+    def _pause(self, reason):
+        if not self._paused:
+            self.transport.pauseProducing()
+        self._paused.add(reason)
+
+    def _resume(self, reason):
+        self._paused.discard(reason)
+        if not self._paused:
+            self.transport.resumeProducing()
+
+    def pauseProducing(self):
+        # the client does not read responses fast enough.
+        self._pause('write')
+
+    def resumeProducing(self):
+        self._resume('write')
+
+    def stopProducing(self):
+        pass
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        self.buffer += data
+
+        pos = 0
+        while len(self.buffer) - pos >= _LENGTH.size:
+            length = _LENGTH.unpack_from(self.buffer, pos)[0]
+            if len(self.buffer) - pos - _LENGTH.size < length:
+                break
+
+            start = pos + _LENGTH.size
+            pos = start + length
+            message = dns.Message()
+            try:
+                message.fromStr(self.buffer[start:pos])
+            except:
+                self._logger.w('malformed message from %s, close connection.', self.transport.getPeer())
+                self.buffer = ''
+                self.transport.loseConnection()
+                return
+
+            self._inflight += 1
+            if self._inflight >= self._max_inflight:
+                self._pause('inflight')
+            self.controller.messageReceived(message, self)
+
+        self.buffer = self.buffer[pos:]
+
+    def writeMessage(self, message):
+        dns.DNSProtocol.writeMessage(self, message)
+        self.resetTimeout()
+
+        self._inflight -= 1
+        if self._inflight < self._max_inflight:
+            self._resume('inflight')
+
+    def writeMessages(self, messages):
+        """
+        answer one query by several messages, like zone transfers.
+        """
+
+        for message in messages[:-1]:
+            dns.DNSProtocol.writeMessage(self, message)
+        self.writeMessage(messages[-1])
+
+
+class ServerFactory(server.DNSServerFactory):
+    """
+    dns server factory limiting tcp connections, in total and per peer,
+    passing the client address of queries to resolvers,
+    fitting udp responses into the payload size negotiated by edns0,
+    and answering soa and zone transfers of pattern zones.
+    """
+
+    protocol = PipelinedStreamProtocol
+
+    def __init__(self, authorities=None, caches=None, clients=None, verbose=0,
+                 max_connections=512, max_peer_connections=32, idle_timeout=10, max_inflight=16,
+                 max_udp_size=1232, query_log=None, transfer=None):
+        """
+
+        :param max_connections: max tcp connections.
+        :param max_peer_connections: max tcp connections of one peer address.
+        :param idle_timeout: seconds an idle tcp connection is kept.
+        :param max_inflight: max queries of a tcp connection in flight.
+        :param max_udp_size: max udp payload size advertised to and accepted from edns0 clients.
+        :param query_log: QueryLog where answered queries are logged.
+        :param transfer: ZoneTransfer answering soa, axfr and ixfr of zones, None to resolve them as usual.
+        :return:
+        """
+        server.DNSServerFactory.__init__(self, authorities=authorities, caches=caches,
+                                         clients=clients, verbose=verbose)
+        self.resolver = ResolverChain(self.resolver.resolvers)
+        self._max_connections = max_connections
+        self._max_peer_connections = max_peer_connections
+        self._idle_timeout = idle_timeout
+        self._max_inflight = max_inflight
+        self._max_udp_size = max(max_udp_size, _MAX_UDP_SIZE)
+        self._query_log = query_log
+        self._transfer = transfer
+        self._logger = loggers.getlogger('d.p.ServerFactory')
+
+    def buildProtocol(self, addr):
+        if len(self.connections) >= self._max_connections:
+            self._logger.w('too many tcp connections, refuse %s.', addr)
+            return None
+
+        peer_connections = sum(1 for it in self.connections if it.transport.getPeer().host == addr.host)
+        if peer_connections >= self._max_peer_connections:
+            self._logger.w('too many tcp connections from %s, refuse it.', addr.host)
+            return None
+
+        p = self.protocol(self, idle_timeout=self._idle_timeout, max_inflight=self._max_inflight)
+        p.factory = self
+        return p
+
+    def handleQuery(self, message, protocol, address):
+        query = message.queries[0]
+        client = address[0] if address else protocol.transport.getPeer().host
+        if self._transfer is not None and self._transfer.handles(query):
+            return self._handle_transfer(message, protocol, address, client)
+
+        context, started = {}, time.time()
+        d = self.resolver.query(query, client=client, context=context)
+        if self._query_log is not None:
+            d.addBoth(self._log_query, query, client, context, started)
+        return d.addCallback(
+            self._gotResolverResponse, protocol, message, address, context
+        ).addErrback(
+            self.gotResolverError, protocol, message, address
+        )
+
+    def _gotResolverResponse(self, response, protocol, message, address, context):
+        # only address records built from backend items may be dropped to fit,
+        # any other answer is sent whole or truncated, never shortened.
+        message.trimmable = context.get('source') == 'backend' and message.queries[0].type in (dns.A, dns.AAAA)
+        return self.gotResolverResponse(response, protocol, message, address)
+
+    def _handle_transfer(self, message, protocol, address, client):
+        query = message.queries[0]
+        serial = None
+        if query.type == dns.IXFR:
+            soas = [it for it in message.authority if it.type == dns.SOA]
+            serial = soas[0].payload.serial if soas else None
+
+        rcode, batches = self._transfer.answer(query, client, serial=serial, stream=address is None)
+        responses = [self._responseFromMessage(message, rCode=rcode, answers=it) for it in batches or [[]]]
+        for response in responses:
+            response.auth = 1
+
+        if len(responses) == 1:
+            self.sendReply(protocol, responses[0], address)
+            return
+
+        for response in responses:
+            response.maxSize = 0
+        protocol.writeMessages(responses)
+
+    def _responseFromMessage(self, message, rCode=dns.OK, answers=None, authority=None, additional=None):
+        response = server.DNSServerFactory._responseFromMessage(self, message, rCode=rCode, answers=answers,
+                                                                authority=authority, additional=additional)
+
+        # maxSize of response is the udp payload size of the client, applied by sendReply.
+        response.maxSize = _MAX_UDP_SIZE
+        response.trimmable = getattr(message, 'trimmable', False)
+        opts = [it for it in message.additional if it.type == dns.OPT]
+        if len(opts) == 1:
+            requested = dns._OPTHeader.fromRRHeader(opts[0]).udpPayloadSize
+            response.maxSize = min(max(requested, _MAX_UDP_SIZE), self._max_udp_size)
+            response.additional = response.additional + [dns._OPTHeader(udpPayloadSize=self._max_udp_size)]
+        return response
+
+    def sendReply(self, protocol, message, address):
+        if address is not None:
+            self._fit(message, message.maxSize)
+        # never let the message cut itself at arbitrary bytes.
+        message.maxSize = 0
+        server.DNSServerFactory.sendReply(self, protocol, message, address)
+
+    def _fit(self, message, size):
+        """
+        make message fit in size. backend address answers drop whole records: additional records but opt first,
+        then authority records, then answers from the end, so a shortened answer set still resolves
+        in one exchange, truncated flag is only set if no answer is left.
+        any other message is sent truncated without records, the client retries over tcp.
+        """
+
+        message.maxSize = 0
+        if len(message.toStr()) <= size:
+            return
+
+        answer_count = len(message.answers)
+        message.additional = [it for it in message.additional if it.type == dns.OPT]
+        message.authority = []
+        if not getattr(message, 'trimmable', False):
+            message.answers = []
+            message.trunc = 1
+            return
+
+        answers = message.answers
+        lo, hi = 0, answer_count
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            message.answers = answers[:mid]
+            if len(message.toStr()) <= size:
+                lo = mid
+            else:
+                hi = mid - 1
+        message.answers = answers[:lo]
+
+        self._logger.d('response of %s trimmed from %d to %d answers to fit %d bytes.',
+                       message.queries[0].name if message.queries else None,
+                       answer_count, len(message.answers), size)
+        if answer_count and not message.answers:
+            message.trunc = 1
+
+    def _log_query(self, result, query, client, context, started):
+        if isinstance(result, failure.Failure):
+            rcode = dns.ENAME if result.check(dns.DomainError, dns.AuthoritativeDomainError) else dns.ESERVER
+            answers = 0
+        else:
+            rcode, answers = dns.OK, len(result[0])
+
+        self._query_log.log(client, query.name.name, query.type, context.get('source'),
+                            time.time() - started, rcode=rcode, answers=answers)
+        return result
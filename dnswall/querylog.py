@@ -0,0 +1,105 @@
+"""
+
+"""
+import collections
+import json
+import sys
+import threading
+import time
+
+from twisted.names import dns
+
+from dnswall import loggers
+
+__all__ = ['QueryLog']
+
+_logger = loggers.getlogger('d.q.QueryLog')
+
+
+class QueryLog(object):
+    """
+    structured query log written as json lines by a background thread,
+    logging never blocks the caller: records are dropped when the queue is full.
+    """
+
+    def __init__(self, output, max_queue=10000, max_batch=500, interval=1):
+        """
+
+        :param output: file path appended to, or - for stderr.
+        :param max_queue: max records waiting to be written.
+        :param max_batch: max records written at once.
+        :param interval: seconds the writer sleeps when no records are waiting.
+        :return:
+        """
+        self._output = output
+        self._max_queue = max_queue
+        self._max_batch = max_batch
+        self._interval = interval
+        # deque append and popleft are atomic, the reactor thread takes no lock.
+        self._records = collections.deque()
+        self._dropped = 0
+
+        writer = threading.Thread(target=self._run, name='dnswall-querylog')
+        writer.daemon = True
+        writer.start()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def log(self, client, name, qtype, source, latency, rcode=dns.OK, answers=0):
+        """
+
+        :param client: client address.
+        :param name: query name.
+        :param qtype: query type.
+        :param source: backend, upstream or cache, where the answer comes from.
+        :param latency: seconds taken to answer.
+        :param rcode: response code.
+        :param answers: count of answer records.
+        :return:
+        """
+        if len(self._records) >= self._max_queue:
+            self._dropped += 1
+            return
+        self._records.append((time.time(), client, name, qtype, source, latency, rcode, answers))
+
+    def _take(self):
+        batch = []
+        try:
+            while len(batch) < self._max_batch:
+                batch.append(self._records.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _format(self, record):
+        ts, client, name, qtype, source, latency, rcode, answers = record
+        return json.dumps({'ts': round(ts, 3),
+                           'client': client,
+                           'name': name,
+                           'qtype': dns.QUERY_TYPES.get(qtype, dns.EXT_QUERIES.get(qtype, str(qtype))),
+                           'source': source,
+                           'latency_ms': round(latency * 1000, 3),
+                           'rcode': rcode,
+                           'answers': answers}, sort_keys=True)
+
+    def _run(self):
+        stream = sys.stderr if self._output == '-' else open(self._output, 'a')
+        reported_dropped = 0
+        while True:
+            batch = self._take()
+            if not batch:
+                time.sleep(self._interval)
+                continue
+
+            try:
+                stream.write(''.join('{}\n'.format(self._format(it)) for it in batch))
+                stream.flush()
+            except:
+                _logger.ex('write query log %s occurs error, drop %d records.', self._output, len(batch))
+
+            dropped = self._dropped
+            if dropped != reported_dropped:
+                _logger.w('%d query log records dropped as queue is full.', dropped - reported_dropped)
+                reported_dropped = dropped
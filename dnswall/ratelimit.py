@@ -0,0 +1,165 @@
+"""
+
+"""
+import collections
+import socket
+import struct
+import threading
+import time
+
+from dnswall import loggers
+
+__all__ = ['TokenBucket', 'ResponseRateLimiter', 'ALLOW', 'DROP', 'SLIP']
+
+ALLOW = 'allow'
+DROP = 'drop'
+SLIP = 'slip'
+
+_IPV4 = struct.Struct('!I')
+
+_logger = loggers.getlogger('d.l.ResponseRateLimiter')
+
+
+class TokenBucket(object):
+    """
+    token bucket refilled at rate tokens per second, holding at most burst tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+
+        :param rate: tokens added per second.
+        :param burst: max tokens kept, default is rate.
+        :return:
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive.')
+
+        self._rate = float(rate)
+        self._burst = float(burst or rate)
+        self._tokens = self._burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _refill(self, now):
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def consume(self, tokens=1):
+        """
+        take tokens without waiting.
+
+        :param tokens:
+        :return: True if tokens are taken.
+        """
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """
+        take tokens, wait until enough tokens are refilled.
+
+        :param tokens:
+        :return: seconds waited.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            # take tokens in advance, so concurrent callers queue up behind each other.
+            self._tokens -= tokens
+            wait_seconds = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait_seconds:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+
+class ResponseRateLimiter(object):
+    """
+    token buckets of client prefixes limiting responses per second,
+    limited queries are dropped, but every slip-th of them is answered truncated,
+    so real clients sharing a limited prefix still get their answer over tcp.
+    checked on the reactor thread for every query, so it takes no lock.
+    """
+
+    def __init__(self, rate, burst=None, slip=2, ipv4_prefix=24, ipv6_prefix=56, max_clients=100000):
+        """
+
+        :param rate: responses per second of a client prefix.
+        :param burst: max responses of a client prefix at once, default is rate.
+        :param slip: every slip-th limited query is answered truncated, 0 drops them all.
+        :param ipv4_prefix: prefix length ipv4 clients are grouped by.
+        :param ipv6_prefix: prefix length ipv6 clients are grouped by, rounded down to whole bytes.
+        :param max_clients: max client prefixes tracked.
+        :return:
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive.')
+
+        self._rate = float(rate)
+        self._burst = float(burst or rate)
+        self._slip = slip
+        self._ipv4_shift = 32 - ipv4_prefix
+        self._ipv6_bytes = ipv6_prefix // 8
+        self._max_clients = max_clients
+        # client prefix -> [tokens, updated, limited responses in a row], in least recently checked order.
+        self._clients = collections.OrderedDict()
+        self.dropped = 0
+        self.slipped = 0
+
+    def _prefix(self, address):
+        try:
+            if ':' in address:
+                return socket.inet_pton(socket.AF_INET6, address)[:self._ipv6_bytes]
+            return _IPV4.unpack(socket.inet_aton(address))[0] >> self._ipv4_shift
+        except socket.error:
+            return address
+
+    def check(self, address):
+        """
+
+        :param address: client address.
+        :return: ALLOW, DROP or SLIP.
+        """
+
+        now = time.time()
+        key = self._prefix(address)
+        state = self._clients.pop(key, None)
+        if state is None:
+            if len(self._clients) >= self._max_clients:
+                # the least recently checked client goes first, its bucket is most likely full again.
+                self._clients.popitem(last=False)
+            self._clients[key] = [self._burst - 1, now, 0]
+            return ALLOW
+
+        self._clients[key] = state
+
+        tokens = state[0] + (now - state[1]) * self._rate
+        if tokens > self._burst:
+            tokens = self._burst
+        state[1] = now
+
+        if tokens >= 1:
+            state[0] = tokens - 1
+            state[2] = 0
+            return ALLOW
+
+        state[0] = tokens
+        state[2] += 1
+        if state[2] == 1:
+            _logger.w('responses to %s and its neighbours are rate limited.', address)
+
+        if self._slip and state[2] % self._slip == 0:
+            self.slipped += 1
+            return SLIP
+
+        self.dropped += 1
+        return DROP
@@ -0,0 +1,144 @@
+"""
+
+"""
+import json
+import signal
+
+from twisted.internet import reactor
+
+from dnswall import loggers
+from dnswall.commons import *
+
+__all__ = ['Reloader', 'load_config']
+
+_logger = loggers.getlogger('d.r.Reloader')
+
+
+def _to_list(value):
+    if not isinstance(value, (list, tuple)):
+        value = value | split(r'[,;\s]')
+    return value | collect(lambda it: it | strip) | select(lambda it: it) | as_list
+
+
+def _to_server(value):
+    host, port = value | split(':')
+    return host, port | as_int
+
+
+def load_config(path):
+    """
+    patterns and servers may be lists or strings separated like their options, either may be absent.
+
+    :param path: json file like {"patterns": ["dnswall.local"], "servers": ["8.8.8.8:53"]}.
+    :return: dict with patterns as list of str and servers as list of two-tuple(host, port).
+    """
+
+    with open(path) as f:
+        config = json.load(f)
+
+    loaded = {}
+    if config.get('patterns') is not None:
+        loaded['patterns'] = _to_list(config['patterns'])
+    if config.get('servers') is not None:
+        loaded['servers'] = _to_list(config['servers']) | collect(_to_server) | as_list
+    return loaded
+
+
+def _served(patterns, name):
+    return not patterns or patterns | any(lambda it: name.endswith(it | lowcase))
+
+
+class Reloader(object):
+    """
+    applies patterns and upstream servers of a config file to a running daemon,
+    only state of names moving between backend and upstream is dropped, anything else stays warm.
+    """
+
+    def __init__(self, path, backend, backend_resolver, upstream, forward_resolver=None, transfer=None,
+                 protocol=None, rebuilders=None):
+        """
+
+        :param path: config file read by load_config().
+        :param backend: Backend whose patterns are reloaded.
+        :param backend_resolver: BackendResolver whose last known records are pruned.
+        :param upstream: ProxyResovler whose servers are reloaded.
+        :param forward_resolver: ForwardResolver whose cached answers are pruned.
+        :param transfer: ZoneTransfer whose zones follow patterns.
+        :param protocol: FastDatagramProtocol whose responses are pruned.
+        :param rebuilders: callables run after patterns change, usually rebuilding indexes read from backend.
+        :return:
+        """
+        self._path = path
+        self._backend = backend
+        self._backend_resolver = backend_resolver
+        self._upstream = upstream
+        self._forward_resolver = forward_resolver
+        self._transfer = transfer
+        self._protocol = protocol
+        self._rebuilders = rebuilders or []
+
+    def install(self, signum=signal.SIGHUP):
+        """
+        reload whenever signum is received by this process.
+        """
+
+        def _on_signal(*_):
+            reactor.callFromThread(self.reload)
+
+        signal.signal(signum, _on_signal)
+        # don't break blocking calls of the process when reload is triggered.
+        signal.siginterrupt(signum, False)
+
+    def reload(self):
+        """
+
+        :return: True if patterns or servers changed.
+        """
+
+        try:
+            config = load_config(self._path)
+        except Exception:
+            _logger.ex('load config %s occurs error, keep current config.', self._path)
+            return False
+
+        changed = False
+        patterns = config.get('patterns')
+        if patterns is not None and (patterns | as_set) != (self._backend.patterns | as_set):
+            if patterns:
+                self._reload_patterns(patterns)
+                changed = True
+            else:
+                _logger.w('patterns of config %s must not be empty, keep current patterns.', self._path)
+
+        servers = config.get('servers')
+        if servers is not None and servers != (self._upstream.servers | as_list):
+            if servers:
+                _logger.w('upstream servers change from %s to %s.', self._upstream.servers, servers)
+                self._upstream.servers = servers
+                changed = True
+            else:
+                _logger.w('servers of config %s must not be empty, keep current servers.', self._path)
+
+        if not changed:
+            _logger.i('config %s reloaded, nothing changed.', self._path)
+        return changed
+
+    def _reload_patterns(self, patterns):
+        old_patterns = self._backend.patterns
+        self._backend.patterns = patterns
+
+        def _moved(name):
+            name = name | lowcase
+            return _served(old_patterns, name) != _served(patterns, name)
+
+        stale = self._backend_resolver.forget(_moved)
+        forwarded = self._forward_resolver.forget(_moved) if self._forward_resolver is not None else 0
+        responses = self._protocol.forget(_moved) if self._protocol is not None else 0
+        if self._transfer is not None:
+            self._transfer.zones = patterns
+
+        _logger.w('patterns change from %s to %s, %d last known names, %d forwarded answers '
+                  'and %d responses dropped.', old_patterns, patterns, stale, forwarded, responses)
+
+        for rebuild in self._rebuilders:
+            rebuild()
@@ -1,40 +1,240 @@
-from twisted.internet import defer, threads
-from twisted.names import dns
+import collections
+import heapq
+import random
+import socket
+import time
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.names import dns, resolve
 from twisted.names.client import Resolver as ProxyResovler
+from twisted.python import failure, threadpool
 
 from dnswall import loggers
+from dnswall.backend import *
 from dnswall.commons import *
+from dnswall.errors import *
 
-__all__ = ["BackendResolver", "ProxyResovler"]
+__all__ = ["BackendResolver", "ForwardResolver", "ProxyResovler", "ResolverChain",
+           "OVERLOAD_FORWARD", "OVERLOAD_SERVFAIL", "ORDER_RANDOM", "ORDER_TOPOLOGY"]
 
 EMPTY_ANSWERS = [], [], []
 
+OVERLOAD_FORWARD = 'forward'
+OVERLOAD_SERVFAIL = 'servfail'
+
+ORDER_RANDOM = 'random'
+ORDER_TOPOLOGY = 'topology'
+
+# max names remembered as answered by backend, the least recently answered one is forgotten first
+# and may be served from a young snapshot again until backend answers it.
+_MAX_ANSWERED = 100000
+
+
+def _prefix_len(client, item):
+    """
+    count of leading bits shared by client address and the item address of the same family.
+    """
+
+    if not client:
+        return 0
+
+    family = socket.AF_INET6 if ':' in client else socket.AF_INET
+    address = item.host_ipv6 if family == socket.AF_INET6 else item.host_ipv4
+    if not address:
+        return 0
+
+    try:
+        client_bytes = socket.inet_pton(family, client)
+        address_bytes = socket.inet_pton(family, address)
+    except socket.error:
+        return 0
+
+    for pos, (x, y) in enumerate(zip(client_bytes, address_bytes)):
+        diff = ord(x) ^ ord(y)
+        if diff:
+            return pos * 8 + 8 - diff.bit_length()
+    return len(client_bytes) * 8
+
+
+class ResolverChain(resolve.ResolverChain):
+    """
+    resolver chain passing the client address to resolvers accepting it.
+    """
+
+    def query(self, query, timeout=None, client=None, context=None):
+        """
+
+        :param query:
+        :param timeout:
+        :param client: address of the client.
+        :param context: dict where source of the answer, backend, upstream or cache, is put into.
+        :return:
+        """
+
+        if not self.resolvers:
+            return defer.fail(dns.DomainError())
+
+        d = self._query(self.resolvers[0], query, timeout, client, context)
+        for r in self.resolvers[1:]:
+            d = d.addErrback(resolve.FailureHandler(
+                lambda q, t, r=r: self._query(r, q, t, client, context), query, timeout))
+        return d
+
+    def _query(self, resolver, query, timeout, client, context):
+        if isinstance(resolver, BackendResolver):
+            if context is not None:
+                context['source'] = 'backend'
+            return resolver.query(query, timeout, client=client)
+
+        if context is not None:
+            context['source'] = 'upstream'
+        if isinstance(resolver, ForwardResolver):
+            return resolver.query(query, timeout, context=context)
+        return resolver.query(query, timeout)
+
 
 class BackendResolver(object):
     """
 
     """
 
-    def __init__(self, backend=None):
+    def __init__(self, backend=None, max_threads=10, max_queue=100, timeout=2, overload=OVERLOAD_FORWARD,
+                 min_ttl=1, max_ttl=30, stale_ttl=5, stale_age=3600, stale_entries=10000, retry=5,
+                 snapshot=None, snapshot_age=0, order=ORDER_RANDOM, zone=None, host=None, max_answers=0,
+                 reverse=None):
         """
 
         :param backend:
+        :param max_threads: max threads used to lookup backend.
+        :param max_queue: max lookups waiting for a thread, new lookups are shed when full.
+        :param timeout: default seconds a lookup may take when query has no timeout.
+        :param overload: forward or servfail, how shed or expired lookups are answered.
+        :param min_ttl: min ttl of answers.
+        :param max_ttl: max ttl of answers, also used for records which never expire.
+        :param stale_ttl: ttl of answers served from last known records.
+        :param stale_age: max seconds last known records of a name are served after backend fails.
+        :param stale_entries: max names whose last known records are kept.
+        :param retry: seconds stale records are served without waiting for backend after it fails.
+        :param snapshot: Snapshot consulted for names without last known records.
+        :param snapshot_age: max age in seconds of a snapshot answered before backend,
+                    until backend answers a name once, 0 to consult it only after backend fails.
+        :param order: random or topology, how answers are ordered.
+        :param zone: zone of this daemon, items in it go first when ordering by topology.
+        :param host: docker host of this daemon, items on it go next when ordering by topology.
+        :param max_answers: max records of an answer, 0 means no limit.
+        :param reverse: ReverseIndex answering ptr queries, None to forward them.
         :return:
         """
         self._backend = backend
+        self._timeout = timeout
+        self._overload = overload
+        self._min_ttl = min_ttl
+        self._max_ttl = max_ttl
+        self._stale_ttl = stale_ttl
+        self._stale_age = stale_age
+        self._stale_entries = stale_entries
+        self._retry = retry
+        # name -> (DomainDetail, fetched_at), in least recently fetched order.
+        self._last_known = collections.OrderedDict()
+        self._unhealthy_until = 0
+        self._snapshot = snapshot
+        self._snapshot_age = snapshot_age
+        # names answered by backend -> None, in least recently answered order.
+        self._answered = collections.OrderedDict()
+        self._order = order
+        self._zone = zone
+        self._host = host
+        self._max_answers = max_answers
+        self._reverse = reverse
+        self._max_pending = max_threads + max_queue
+        self._pending = 0
+        # name -> deferreds waiting for the in-flight lookup of name.
+        self._inflight = {}
         self._logger = loggers.getlogger('d.r.BackendResolver')
 
-    def query(self, query, timeout=None):
+        self._threadpool = threadpool.ThreadPool(minthreads=1, maxthreads=max_threads, name='dnswall-lookup')
+        reactor.callWhenRunning(self._threadpool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._threadpool.stop)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @snapshot.setter
+    def snapshot(self, snapshot):
+        self._snapshot = snapshot
+
+    def forget(self, predicate):
+        """
+        drop last known records of names matching predicate, usually names backend no longer serves.
+
+        :param predicate: callable taking a name.
+        :return: count of names dropped.
+        """
+
+        names = iter(self._last_known) | select(predicate) | as_list
+        for name in names:
+            del self._last_known[name]
+        return len(names)
+
+    def _overloaded(self, reason):
+        if self._overload == OVERLOAD_SERVFAIL:
+            return defer.fail(BackendOverloadError(reason))
+        return defer.fail(dns.DomainError(reason))
+
+    def _deadline(self, timeout):
+        if not timeout:
+            return self._timeout
+        return sum(timeout) if isinstance(timeout, (list, tuple)) else timeout
+
+    def _with_deadline(self, lookup, seconds, qname, qtype, client):
+        """
+        answer with last known records or the overload policy if lookup is not done within seconds,
+        a late result of lookup is dropped.
+        """
+
+        result = defer.Deferred()
+
+        def _expire():
+            self._logger.w('lookup name %s exceeds %s seconds.', qname, seconds)
+            stale_detail = self._stale(qname)
+            if stale_detail:
+                result.callback(self._to_answers((stale_detail, True), qname, qtype, client))
+            else:
+                self._overloaded('lookup timeout').chainDeferred(result)
+
+        def _done(value):
+            if not timer.active():
+                return
+            timer.cancel()
+            if isinstance(value, failure.Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+
+        timer = reactor.callLater(seconds, _expire)
+        lookup.addBoth(_done)
+        return result
+
+    def _release(self, value):
+        self._pending -= 1
+        return value
+
+    def query(self, query, timeout=None, client=None):
         """
 
         :param query:
         :param timeout:
+        :param client: address of the client, answers are ordered for it.
         :return:
         """
 
         qname = query.name.name
         qtype = query.type
 
+        if qtype == dns.PTR and self._reverse is not None:
+            return self._query_reverse(qname)
+
         if not self._backend.supports(qname):
             self._logger.d('unsupported query name [%s], just forward it.', qname)
             return defer.fail(dns.DomainError())
@@ -43,49 +243,348 @@ class BackendResolver(object):
             self._logger.d('unsupported query type [%d], just forward it.', qtype)
             return defer.fail(dns.DomainError())
 
-        def _lookup_backend(backend, logger, qn, qt):
-            """
+        deadline = self._deadline(timeout)
+        stale_detail = self._stale(qname)
+        if stale_detail and time.time() < self._unhealthy_until:
+            self._logger.d('backend unhealthy, serve stale name [%s] and refresh it.', qname)
+            self._refresh(qname, deadline)
+            return defer.succeed(self._to_answers((stale_detail, True), qname, qtype, client))
 
-            :param backend:
-            :param qn:
-            :param qt:
-            :return: three-tuple(answers, authorities, additional)
-                        of lists of twisted.names.dns.RRHeader instances.
-            """
+        snapshot_detail = self._fresh(qname)
+        if snapshot_detail:
+            self._logger.d('serve name [%s] from snapshot and catch up from backend.', qname)
+            self._refresh(qname, deadline)
+            return defer.succeed(self._to_answers((snapshot_detail, True), qname, qtype, client))
 
-            import random
-            try:
+        waiters = self._refresh(qname, deadline)
+        if waiters is None:
+            self._logger.w('too many pending lookups, shed query name [%s].', qname)
+            return self._overloaded('too many pending lookups')
 
-                name_detail = backend.lookup(qn)
-            except:
-                logger.ex('lookup name %s occurs error, just ignore and forward it.', qn)
-                return EMPTY_ANSWERS
+        waiter = defer.Deferred()
+        waiter.addCallback(self._to_answers, qname, qtype, client)
+        waiters.append(waiter)
+        return self._with_deadline(waiter, deadline, qname, qtype, client)
 
-            if not name_detail.items:
-                return EMPTY_ANSWERS
+    def _query_reverse(self, qname):
+        names = self._reverse.lookup(qname)
+        if names is None:
+            self._logger.d('unmanaged reverse name [%s], just forward it.', qname)
+            return defer.fail(dns.DomainError())
 
-            if qt == dns.A:
-                answers = name_detail.items \
-                          | select(lambda it: it.host_ipv4) \
-                          | collect(lambda it: it.host_ipv4) \
-                          | as_set \
-                          | collect(lambda it: dns.Record_A(address=it)) \
-                          | collect(lambda record_a: dns.RRHeader(name=qn, payload=record_a)) \
-                          | as_list
+        if not names:
+            return defer.fail(dns.AuthoritativeDomainError(qname))
 
-                random.shuffle(answers)
-                return answers, [], []
+        if self._max_answers:
+            names = names[:self._max_answers]
 
-            else:
-                answers = name_detail.items \
-                          | select(lambda it: it.host_ipv6) \
-                          | collect(lambda it: it.host_ipv6) \
-                          | as_set \
-                          | collect(lambda it: dns.Record_AAAA(address=it)) \
-                          | collect(lambda record_aaaa: dns.RRHeader(name=qn, payload=record_aaaa)) \
-                          | as_list
-
-                random.shuffle(answers)
-                return answers, [], []
-
-        return threads.deferToThread(_lookup_backend, self._backend, self._logger, qname, qtype)
+        answers = names \
+                  | collect(lambda it: dns.RRHeader(name=qname, type=dns.PTR, ttl=self._max_ttl,
+                                                    payload=dns.Record_PTR(name=it))) \
+                  | as_list
+        return defer.succeed((answers, [], []))
+
+    def _refresh(self, qname, deadline):
+        """
+        start a lookup of qname unless one is in flight.
+
+        :return: waiters of the in-flight lookup, or None if lookup is shed.
+        """
+
+        waiters = self._inflight.get(qname)
+        if waiters is not None:
+            self._logger.d('join in-flight lookup of name [%s].', qname)
+            return waiters
+
+        if self._pending >= self._max_pending:
+            return None
+
+        waiters = self._inflight[qname] = []
+        self._lookup(qname, deadline).addBoth(self._land, qname)
+        return waiters
+
+    def _lookup(self, qname, deadline):
+        """
+        lookup qname from backend, concurrent queries of qname share this lookup.
+
+        :param qname:
+        :param deadline:
+        :return: a deferred fires with two-tuple(DomainDetail, stale).
+        """
+
+        self._pending += 1
+        if self._backend.asynchronous:
+            lookup = self._backend.lookup(qname)
+        else:
+            lookup = threads.deferToThreadPool(reactor, self._threadpool, self._lookup_backend,
+                                               qname, time.time() + deadline)
+
+        lookup.addBoth(self._release)
+        lookup.addCallbacks(self._lookup_succeeded, self._lookup_failed,
+                            callbackArgs=(qname,), errbackArgs=(qname,))
+        return lookup
+
+    def _land(self, result, qname):
+        for waiter in self._inflight.pop(qname):
+            waiter.callback(result)
+
+    def _lookup_backend(self, qname, expired_at):
+        """
+
+        :param qname:
+        :param expired_at: skip the lookup if it is picked up after this time.
+        :return: a releative DomainDetail.
+        """
+
+        if time.time() > expired_at:
+            raise defer.TimeoutError('lookup of name {} expired in queue.'.format(qname))
+        return self._backend.lookup(qname)
+
+    def _lookup_succeeded(self, name_detail, qname):
+        self._unhealthy_until = 0
+        self._answered.pop(qname, None)
+        self._answered[qname] = None
+        if len(self._answered) > _MAX_ANSWERED:
+            self._answered.popitem(last=False)
+        self._last_known.pop(qname, None)
+        if name_detail.items:
+            self._last_known[qname] = (name_detail, time.time())
+            if len(self._last_known) > self._stale_entries:
+                self._last_known.popitem(last=False)
+        return name_detail, False
+
+    def _lookup_failed(self, failure, qname):
+        self._unhealthy_until = time.time() + self._retry
+
+        stale_detail = self._stale(qname)
+        if stale_detail:
+            self._logger.w('lookup name %s occurs error, serve last known records.', qname)
+            return stale_detail, True
+
+        self._logger.e('lookup name %s occurs error, just ignore and forward it.', qname,
+                       exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        return DomainDetail(qname), False
+
+    def _stale(self, qname):
+        last_known = self._last_known.get(qname)
+        if last_known:
+            return last_known[0] if time.time() - last_known[1] <= self._stale_age else None
+
+        snapshot = self._snapshot
+        if not snapshot or time.time() - snapshot.created > self._stale_age:
+            return None
+        return snapshot.lookup(qname)
+
+    def _fresh(self, qname):
+        """
+        snapshot records of qname answered before backend, only while the snapshot is young
+        and backend has never answered qname.
+        """
+
+        snapshot = self._snapshot
+        if not snapshot or not self._snapshot_age or qname in self._answered:
+            return None
+        if time.time() - snapshot.created > self._snapshot_age:
+            return None
+        return snapshot.lookup(qname)
+
+    def _to_answers(self, result, qname, qtype, client=None):
+        """
+
+        :param result: two-tuple(DomainDetail, stale).
+        :param qname:
+        :param qtype:
+        :param client: address of the client.
+        :return: three-tuple(answers, authorities, additional)
+                    of lists of twisted.names.dns.RRHeader instances.
+        """
+
+        name_detail, stale = result
+        if not name_detail.items:
+            return EMPTY_ANSWERS
+
+        if qtype == dns.A:
+            to_address, record_cls = lambda it: it.host_ipv4, dns.Record_A
+        else:
+            to_address, record_cls = lambda it: it.host_ipv6, dns.Record_AAAA
+
+        items = name_detail.items | select(to_address) | as_list
+        ttl = self._to_ttl(items, stale)
+        addresses = collections.OrderedDict.fromkeys(self._ordered(items, client) | collect(to_address)).keys()
+        if self._max_answers:
+            addresses = addresses[:self._max_answers]
+
+        answers = addresses \
+                  | collect(lambda it: dns.RRHeader(name=qname, type=qtype, ttl=ttl, payload=record_cls(address=it))) \
+                  | as_list
+        return answers, [], []
+
+    def _ordered(self, items, client):
+        """
+        items in random order, when ordering by topology nearest items go first:
+        those in the zone of this daemon, then on its host, then sharing the longest prefix with client.
+        """
+
+        items = items | as_list
+        random.shuffle(items)
+        if self._order != ORDER_TOPOLOGY:
+            return items
+
+        # sort is stable, so items equally near stay shuffled.
+        return items | sort(key=lambda it: (self._zone is not None and it.zone != self._zone,
+                                            self._host is not None and it.host != self._host,
+                                            -_prefix_len(client, it)))
+
+    def _to_ttl(self, items, stale):
+        """
+        ttl of answers, never longer than the earliest expiring registration of items.
+        """
+
+        if stale:
+            return [self._stale_ttl, self._max_ttl] | min
+
+        ttls = items | select(lambda it: it.ttl is not None) | collect(lambda it: it.ttl) | as_list
+        ttl = ttls | min if ttls else self._max_ttl
+        return [self._min_ttl, [ttl, self._max_ttl] | min] | max
+
+
+class ForwardResolver(object):
+    """
+    forwards queries to upstream resolvers in order and caches answers for their ttl,
+    entries hit often enough within their ttl are refreshed in background shortly before they expire,
+    so hot names are always answered from cache.
+    """
+
+    def __init__(self, resolvers, max_entries=10000, max_ttl=3600, prefetch_hits=3, prefetch_ratio=0.1):
+        """
+
+        :param resolvers: upstream resolvers, tried in order.
+        :param max_entries: max answers cached, the earliest stored go first when full.
+        :param max_ttl: max seconds an answer is cached, whatever ttl upstream gives.
+        :param prefetch_hits: min hits within ttl for an entry to be refreshed before it expires, 0 to disable.
+        :param prefetch_ratio: part of ttl left, at least one second, when an entry is refreshed.
+        :return:
+        """
+        self._upstream = resolve.ResolverChain(resolvers)
+        self._max_entries = max_entries
+        self._max_ttl = max_ttl
+        self._prefetch_hits = prefetch_hits
+        self._prefetch_ratio = prefetch_ratio
+        # (name, type, cls) -> [answers, expires_at, stored_at, hits], in stored order.
+        self._entries = collections.OrderedDict()
+        # heap of three-tuple(prefetch_at, key, stored_at).
+        self._prefetches = []
+        # key -> deferreds waiting for the in-flight upstream query of key.
+        self._inflight = {}
+        self._logger = loggers.getlogger('d.r.ForwardResolver')
+
+        if prefetch_hits > 0:
+            self._prefetcher = task.LoopingCall(self._prefetch)
+            reactor.callWhenRunning(self._prefetcher.start, 1, now=False)
+
+    def query(self, query, timeout=None, context=None):
+        """
+
+        :param query:
+        :param timeout:
+        :param context: dict where source of the answer, cache or upstream, is put into.
+        :return:
+        """
+
+        key = (query.name.name.lower(), query.type, query.cls)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > now:
+            entry[3] += 1
+            if context is not None:
+                context['source'] = 'cache'
+            return defer.succeed(self._aged(entry[0], int(now - entry[2])))
+
+        return self._forward(key, query, timeout)
+
+    def forget(self, predicate):
+        """
+        drop cached answers of names matching predicate, usually names now served by backend.
+
+        :param predicate: callable taking a name.
+        :return: count of answers dropped.
+        """
+
+        keys = iter(self._entries) | select(lambda it: predicate(it[0])) | as_list
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def _forward(self, key, query, timeout):
+        # concurrent misses of a key share one upstream query.
+        d = defer.Deferred()
+        waiting = self._inflight.get(key)
+        if waiting is not None:
+            waiting.append(d)
+            return d
+
+        self._inflight[key] = [d]
+        self._upstream.query(query, timeout).addBoth(self._answered, key)
+        return d
+
+    def _answered(self, result, key):
+        waiting = self._inflight.pop(key, [])
+        if isinstance(result, failure.Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+
+        self._store(key, result)
+        for d in waiting:
+            d.callback(result)
+
+    def _store(self, key, result):
+        answers, authority, additional = result
+        ttls = [answers, authority, additional] | chain | select(lambda it: it.type != dns.OPT) \
+               | collect(lambda it: it.ttl) | as_list
+        # only positive answers are cached.
+        if not answers or not ttls:
+            return
+
+        ttl = [ttls | min, self._max_ttl] | min
+        if ttl <= 0:
+            return
+
+        now = time.time()
+        self._entries.pop(key, None)
+        if len(self._entries) >= self._max_entries:
+            self._entries.popitem(last=False)
+        self._entries[key] = [result, now + ttl, now, 0]
+
+        if self._prefetch_hits > 0 and ttl > 1:
+            heapq.heappush(self._prefetches, (now + ttl - ([ttl * self._prefetch_ratio, 1] | max), key, now))
+            # drop schedules of replaced or evicted entries once they pile up.
+            if len(self._prefetches) > self._max_entries * 4:
+                self._prefetches = self._prefetches \
+                                   | select(lambda it: it[1] in self._entries and self._entries[it[1]][2] == it[2]) \
+                                   | as_list
+                heapq.heapify(self._prefetches)
+
+    def _aged(self, result, elapsed):
+        if not elapsed:
+            return result
+
+        return tuple([dns.RRHeader(name=it.name.name, type=it.type, cls=it.cls,
+                                   ttl=it.ttl if it.type == dns.OPT else it.ttl - elapsed,
+                                   payload=it.payload, auth=it.auth) for it in records]
+                     for records in result)
+
+    def _prefetch(self):
+        now = time.time()
+        while self._prefetches and self._prefetches[0][0] <= now:
+            _, key, stored_at = heapq.heappop(self._prefetches)
+            entry = self._entries.get(key)
+            # unpopular entries just expire.
+            if entry is None or entry[2] != stored_at or entry[3] < self._prefetch_hits or key in self._inflight:
+                continue
+
+            name, qtype, cls = key
+            self._logger.d('prefetch name %s of type %s after %d hits.', name, qtype, entry[3])
+            d = self._forward(key, dns.Query(name, qtype, cls), None)
+            d.addErrback(lambda failure, name=name: self._logger.w('prefetch name %s occurs error: %s',
+                                                                    name, failure.getErrorMessage()))
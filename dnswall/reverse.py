@@ -0,0 +1,290 @@
+"""
+
+"""
+import socket
+
+from twisted.internet import defer, reactor, task, threads
+
+from dnswall import loggers
+from dnswall.commons import *
+
+__all__ = ['ReverseIndex', 'ReverseFollower', 'to_address', 'to_network', 'in_network']
+
+_IPV4_SUFFIX = '.in-addr.arpa'
+_IPV6_SUFFIX = '.ip6.arpa'
+
+_logger = loggers.getlogger('d.r.ReverseIndex')
+
+
+def to_address(name):
+    """
+    parse a reverse lookup name.
+
+    :param name: name under in-addr.arpa or ip6.arpa.
+    :return: two-tuple(family, packed address), or None if name is not a full reverse name.
+    """
+
+    name = name | lowcase
+    try:
+        if name.endswith(_IPV4_SUFFIX):
+            octets = name[:-len(_IPV4_SUFFIX)] | split(r'\.') | reverse | as_list
+            if len(octets) != 4 or not octets | all(lambda it: it.isdigit() and int(it) < 256):
+                return None
+            return socket.AF_INET, socket.inet_pton(socket.AF_INET, octets | join('.'))
+
+        if name.endswith(_IPV6_SUFFIX):
+            nibbles = name[:-len(_IPV6_SUFFIX)] | split(r'\.') | reverse | as_list
+            if len(nibbles) != 32 or not nibbles | all(lambda it: len(it) == 1):
+                return None
+            return socket.AF_INET6, ''.join(nibbles).decode('hex')
+    except (socket.error, TypeError, ValueError):
+        return None
+
+    return None
+
+
+def to_network(cidr):
+    """
+
+    :param cidr: network like 10.0.0.0/8, or a single address.
+    :return: three-tuple(family, packed address, prefix length).
+    """
+
+    address, _, prefix_len = cidr.partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+    return family, packed, int(prefix_len) if prefix_len else len(packed) * 8
+
+
+def in_network(family, packed, network):
+    """
+
+    :param family:
+    :param packed: packed address.
+    :param network: three-tuple returned by to_network.
+    :return: True if address is in network.
+    """
+
+    network_family, network_packed, prefix_len = network
+    if family != network_family:
+        return False
+
+    whole_bytes, rest_bits = divmod(prefix_len, 8)
+    if packed[:whole_bytes] != network_packed[:whole_bytes]:
+        return False
+    if not rest_bits:
+        return True
+
+    mask = (0xff << (8 - rest_bits)) & 0xff
+    return ord(packed[whole_bytes]) & mask == ord(network_packed[whole_bytes]) & mask
+
+
+def _address_keys(name, items):
+    keys = set()
+    for item in items:
+        for family, address in ((socket.AF_INET, item.host_ipv4), (socket.AF_INET6, item.host_ipv6)):
+            if not address:
+                continue
+            try:
+                keys.add((family, socket.inet_pton(family, address)))
+            except socket.error:
+                _logger.w('ignore invalid address %s of name %s.', address, name)
+    return keys
+
+
+class ReverseIndex(object):
+    """
+    address to names index of backend items, answering reverse lookups without touching backend.
+    the index is replaced as a whole on rebuild, so readers never see a partial one,
+    and kept up to date one name at a time between rebuilds.
+    """
+
+    def __init__(self, networks=None):
+        """
+
+        :param networks: cidrs owned by backend, reverse names in them are never forwarded.
+        :return:
+        """
+        self._networks = (networks or []) | collect(to_network) | as_list
+        # (family, packed address) -> sorted names.
+        self._names = {}
+        # name -> set of (family, packed address).
+        self._addresses = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def rebuild(self, details):
+        """
+
+        :param details: list of DomainDetail, usually returned by Backend.lookall().
+        :return: count of addresses indexed.
+        """
+
+        names, addresses = {}, {}
+        for name_detail in details:
+            # wildcard names are not names of an address.
+            if '*' in name_detail.name:
+                continue
+
+            keys = _address_keys(name_detail.name, name_detail.items)
+            if keys:
+                addresses.setdefault(name_detail.name, set()).update(keys)
+            for key in keys:
+                names.setdefault(key, set()).add(name_detail.name)
+
+        self._names = names.items() | collect(lambda it: (it[0], it[1] | sort | as_list)) | as_dict
+        self._addresses = addresses
+        return len(self._names)
+
+    def update(self, name, items):
+        """
+        replace the addresses of one name.
+
+        :param name:
+        :param items: current DomainItems of name, empty if name is gone.
+        :return: count of addresses whose names changed.
+        """
+
+        if '*' in name:
+            return 0
+
+        old_keys = self._addresses.get(name, set())
+        new_keys = _address_keys(name, items)
+        for key in old_keys - new_keys:
+            names = self._names.get(key, []) | select(lambda it: it != name) | as_list
+            if names:
+                self._names[key] = names
+            else:
+                self._names.pop(key, None)
+        for key in new_keys - old_keys:
+            self._names[key] = (self._names.get(key, []) + [name]) | sort | as_list
+
+        if new_keys:
+            self._addresses[name] = new_keys
+        else:
+            self._addresses.pop(name, None)
+        return len(old_keys ^ new_keys)
+
+    def lookup(self, name):
+        """
+
+        :param name: reverse lookup name.
+        :return: list of names, empty if address is managed but unknown, or None if address is not managed.
+        """
+
+        address = to_address(name)
+        if address is None:
+            return None
+
+        names = self._names.get(address)
+        if names:
+            return names
+
+        if self._networks | any(lambda it: in_network(address[0], address[1], it)):
+            return []
+        return None
+
+
+class ReverseFollower(object):
+    """
+    keeps a reverse index up to date by following backend changes, each changed name is looked up again,
+    so applying a change twice or late does no harm. the index is only rebuilt from a full read on start,
+    when changes can not be followed any more, and every interval as a safety net.
+    registered and unregistered names show up within a watch round trip, but an item expiring without
+    unregister changes no name, its addresses stay until the pointers of its names expire or the next rebuild.
+    """
+
+    def __init__(self, backend, reverse_index, interval=300, retry=5):
+        """
+
+        :param backend:
+        :param reverse_index: ReverseIndex kept up to date.
+        :param interval: seconds between two safety net rebuilds, 0 to rebuild only when following fails.
+        :param retry: seconds before a failed rebuild or a lost watch is retried.
+        :return:
+        """
+        self._backend = backend
+        self._reverse_index = reverse_index
+        self._interval = interval
+        self._retry = retry
+        # backend index the next watch starts at, None until the first rebuild.
+        self._next_index = None
+        # bumped by every rebuild, changes watched before it do not move the next index.
+        self._generation = 0
+        self._following = False
+        self._rebuilding = False
+
+    def start(self):
+        self.rebuild()
+        if self._interval > 0:
+            task.LoopingCall(self.rebuild).start(self._interval, now=False)
+
+    def _call(self, method, *args, **kwargs):
+        if self._backend.asynchronous:
+            return defer.maybeDeferred(getattr(self._backend, method), *args, **kwargs)
+        return threads.deferToThread(getattr(self._backend, method), *args, **kwargs)
+
+    def rebuild(self):
+        if self._rebuilding:
+            return None
+
+        self._rebuilding = True
+        d = self._call('lookall', with_index=True)
+
+        def _rebuilt(result):
+            details, index = result
+            count = self._reverse_index.rebuild(details)
+            _logger.i('%d addresses indexed for reverse lookup at index %d.', count, index)
+
+            # changes after the read are followed again, even if the watch got past them.
+            self._generation += 1
+            self._next_index = index + 1
+            if not self._following:
+                self._following = True
+                self._follow()
+
+        def _failed(failure):
+            _logger.e('rebuild reverse index occurs error, retry later.',
+                      exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+            if not self._following:
+                reactor.callLater(self._retry, self.rebuild)
+
+        def _done(_):
+            self._rebuilding = False
+
+        d.addCallbacks(_rebuilt, _failed)
+        d.addBoth(_done)
+        return d
+
+    def _follow(self):
+        d = self._call('watch', index=self._next_index)
+        d.addCallback(self._changed, self._generation)
+        d.addCallbacks(lambda _: reactor.callLater(0, self._follow), self._lost)
+
+    def _changed(self, change, generation):
+        # the watch timed out without changes.
+        if change is None:
+            return None
+
+        action, name, index = change
+        if generation == self._generation:
+            self._next_index = index + 1
+        if not name or not self._backend.supports(name):
+            return None
+
+        def _update(name_detail):
+            # a missing name may be answered by its wildcard, which is not a name of an address.
+            items = name_detail.items if name_detail.name == name else []
+            if self._reverse_index.update(name, items):
+                _logger.d('reverse index of name %s updated on %s.', name, action)
+
+        d = self._call('lookup', name)
+        d.addCallback(_update)
+        return d
+
+    def _lost(self, failure):
+        _logger.w('follow backend changes occurs error: %s, rebuild reverse index in %s seconds.',
+                  failure.getErrorMessage(), self._retry)
+        self._following = False
+        reactor.callLater(self._retry, self.rebuild)
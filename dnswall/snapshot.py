@@ -0,0 +1,147 @@
+"""
+
+"""
+import mmap
+import os
+import socket
+import struct
+import time
+
+from dnswall import loggers
+from dnswall.backend import *
+from dnswall.commons import *
+
+__all__ = ['Snapshot', 'export']
+
+_MAGIC = 'DNSWSNP1'
+
+# magic, name count, item count, created at.
+_HEADER = struct.Struct('<8sIIQ')
+# name offset, name length, first item, item count.
+_ENTRY = struct.Struct('<IHIH')
+# flags, ipv4 address, ipv6 address.
+_ITEM = struct.Struct('<B4s16s')
+
+_HAS_IPV4 = 0x01
+_HAS_IPV6 = 0x02
+
+_logger = loggers.getlogger('d.s.Snapshot')
+
+
+def _reverse(name):
+    return name | split(r'\.') | reverse | join('.')
+
+
+def export(details, path):
+    """
+    compile name details into a read-only snapshot file,
+    the file is replaced atomically so mapped readers keep their old copy.
+
+    :param details: list of DomainDetail, usually returned by Backend.lookall().
+    :param path:
+    :return: count of names exported.
+    """
+
+    details = details \
+              | select(lambda it: it.items) \
+              | collect(lambda it: (_reverse(it.name), it.items)) \
+              | sort(key=lambda it: it[0]) \
+              | as_list
+
+    entries, items, names = [], [], []
+    name_offset = 0
+    for reversed_name, name_items in details:
+        entries.append(_ENTRY.pack(name_offset, len(reversed_name), len(items), len(name_items)))
+        for item in name_items:
+            flags, ipv4, ipv6 = 0, '\0' * 4, '\0' * 16
+            if item.host_ipv4:
+                flags, ipv4 = flags | _HAS_IPV4, socket.inet_pton(socket.AF_INET, item.host_ipv4)
+            if item.host_ipv6:
+                flags, ipv6 = flags | _HAS_IPV6, socket.inet_pton(socket.AF_INET6, item.host_ipv6)
+            items.append(_ITEM.pack(flags, ipv4, ipv6))
+        names.append(reversed_name)
+        name_offset += len(reversed_name)
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, len(entries), len(items), int(time.time())))
+        f.write(''.join(entries))
+        f.write(''.join(items))
+        f.write(''.join(names))
+    os.rename(tmp_path, path)
+    return len(entries)
+
+
+class Snapshot(object):
+    """
+    memory-mapped view of a snapshot file, names are found by binary search
+    so loading costs nothing but the mmap and processes share one physical copy.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._name_count, self._item_count, self._created = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            self._mmap.close()
+            raise ValueError('{} is not a snapshot file.'.format(path))
+
+        self._entries_offset = _HEADER.size
+        self._items_offset = self._entries_offset + self._name_count * _ENTRY.size
+        self._names_offset = self._items_offset + self._item_count * _ITEM.size
+
+    def __len__(self):
+        return self._name_count
+
+    @property
+    def created(self):
+        return self._created
+
+    def close(self):
+        self._mmap.close()
+
+    def _entry(self, pos):
+        name_offset, name_len, first_item, item_count = \
+            _ENTRY.unpack_from(self._mmap, self._entries_offset + pos * _ENTRY.size)
+        start = self._names_offset + name_offset
+        return self._mmap[start:start + name_len], first_item, item_count
+
+    def _find(self, reversed_name):
+        lo, hi = 0, self._name_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < reversed_name:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._name_count:
+            entry = self._entry(lo)
+            if entry[0] == reversed_name:
+                return entry
+        return None
+
+    def _item(self, pos):
+        flags, ipv4, ipv6 = _ITEM.unpack_from(self._mmap, self._items_offset + pos * _ITEM.size)
+        return DomainItem(host_ipv4=socket.inet_ntop(socket.AF_INET, ipv4) if flags & _HAS_IPV4 else None,
+                          host_ipv6=socket.inet_ntop(socket.AF_INET6, ipv6) if flags & _HAS_IPV6 else None)
+
+    def lookup(self, name):
+        """
+
+        :param name: domain name.
+        :return: a releative DomainDetail, or None if name is not in snapshot.
+        """
+
+        entry = self._find(_reverse(name))
+        if entry is None:
+            name_list = name | split(r'\.') | as_list
+            if '*' in name or len(name_list) <= 2:
+                return None
+            return self.lookup((['*'] + name_list[1:]) | join('.'))
+
+        _, first_item, item_count = entry
+        return DomainDetail(name, items=range(first_item, first_item + item_count)
+                                        | collect(lambda it: self._item(it))
+                                        | as_list)
@@ -1,4 +1,5 @@
 import functools
+import random
 import threading
 import time
 
@@ -9,6 +10,8 @@ _logger = loggers.getlogger('d.s.supervise')
 
 def supervise(min_seconds=None, max_seconds=None):
     """
+    retry function on errors, backing off exponentially from min_seconds up to max_seconds,
+    every sleep is a random time up to the backoff so supervised callers don't retry in lockstep.
 
     :param min_seconds:
     :param max_seconds:
@@ -31,12 +34,14 @@ def supervise(min_seconds=None, max_seconds=None):
                     return None
                 except:
                     _logger.ex('function call occurs error.')
-                    _logger.w('sleep %d seconds and retry again.', retry_seconds)
+                    # full jitter, even the first retry is spread, so callers failing together retry apart.
+                    sleep_seconds = random.uniform(0, retry_seconds)
+                    _logger.w('sleep %.1f seconds and retry again.', sleep_seconds)
 
-                    time.sleep(retry_seconds)
+                    time.sleep(sleep_seconds)
                     next_retry_seconds *= 2
                     if next_retry_seconds > max_seconds:
-                        next_retry_seconds = min_seconds
+                        next_retry_seconds = max_seconds
                     retry_seconds = next_retry_seconds
 
         return wrapped
@@ -0,0 +1,55 @@
+import unittest
+from StringIO import StringIO
+
+from dnswall.ctl import _iter_records
+
+
+def _records(text, chunk_size=3):
+    return list(_iter_records(StringIO(text), chunk_size=chunk_size))
+
+
+class IterRecordsTest(unittest.TestCase):
+    def test_json_array(self):
+        text = '[\n  {"name": "a.dnswall.local", "items": [{"uuid": "1"}]},\n  {"name": "b.dnswall.local"}\n]\n'
+        self.assertEqual([{'name': 'a.dnswall.local', 'items': [{'uuid': '1'}]}, {'name': 'b.dnswall.local'}],
+                         _records(text))
+
+    def test_ndjson(self):
+        text = '{"name": "a.dnswall.local"}\n{"name": "b.dnswall.local"}\n'
+        for chunk_size in (1, 3, 64 * 1024):
+            self.assertEqual([{'name': 'a.dnswall.local'}, {'name': 'b.dnswall.local'}],
+                             _records(text, chunk_size))
+
+    def test_concatenated(self):
+        self.assertEqual([{'a': 1}, {'b': {'c': 2}}, {'d': 3}], _records('{"a": 1}{"b": {"c": 2}} {"d": 3}'))
+
+    def test_braces_and_escapes_in_strings(self):
+        text = '{"a": "}{\\""}\n{"b": "\\\\"}\n{"c": "\\u007b"}'
+        for chunk_size in (1, 2, 3, 4, 5):
+            self.assertEqual([{'a': '}{"'}, {'b': '\\'}, {'c': '{'}], _records(text, chunk_size))
+
+    def test_empty(self):
+        self.assertEqual([], _records(''))
+        self.assertEqual([], _records('[]\n'))
+
+    def test_malformed_record(self):
+        records = _iter_records(StringIO('{"a": 1}\n{"b": 2,,}\n{"c": 3}\n'), chunk_size=3)
+        self.assertEqual({'a': 1}, next(records))
+        self.assertRaises(ValueError, next, records)
+
+    def test_malformed_fails_before_reading_the_rest(self):
+        stream = StringIO('{"a": 1,}' + '{"b": 2}' * 10000)
+        records = _iter_records(stream, chunk_size=16)
+        self.assertRaises(ValueError, next, records)
+        self.assertTrue(stream.tell() <= 16)
+
+    def test_rejects_garbage(self):
+        self.assertRaises(ValueError, _records, '{"a": 1} garbage {"b": 2}')
+        self.assertRaises(ValueError, _records, '"a"')
+        self.assertRaises(ValueError, _records, '{"a": 1}}')
+        self.assertRaises(ValueError, _records, '{"a": 1}\n{"b": ')
+        self.assertRaises(ValueError, _records, '{"a": "unterminated}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import struct
+import unittest
+
+from twisted.names import dns
+
+from dnswall.protocols import FastDatagramProtocol
+from dnswall.ratelimit import SLIP
+
+
+class _Transport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, addr):
+        self.written.append((data, addr))
+
+
+class _Limiter(object):
+    def __init__(self, action):
+        self.action = action
+
+    def check(self, address):
+        return self.action
+
+
+def _query(name='A.dnswall.local', edns=False, **kwargs):
+    message = dns.Message(id=4242, **kwargs)
+    message.queries = [dns.Query(name, dns.A)]
+    if edns:
+        message.additional = [dns._OPTHeader(udpPayloadSize=4096)]
+    return message.toStr()
+
+
+class SlipTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = FastDatagramProtocol(controller=None, limiter=_Limiter(SLIP), max_udp_size=1232)
+        self.protocol.transport = _Transport()
+
+    def _slip(self, data):
+        self.protocol.datagramReceived(data, ('10.0.0.1', 5353))
+        self.assertEqual(1, len(self.protocol.transport.written))
+        response, addr = self.protocol.transport.written[0]
+        self.assertEqual(('10.0.0.1', 5353), addr)
+        return response
+
+    def test_header_and_question(self):
+        data = _query(recDes=1)
+        response = self._slip(data)
+
+        query_id, flags, rflags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HBBHHHH', response)
+        self.assertEqual(4242, query_id)
+        # qr, tc and rd set, opcode query.
+        self.assertEqual(0x80 | 0x02 | 0x01, flags)
+        # ra set, rcode ok.
+        self.assertEqual(0x80, rflags)
+        self.assertEqual((1, 0, 0, 0), (qdcount, ancount, nscount, arcount))
+        # the question is copied byte for byte, case included.
+        self.assertEqual(data[12:], response[12:])
+
+    def test_opt_echoed(self):
+        data = _query(edns=True)
+        response = self._slip(data)
+        self.assertEqual(1, struct.unpack_from('!H', response, 10)[0])
+
+        question_end = len(_query())
+        opt = response[question_end:]
+        self.assertEqual(11, len(opt))
+        self.assertEqual('\0', opt[0])
+        opt_type, udp_size, ttl, rdata_len = struct.unpack('!HHIH', opt[1:])
+        self.assertEqual((dns.OPT, 1232, 0, 0), (opt_type, udp_size, ttl, rdata_len))
+
+        message = dns.Message()
+        message.fromStr(response)
+        self.assertTrue(message.trunc)
+        self.assertEqual(['A.dnswall.local'], [it.name.name for it in message.queries])
+        self.assertEqual([dns.OPT], [it.type for it in message.additional])
+
+    def test_unparsable_query_is_dropped(self):
+        message = dns.Message(id=1)
+        message.queries = [dns.Query('a.dnswall.local', dns.A), dns.Query('b.dnswall.local', dns.A)]
+        self.protocol.datagramReceived(message.toStr(), ('10.0.0.1', 5353))
+        self.assertEqual([], self.protocol.transport.written)
+
+
+if __name__ == '__main__':
+    unittest.main()
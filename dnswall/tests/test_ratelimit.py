@@ -0,0 +1,71 @@
+import unittest
+
+from dnswall import ratelimit
+from dnswall.ratelimit import ALLOW, DROP, SLIP, ResponseRateLimiter
+
+
+class _Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class ResponseRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self._time = ratelimit.time
+        ratelimit.time = self.clock
+
+    def tearDown(self):
+        ratelimit.time = self._time
+
+    def test_allow_drop_slip(self):
+        limiter = ResponseRateLimiter(2, burst=2, slip=2)
+        actions = [limiter.check('10.0.0.1') for _ in range(6)]
+        self.assertEqual([ALLOW, ALLOW, DROP, SLIP, DROP, SLIP], actions)
+        self.assertEqual(2, limiter.dropped)
+        self.assertEqual(2, limiter.slipped)
+
+    def test_refill(self):
+        limiter = ResponseRateLimiter(2, burst=2, slip=0)
+        self.assertEqual([ALLOW, ALLOW, DROP], [limiter.check('10.0.0.1') for _ in range(3)])
+        self.clock.now += 0.5
+        self.assertEqual([ALLOW, DROP], [limiter.check('10.0.0.1') for _ in range(2)])
+        self.clock.now += 10
+        self.assertEqual([ALLOW, ALLOW, DROP], [limiter.check('10.0.0.1') for _ in range(3)])
+
+    def test_slip_zero_drops_all(self):
+        limiter = ResponseRateLimiter(1, slip=0)
+        self.assertEqual([ALLOW, DROP, DROP, DROP], [limiter.check('10.0.0.1') for _ in range(4)])
+
+    def test_ipv4_prefix(self):
+        limiter = ResponseRateLimiter(1, ipv4_prefix=24)
+        self.assertEqual(ALLOW, limiter.check('10.0.0.1'))
+        self.assertNotEqual(ALLOW, limiter.check('10.0.0.254'))
+        self.assertEqual(ALLOW, limiter.check('10.0.1.1'))
+
+    def test_ipv6_prefix(self):
+        limiter = ResponseRateLimiter(1, ipv6_prefix=56)
+        self.assertEqual(ALLOW, limiter.check('fd00:0:0:ab::1'))
+        self.assertNotEqual(ALLOW, limiter.check('fd00:0:0:ff:1::2'))
+        self.assertEqual(ALLOW, limiter.check('fd00:0:0:100::1'))
+
+    def test_lru_eviction(self):
+        limiter = ResponseRateLimiter(1, slip=0, max_clients=3)
+        for address in ('10.0.1.1', '10.0.2.1', '10.0.3.1'):
+            self.assertEqual(ALLOW, limiter.check(address))
+        # 10.0.1 is checked again, so 10.0.2 is the least recently checked one.
+        self.assertEqual(DROP, limiter.check('10.0.1.1'))
+        self.assertEqual(ALLOW, limiter.check('10.0.4.1'))
+        self.assertEqual(3, len(limiter._clients))
+
+        self.assertEqual(DROP, limiter.check('10.0.1.1'))
+        self.assertEqual(DROP, limiter.check('10.0.3.1'))
+        # forgotten, so its bucket is full again.
+        self.assertEqual(ALLOW, limiter.check('10.0.2.1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+from twisted.names import dns
+
+from dnswall.backend import DomainDetail, DomainItem
+from dnswall.transfer import ZoneTransfer, _serial_gt
+
+
+def _detail(name, *addresses):
+    items = [DomainItem(uuid=it, host_ipv6=it) if ':' in it else DomainItem(uuid=it, host_ipv4=it)
+             for it in addresses]
+    return DomainDetail(name, items=items)
+
+
+def _query(zone, qtype):
+    return dns.Query(zone, qtype)
+
+
+def _records(batches):
+    return [(it.name.name, it.type) for batch in batches for it in batch]
+
+
+class ZoneTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.transfer = ZoneTransfer(['dnswall.local.'], acl=['10.0.0.0/8'], ttl=30,
+                                     max_journal=2, nameserver='ns1.example.com')
+        self.transfer.rebuild([_detail('a.dnswall.local', '10.1.1.1'),
+                               _detail('b.dnswall.local', 'fd00::1'),
+                               _detail('other.local', '10.9.9.9')], 100)
+
+    def test_serial_arithmetic(self):
+        self.assertTrue(_serial_gt(2, 1))
+        self.assertFalse(_serial_gt(1, 1))
+        self.assertTrue(_serial_gt(1, 0xffffffff))
+
+    def test_soa_query(self):
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.SOA), None, stream=False)
+        self.assertEqual(dns.OK, rcode)
+        soa = batches[0][0].payload
+        self.assertEqual(100, soa.serial)
+        self.assertEqual('ns1.example.com', soa.mname.name)
+
+    def test_axfr_has_apex_ns(self):
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.AXFR), '10.0.0.1')
+        self.assertEqual(dns.OK, rcode)
+        records = _records(batches)
+        self.assertEqual(('dnswall.local', dns.SOA), records[0])
+        self.assertEqual(('dnswall.local', dns.SOA), records[-1])
+        self.assertIn(('dnswall.local', dns.NS), records)
+        self.assertIn(('a.dnswall.local', dns.A), records)
+        self.assertIn(('b.dnswall.local', dns.AAAA), records)
+        self.assertNotIn(('other.local', dns.A), records)
+
+    def test_acl_and_udp(self):
+        rcode, _ = self.transfer.answer(_query('dnswall.local', dns.AXFR), '192.168.0.1')
+        self.assertEqual(dns.EREFUSED, rcode)
+        rcode, _ = self.transfer.answer(_query('dnswall.local', dns.AXFR), '10.0.0.1', stream=False)
+        self.assertEqual(dns.EREFUSED, rcode)
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.IXFR), '10.0.0.1',
+                                              serial=1, stream=False)
+        self.assertEqual([('dnswall.local', dns.SOA)], _records(batches))
+
+    def test_unchanged_rebuild_keeps_serial(self):
+        self.assertEqual(0, self.transfer.rebuild([_detail('a.dnswall.local', '10.1.1.1'),
+                                                   _detail('b.dnswall.local', 'fd00::1')], 105))
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.SOA), None)
+        self.assertEqual(100, batches[0][0].payload.serial)
+
+    def test_ixfr_journal(self):
+        self.transfer.rebuild([_detail('a.dnswall.local', '10.1.1.2'),
+                               _detail('b.dnswall.local', 'fd00::1')], 110)
+
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.IXFR), '10.0.0.1', serial=100)
+        records = [it for batch in batches for it in batch]
+        self.assertEqual([dns.SOA, dns.SOA, dns.A, dns.SOA, dns.A, dns.SOA], [it.type for it in records])
+        self.assertEqual([110, 100, 110, 110], [it.payload.serial for it in records if it.type == dns.SOA])
+        self.assertEqual('10.1.1.1', records[2].payload.dottedQuad())
+        self.assertEqual('10.1.1.2', records[4].payload.dottedQuad())
+
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.IXFR), '10.0.0.1', serial=110)
+        self.assertEqual([('dnswall.local', dns.SOA)], _records(batches))
+
+    def test_ixfr_of_forgotten_serial_is_full(self):
+        for index, address in ((110, '10.1.1.2'), (120, '10.1.1.3'), (130, '10.1.1.4')):
+            self.transfer.rebuild([_detail('a.dnswall.local', address)], index)
+
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.IXFR), '10.0.0.1', serial=100)
+        records = _records(batches)
+        self.assertIn(('dnswall.local', dns.NS), records)
+        self.assertEqual(1, records.count(('a.dnswall.local', dns.A)))
+
+    def test_serial_never_reused(self):
+        self.transfer.rebuild([_detail('a.dnswall.local', '10.1.1.2')], 90)
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.SOA), None)
+        self.assertEqual(101, batches[0][0].payload.serial)
+
+    def test_split(self):
+        details = [_detail('host{}.dnswall.local'.format(i), '10.2.{}.{}'.format(i // 250, i % 250))
+                   for i in range(5000)]
+        self.transfer.rebuild(details, 200)
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.AXFR), '10.0.0.1')
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual(5000 + 3, sum(len(it) for it in batches))
+        for batch in batches:
+            message = dns.Message(answer=1)
+            message.answers = batch
+            self.assertTrue(len(message.toStr()) < 65535)
+
+    def test_zones_change_keeps_journal(self):
+        self.transfer.rebuild([_detail('a.dnswall.local', '10.1.1.2')], 110)
+        self.transfer.zones = ['dnswall.local', 'other.local']
+        # only the new zone changes.
+        self.assertEqual(1, self.transfer.rebuild([_detail('a.dnswall.local', '10.1.1.2')], 120))
+        rcode, batches = self.transfer.answer(_query('dnswall.local', dns.IXFR), '10.0.0.1', serial=100)
+        self.assertEqual(dns.SOA, batches[0][1].type)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+"""
+
+"""
+import collections
+import socket
+
+from twisted.names import dns
+
+from dnswall import loggers
+from dnswall.commons import *
+from dnswall.reverse import *
+
+__all__ = ['ZoneTransfer']
+
+# tcp messages are limited to 65535 bytes, leave room for header, question and opt record.
+_MAX_MESSAGE_SIZE = 60000
+_SERIAL_MASK = 0xffffffff
+
+_logger = loggers.getlogger('d.t.ZoneTransfer')
+
+
+def _serial_gt(a, b):
+    # serial number arithmetic of rfc 1982.
+    return a != b and ((a - b) & _SERIAL_MASK) < 0x80000000
+
+
+def _record_size(record):
+    # uncompressed size: name, type, class, ttl, rdata length and rdata,
+    # soa carries two more names and five numbers.
+    name_size = len(record.name.name) + 2
+    if record.type == dns.SOA:
+        return name_size * 3 + 10 + 20
+    if record.type == dns.NS:
+        return name_size + 10 + len(record.payload.name.name) + 2
+    return name_size + 10 + (4 if record.type == dns.A else 16)
+
+
+class _Version(object):
+    def __init__(self, serial, records):
+        self.serial = serial
+        # frozenset of three-tuple(name, type, address or nameserver).
+        self.records = records
+
+
+class ZoneTransfer(object):
+    """
+    versioned copies of the pattern zones served by axfr and ixfr,
+    serials follow the backend index and differences between versions are journaled,
+    so secondaries holding a recent serial only receive what changed.
+    """
+
+    def __init__(self, zones, acl=None, ttl=30, refresh=30, max_journal=100, nameserver=None):
+        """
+
+        :param zones: zone names, usually the patterns of backend.
+        :param acl: cidrs allowed to transfer zones, empty means nobody.
+        :param ttl: ttl of transferred records.
+        :param refresh: seconds between two rebuilds, advertised as refresh and retry of soa.
+        :param max_journal: max differences kept per zone, older serials get a full transfer.
+        :param nameserver: name of this daemon, the apex ns and soa mname of zones, default is fqdn of host.
+        :return:
+        """
+        self._nameserver = (nameserver or socket.getfqdn()).strip('.') | lowcase
+        self._zones = zones | collect(lambda it: it.strip('.') | lowcase) | select(lambda it: it) | as_set
+        self._acl = (acl or []) | collect(to_network) | as_list
+        self._ttl = ttl
+        self._refresh = refresh
+        self._max_journal = max_journal
+        # zone -> _Version
+        self._versions = {}
+        # zone -> deque of four-tuple(from serial, to serial, removed records, added records).
+        self._journals = {}
+
+    @property
+    def zones(self):
+        return self._zones
+
+    @zones.setter
+    def zones(self, zones):
+        """
+        versions and journals of kept zones stay, so their secondaries still get incremental transfers,
+        new zones are served from the next rebuild.
+        """
+
+        self._zones = zones | collect(lambda it: it.strip('.') | lowcase) | select(lambda it: it) | as_set
+        for zone in iter(self._versions) | select(lambda it: it not in self._zones) | as_list:
+            del self._versions[zone]
+            del self._journals[zone]
+
+    def handles(self, query):
+        return query.type in (dns.SOA, dns.AXFR, dns.IXFR) and query.name.name.lower() in self._zones
+
+    def allows(self, client):
+        if not client:
+            return False
+
+        family = socket.AF_INET6 if ':' in client else socket.AF_INET
+        try:
+            packed = socket.inet_pton(family, client)
+        except socket.error:
+            return False
+        return self._acl | any(lambda it: in_network(family, packed, it))
+
+    def _zone_of(self, name):
+        parts = name | split(r'\.') | as_list
+        for i in range(len(parts)):
+            zone = parts[i:] | join('.')
+            if zone in self._zones:
+                return zone
+        return None
+
+    def rebuild(self, details, index):
+        """
+
+        :param details: list of DomainDetail, usually returned by Backend.lookall().
+        :param index: backend index details are read at.
+        :return: count of zones changed.
+        """
+
+        # secondaries refuse zones without ns records at their apex.
+        records = self._zones | collect(lambda it: (it, {(it, dns.NS, self._nameserver)})) | as_dict
+        for name_detail in details:
+            name = name_detail.name | lowcase
+            zone = self._zone_of(name)
+            if zone is None:
+                continue
+
+            for item in name_detail.items:
+                for qtype, family, address in ((dns.A, socket.AF_INET, item.host_ipv4),
+                                               (dns.AAAA, socket.AF_INET6, item.host_ipv6)):
+                    if not address:
+                        continue
+                    try:
+                        socket.inet_pton(family, address)
+                    except socket.error:
+                        _logger.w('ignore invalid address %s of name %s.', address, name)
+                        continue
+                    records[zone].add((name, qtype, address))
+
+        changed = 0
+        serial = index & _SERIAL_MASK
+        for zone, zone_records in records.items():
+            zone_records = frozenset(zone_records)
+            current = self._versions.get(zone)
+            if current is None:
+                self._versions[zone] = _Version(serial, zone_records)
+                self._journals[zone] = collections.deque(maxlen=self._max_journal)
+                changed += 1
+                continue
+
+            if zone_records == current.records:
+                continue
+
+            # the index only moves forward, but never reuse a serial whatever happens to backend.
+            new_serial = serial if _serial_gt(serial, current.serial) else (current.serial + 1) & _SERIAL_MASK
+            self._journals[zone].append((current.serial, new_serial,
+                                         current.records - zone_records, zone_records - current.records))
+            self._versions[zone] = _Version(new_serial, zone_records)
+            changed += 1
+
+        return changed
+
+    def answer(self, query, client, serial=None, stream=True):
+        """
+
+        :param query: soa, axfr or ixfr query of a zone.
+        :param client: client address.
+        :param serial: serial held by client for ixfr.
+        :param stream: True if query comes from tcp.
+        :return: two-tuple(rcode, list of answer lists, each fits in one message).
+        """
+
+        zone = query.name.name.lower()
+        version = self._versions.get(zone)
+        if version is None:
+            return dns.ESERVER, []
+
+        soa = self._soa(zone, version.serial)
+        if query.type == dns.SOA:
+            return dns.OK, [[soa]]
+
+        if not self.allows(client):
+            _logger.w('transfer of zone %s refused for %s.', zone, client)
+            return dns.EREFUSED, []
+
+        # rfc 1995, a udp ixfr is answered with the current soa, telling client to retry over tcp.
+        if not stream:
+            return (dns.OK, [[soa]]) if query.type == dns.IXFR else (dns.EREFUSED, [])
+
+        if query.type == dns.IXFR and serial is not None:
+            if serial == version.serial:
+                return dns.OK, [[soa]]
+
+            diffs = self._journals[zone] | skip_while(lambda it: it[0] != serial) | as_list
+            if diffs:
+                _logger.i('incremental transfer of zone %s from %d to %d for %s.',
+                          zone, serial, version.serial, client)
+                records = [soa]
+                for from_serial, to_serial, removed, added in diffs:
+                    records.append(self._soa(zone, from_serial))
+                    records.extend(self._records(removed))
+                    records.append(self._soa(zone, to_serial))
+                    records.extend(self._records(added))
+                records.append(soa)
+                return dns.OK, self._split(records)
+
+        _logger.i('full transfer of zone %s at %d for %s.', zone, version.serial, client)
+        return dns.OK, self._split([soa] + self._records(version.records) + [soa])
+
+    def _soa(self, zone, serial):
+        record = dns.Record_SOA(mname=self._nameserver, rname='hostmaster.{}'.format(zone), serial=serial,
+                                refresh=self._refresh, retry=self._refresh, expire=self._refresh * 100,
+                                minimum=self._ttl, ttl=self._ttl)
+        return dns.RRHeader(zone, type=dns.SOA, ttl=self._ttl, payload=record, auth=True)
+
+    def _records(self, records):
+        headers = []
+        for name, qtype, value in records | sort | as_list:
+            if qtype == dns.NS:
+                payload = dns.Record_NS(value, self._ttl)
+            elif qtype == dns.A:
+                payload = dns.Record_A(value, self._ttl)
+            else:
+                payload = dns.Record_AAAA(value, self._ttl)
+            headers.append(dns.RRHeader(name, type=qtype, ttl=self._ttl, payload=payload, auth=True))
+        return headers
+
+    def _split(self, records):
+        batches, batch, size = [], [], 0
+        for record in records:
+            record_size = _record_size(record)
+            if batch and size + record_size > _MAX_MESSAGE_SIZE:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(record)
+            size += record_size
+
+        batches.append(batch)
+        return batches
@@ -0,0 +1,305 @@
+import json
+import time
+import urllib
+from StringIO import StringIO
+
+import etcd
+from twisted.internet import defer, reactor
+from twisted.web import client
+from twisted.web.http_headers import Headers
+
+from dnswall import loggers
+from dnswall.backend import *
+from dnswall.commons import *
+from dnswall.errors import *
+
+__all__ = ["TxEtcdBackend"]
+
+_MAX_PERSISTENT_PER_HOST = 16
+
+
+class TxEtcdBackend(EtcdBackend):
+    """
+    etcd backend talking to the etcd v2 http api on the reactor,
+    every operation returns a deferred instead of blocking.
+    """
+
+    asynchronous = True
+
+    def __init__(self, *args, **kwargs):
+        super(TxEtcdBackend, self).__init__(*args, **kwargs)
+        self._logger = loggers.getlogger('d.b.TxEtcdBackend')
+
+    def _new_client(self):
+        pool = client.HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = _MAX_PERSISTENT_PER_HOST
+
+        return client.Agent(reactor, pool=pool)
+
+    def _request(self, method, etcd_key, params=None, body=None, measured=True, attempts=None):
+        """
+        send request to the endpoint picked by balancer, fail over to next endpoint on connection errors.
+
+        :return: a deferred fires with EtcdResult.
+        """
+
+        if attempts is None:
+            attempts = len(self._hosts)
+
+        endpoint = self._balancer.pick()
+        url = 'http://{}:{}/v2/keys{}'.format(endpoint[0], endpoint[1], urllib.quote(etcd_key))
+        if params:
+            url = '{}?{}'.format(url, urllib.urlencode(params))
+
+        headers = Headers()
+        producer = None
+        if body is not None:
+            headers.addRawHeader('Content-Type', 'application/x-www-form-urlencoded')
+            producer = client.FileBodyProducer(StringIO(urllib.urlencode(body)))
+
+        started = time.time()
+
+        def _succeeded(result):
+            self._balancer.succeeded(endpoint, time.time() - started if measured else None)
+            return result
+
+        def _failover(failure):
+            if failure.check(etcd.EtcdException):
+                return _succeeded(failure)
+
+            self._balancer.failed(endpoint)
+            if attempts <= 1:
+                return failure
+
+            self._logger.w('request %s occurs error, fail over to next endpoint.', url)
+            return self._request(method, etcd_key, params=params, body=body,
+                                 measured=measured, attempts=attempts - 1)
+
+        d = self._client.request(method, url, headers, producer)
+        d.addCallback(self._read_response)
+        d.addCallbacks(_succeeded, _failover)
+        return d
+
+    def _read_params(self, **params):
+        if self._quorum:
+            params['quorum'] = 'true'
+        return params
+
+    def _read_response(self, response):
+        d = client.readBody(response)
+        d.addCallback(self._to_result, response)
+        return d
+
+    def _to_result(self, body, response):
+        payload = json.loads(body)
+        if response.code not in (200, 201):
+            payload['status'] = response.code
+            etcd.EtcdError.handle(payload)
+
+        result = etcd.EtcdResult(**payload)
+        etcd_index = response.headers.getRawHeaders('x-etcd-index')
+        result.etcd_index = etcd_index[0] | as_int if etcd_index else 1
+        return result
+
+    def _backend_error(self, failure, message, *args):
+        if failure.check(BackendError):
+            return failure
+
+        self._logger.e(message, *args, exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        raise BackendError
+
+    def register(self, name, item, ttl=None):
+        return defer.maybeDeferred(self._register, name, item, ttl)
+
+    def _register(self, name, item, ttl):
+
+        etcd_keys = self._pointers_to_write(self._etcdkeys(name, item), item)
+        item_body = {'value': self._etcdvalue(item)}
+        if ttl:
+            item_body['ttl'] = ttl
+
+        pointer_body = {'value': self._etcdpointer(item.uuid)}
+        if ttl:
+            pointer_body['ttl'] = self._pointer_ttl(ttl)
+
+        def _write_pointers(_):
+            return defer.gatherResults([self._request('PUT', it, body=pointer_body) for it in etcd_keys],
+                                       consumeErrors=True)
+
+        # the item goes first, so a new pointer never points to nothing.
+        d = self._request('PUT', self._etcduuidkey(item.uuid), body=item_body)
+        d.addCallback(_write_pointers)
+        d.addCallbacks(lambda _: self._pointers_written(etcd_keys, ttl, item), self._backend_error,
+                       errbackArgs=('register occur error.',))
+        return d
+
+    def unregister(self, name, item):
+        return defer.maybeDeferred(self._unregister, name, item)
+
+    def _unregister(self, name, item):
+
+        def _not_found(failure, etcd_key):
+            failure.trap(etcd.EtcdKeyError)
+            self._logger.d('unregister key %s not found, just ignore it', etcd_key)
+
+        etcd_keys = self._etcdkeys(name, item)
+        self._pointers_removed(etcd_keys, item)
+
+        requests = []
+        for etcd_key in etcd_keys + [self._etcduuidkey(item.uuid)]:
+            d = self._request('DELETE', etcd_key)
+            d.addErrback(_not_found, etcd_key)
+            requests.append(d)
+
+        d = defer.gatherResults(requests, consumeErrors=True)
+        d.addCallbacks(lambda _: None, self._backend_error, errbackArgs=('unregister occur error.',))
+        return d
+
+    def lookup(self, name):
+        return defer.maybeDeferred(self._lookup, name)
+
+    def _lookup(self, name):
+
+        self._check_name(name)
+        etcd_key = self._etcdkey(name)
+
+        def _not_found(failure):
+            failure.trap(etcd.EtcdKeyError)
+            if not self._can_wildcard_lookback(name):
+                return DomainDetail(name)
+
+            return self._lookup(self._get_wildcard_lookback(name))
+
+        def _to_namedetail(result):
+            d = self._lookup_pointed([result])
+            d.addCallback(lambda pointed: self._to_namedetail(name, result, pointed))
+            return d
+
+        d = self._request('GET', etcd_key, params=self._read_params(recursive='true'))
+        d.addCallback(_to_namedetail)
+        d.addErrback(_not_found)
+        d.addErrback(self._backend_error, 'lookup key %s occurs error.', etcd_key)
+        return d
+
+    def _lookup_pointed(self, results):
+        pointed, missing = self._cached_items(self._pointers_of(results))
+
+        def _read(items):
+            pointed.update(items | as_dict)
+            return pointed
+
+        if self._reads_missing_at_once(missing):
+            d = self._lookall_uuids()
+            d.addCallback(lambda items: _read(self._pointed_of(items, missing)))
+            return d
+
+        d = defer.gatherResults([self._lookup_uuid(it) for it in missing], consumeErrors=True)
+        d.addCallbacks(_read, self._first_failure)
+        return d
+
+    def _lookup_uuid(self, uuid):
+
+        def _expired(failure):
+            failure.trap(etcd.EtcdKeyError)
+            return uuid, None
+
+        d = self._request('GET', self._etcduuidkey(uuid), params=self._read_params())
+        d.addCallback(lambda result: (uuid, self._item_read(self._rawvalue(result.value, result.ttl),
+                                                             result.etcd_index)))
+        d.addErrback(_expired)
+        return d
+
+    def lookall(self, name=None, with_index=False):
+
+        def _to_lookall(results):
+            if self._reads_all_items(name):
+                d = self._lookall_uuids()
+            else:
+                d = self._lookup_pointed(results | select(lambda it: it[0] is not None)
+                                         | collect(lambda it: it[0]) | as_list)
+            d.addCallback(lambda pointed: self._to_lookall(results, pointed, with_index))
+            return d
+
+        lookups = [self._lookall(it) for it in self._etcdlookallkeys(name)]
+        d = defer.gatherResults(lookups, consumeErrors=True)
+        d.addErrback(self._first_failure)
+        d.addCallback(_to_lookall)
+        d.addErrback(self._backend_error, 'lookall items occurs error.')
+        return d
+
+    def lookall_parts(self, name=None):
+        """
+        split lookall(name) into parts one level below its scope keys, so a huge tree is read part by part.
+
+        :param name:
+        :return: a deferred fires with list of two-tuple(name, recursive), names of subtrees read by lookall(),
+                    or names whose own items are read by lookup() if not recursive.
+        """
+
+        def _to_parts(results):
+            parts = []
+            for result, _ in results | select(lambda it: it[0] is not None):
+                parent_key = result.key.rstrip('/')
+                for child in result.get_subtree():
+                    parent, _, child_name = child.key.rstrip('/').rpartition('/')
+                    if parent != parent_key or not child.dir:
+                        continue
+                    if child_name == EtcdBackend.ITEMS_KEY:
+                        parts.append((self._dirname(parent_key), False))
+                    elif not child_name.startswith('@'):
+                        parts.append((self._dirname(child.key), True))
+            return parts
+
+        lookups = [self._lookall(it, recursive=False) for it in self._etcdlookallkeys(name)]
+        d = defer.gatherResults(lookups, consumeErrors=True)
+        d.addErrback(self._first_failure)
+        d.addCallback(_to_parts)
+        d.addErrback(self._backend_error, 'lookall parts occurs error.')
+        return d
+
+    def _dirname(self, etcd_key):
+        return self._rawkey('{}/{}/'.format(etcd_key, EtcdBackend.ITEMS_KEY))
+
+    def _first_failure(self, failure):
+        while failure.check(defer.FirstError):
+            failure = failure.value.subFailure
+        return failure
+
+    def _lookall(self, etcd_key, recursive=True):
+
+        def _not_found(failure):
+            failure.trap(etcd.EtcdKeyError)
+            self._logger.d('key %s not found, just ignore it.', etcd_key)
+            return None, 0
+
+        d = self._request('GET', etcd_key, params=self._read_params(recursive='true' if recursive else 'false'))
+        d.addCallback(lambda result: (result, result.etcd_index))
+        d.addErrback(_not_found)
+        d.addErrback(self._backend_error, 'lookall key %s occurs error.', etcd_key)
+        return d
+
+    def _lookall_uuids(self):
+        etcd_key = self._etcduuidkey()
+
+        def _not_found(failure):
+            failure.trap(etcd.EtcdKeyError)
+            self._logger.d('key %s not found, just ignore it.', etcd_key)
+            return {}
+
+        d = self._request('GET', etcd_key, params=self._read_params(recursive='true'))
+        d.addCallback(lambda result: self._to_uuiditems(result, result.etcd_index))
+        d.addErrback(_not_found)
+        d.addErrback(self._backend_error, 'lookall key %s occurs error.', etcd_key)
+        return d
+
+    def watch(self, name=None, index=None):
+
+        etcd_key = self._etcdwatchkey(name)
+        etcd_params = {'wait': 'true', 'recursive': 'true'}
+        if index:
+            etcd_params['waitIndex'] = index
+
+        d = self._request('GET', etcd_key, params=etcd_params, measured=False)
+        d.addCallback(self._to_change)
+        d.addErrback(self._backend_error, 'watch key %s occurs error.', etcd_key)
+        return d
@@ -0,0 +1,88 @@
+"""
+
+"""
+import collections
+import threading
+
+from dnswall import loggers
+from dnswall.errors import *
+
+__all__ = ['BatchWriter']
+
+_logger = loggers.getlogger('d.w.BatchWriter')
+
+
+class BatchWriter(object):
+    """
+    registers items to backend from one background thread on behalf of many producers,
+    pending registrations of the same name and item are merged so only the latest is written.
+    """
+
+    def __init__(self, backend, max_batch=100, max_pending=10000, limiter=None):
+        """
+
+        :param backend:
+        :param max_batch: max registrations written in one round.
+        :param max_pending: max registrations waiting, new ones are dropped when full.
+        :param limiter: TokenBucket taken by every write, None means no limit.
+        :return:
+        """
+        self._backend = backend
+        self._limiter = limiter
+        self._max_batch = max_batch
+        self._max_pending = max_pending
+        # (name, uuid) -> (name, item, ttl), in arrival order.
+        self._pending = collections.OrderedDict()
+        self._condition = threading.Condition()
+
+        writer = threading.Thread(target=self._run, name='dnswall-writer')
+        writer.daemon = True
+        writer.start()
+
+    def register(self, name, item, ttl=None):
+        """
+        queue a registration, it is written to backend asynchronously.
+
+        :param name:
+        :param item:
+        :param ttl:
+        :return:
+        """
+
+        if not item or not item.uuid:
+            raise BackendValueError('item or item.uuid must not be none or empty.')
+
+        key = (name, item.uuid)
+        with self._condition:
+            if key not in self._pending and len(self._pending) >= self._max_pending:
+                _logger.w('too many pending registrations, drop name %s.', name)
+                return
+
+            self._pending.pop(key, None)
+            self._pending[key] = (name, item, ttl)
+            self._condition.notify()
+
+    def _take(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            batch = []
+            while self._pending and len(batch) < self._max_batch:
+                batch.append(self._pending.popitem(last=False)[1])
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            for name, item, ttl in batch:
+                if self._limiter:
+                    self._limiter.acquire()
+                try:
+                    self._backend.register(name, item, ttl=ttl)
+                except BackendValueError:
+                    _logger.w('registration of name %s is invalid, just ignore it.', name)
+                except:
+                    _logger.ex('register name %s occurs error, wait for next heartbeat.', name)
+
+            _logger.d('%d registrations written to backend.', len(batch))
@@ -12,12 +12,21 @@ setup(
     author="coding4m",
     author_email="coding4m@gmail.com",
 
-    install_requires=['python-etcd>=0.4.3', 'twisted>=15.5.0', 'docker-py>=1.7.0', 'jsonselect>=0.2.3'],
+    # twisted, docker-py and jsonselect serve the python 2 tools, the asyncio daemon needs only python-etcd.
+    install_requires=['python-etcd>=0.4.3',
+                      'twisted>=15.5.0; python_version<"3"',
+                      'docker-py>=1.7.0; python_version<"3"',
+                      'jsonselect>=0.2.3; python_version<"3"'],
+    extras_require={
+        'uvloop': ['uvloop; python_version>="3.5"'],
+    },
 
     entry_points={
         'console_scripts': [
             'dnswall-daemon = dnswall.daemon:main',
-            'dnswall-agent = dnswall.agent:main'
+            'dnswall-agent = dnswall.agent:main',
+            'dnswall-aiodaemon = dnswall.aiodaemon:main',
+            'dnswall-ctl = dnswall.ctl:main'
         ]
     }
 